@@ -0,0 +1,88 @@
+"""
+Micro-benchmark purchase serialization: Pydantic/stdlib json vs Row tuples + orjson/msgpack.
+
+Usage:
+
+    python benchmarks/serialization.py --rows 100000
+
+Rows are loaded into an in-memory SQLite database, so only the ORM and
+serialization cost is measured, not network or disk I/O.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from model import Base, PurchaseDB, PurchaseResponse, PurchaseSearchParams, PURCHASE_FIELDS
+from repository import PurchaseRepository
+from serialization import MsgPackResponse, ORJSONResponse, rows_to_dicts
+
+def legacy(db: Session) -> bytes:
+    """Previous path: ORM objects -> PurchaseResponse -> response_model validation -> json"""
+    purchases = db.query(PurchaseDB).all()
+    responses = [
+        PurchaseResponse(
+            id=p.id,
+            customer_name=p.customer_name,
+            customer_surname=p.customer_surname,
+            customer_cf=p.customer_cf,
+            credit_card=p.credit_card,
+            product_name=p.product_name,
+            price=p.price,
+            date=p.date,
+            receipt_path=p.receipt_path
+        )
+        for p in purchases
+    ]
+    validated = [PurchaseResponse.model_validate(r.model_dump()) for r in responses]
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+def fast(db: Session, response_class) -> bytes:
+    """Fast path: Row tuples -> dicts -> orjson/msgpack"""
+    rows = PurchaseRepository(db).search_purchases(PurchaseSearchParams(), limit=sys.maxsize)
+    return response_class({"items": rows_to_dicts(PURCHASE_FIELDS, rows)}).body
+
+def measure(label: str, run, rows: int, repeat: int):
+    """Print the best rows/second over `repeat` runs"""
+    best = min(_timed(run) for _ in range(repeat))
+    print(f"{label:<28} {rows / best:>12,.0f} rows/s   ({best * 1000:8.1f} ms)")
+
+def _timed(run) -> float:
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.execute(insert(PurchaseDB), [
+            {
+                "customer_name": "Mario", "customer_surname": "Rossi",
+                "customer_cf": "RSSMRA80A01H501U", "credit_card": "4111111111111111",
+                "product_name": f"Product {i % 1000}", "price": (i % 10000) / 10,
+                "date": datetime.date(2025, 1, 1), "receipt_path": f"./uploads/{i}.pdf",
+            }
+            for i in range(args.rows)
+        ])
+        db.commit()
+
+        measure("pydantic + json (before)", lambda: legacy(db), args.rows, args.repeat)
+        db.expunge_all()
+        measure("rows + orjson (after)", lambda: fast(db, ORJSONResponse), args.rows, args.repeat)
+        measure("rows + msgpack (after)", lambda: fast(db, MsgPackResponse), args.rows, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Read-through caches for purchase lookups and search pages: in-process LRU/TTL or shared Redis
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from config import config
+from serialization import dumps_json
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+import threading
+import time
+import orjson
+
+# Stored in place of a purchase that was just deleted: a read racing the delete
+# cannot cache the row it loaded before the delete committed
+TOMBSTONE = b""
+
+class Cache(ABC):
+    """Read-through cache with hit/miss counters"""
+
+    # Whether calls do network I/O and must be kept off the event loop
+    blocking = False
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @abstractmethod
+    def get(self, key: Hashable) -> Any:
+        """The cached value, or None on a miss"""
+
+    @abstractmethod
+    def add(self, key: Hashable, value: Any) -> None:
+        """Cache a value loaded after a miss, unless it was invalidated meanwhile"""
+
+    @abstractmethod
+    def invalidate(self, keys: Iterable[Hashable]) -> None:
+        """Drop the values of deleted rows"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Drop every cached value"""
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cache settings and counters of this process"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self).__name__,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+class MemoryCache(Cache):
+    """Bounded per-process cache evicting the least recently used entry, entries expiring after `ttl` seconds"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None or entry[1] is TOMBSTONE:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def add(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return
+            self._store(key, value)
+
+    def invalidate(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            for key in keys:
+                self._store(key, TOMBSTONE)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        """Insert as most recently used, evicting from the other end past maxsize; caller holds the lock"""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = super().snapshot()
+        with self._lock:
+            snapshot.update({
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            })
+        return snapshot
+
+class RedisCache(Cache):
+    """Cache shared by every worker in Redis (or any server speaking its protocol), so writes invalidate everywhere;
+    size is bounded by the server's maxmemory policy"""
+
+    blocking = True
+
+    def __init__(
+        self,
+        ttl: float,
+        url: Optional[str] = None,
+        client=None,
+        prefix: str = "purchase:",
+        encode: Optional[Callable[[Any], bytes]] = None,
+        decode: Optional[Callable[[bytes], Any]] = None
+    ):
+        super().__init__(ttl)
+        self.client = client if client is not None else _redis_client(url)
+        self.prefix = prefix
+        # Values are stored as given (bytes) unless a codec is supplied
+        self.encode = encode
+        self.decode = decode
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.prefix}{key}"
+
+    def get(self, key: Hashable) -> Any:
+        value = self.client.get(self._key(key))
+        if not value:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return self.decode(value) if self.decode else value
+
+    def add(self, key: Hashable, value: Any) -> None:
+        # NX leaves a tombstone written by a concurrent delete in place
+        value = self.encode(value) if self.encode else value
+        self.client.set(self._key(key), value, px=int(self.ttl * 1000), nx=True)
+
+    def invalidate(self, keys: Iterable[Hashable], batch_size: int = 1000) -> None:
+        pipeline = self.client.pipeline(transaction=False)
+        pending = 0
+        for key in keys:
+            pipeline.set(self._key(key), TOMBSTONE, px=int(self.ttl * 1000))
+            pending += 1
+            if pending % batch_size == 0:
+                pipeline.execute()
+        pipeline.execute()
+        with self._lock:
+            self.invalidations += pending
+
+    def clear(self) -> None:
+        keys = []
+        for key in self.client.scan_iter(match=f"{self.prefix}*", count=1000):
+            keys.append(key)
+            if len(keys) == 1000:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+@lru_cache(maxsize=None)
+def _redis_client(url: str):
+    """One connection pool per Redis URL, shared by the caches using it"""
+    import redis
+
+    return redis.Redis.from_url(url)
+
+@lru_cache(maxsize=None)
+def get_purchase_cache() -> Optional[Cache]:
+    """The purchase cache selected by PURCHASE_CACHE, shared by every request; None when caching is off"""
+    if config.PURCHASE_CACHE == "redis":
+        # Prices come back as floats and dates as ISO strings, which serialize identically
+        return RedisCache(
+            config.PURCHASE_CACHE_TTL, url=config.REDIS_URL, prefix="purchase:",
+            encode=dumps_json, decode=orjson.loads
+        )
+    if config.PURCHASE_CACHE == "memory":
+        return MemoryCache(config.PURCHASE_CACHE_SIZE, config.PURCHASE_CACHE_TTL)
+    return None
+
+@lru_cache(maxsize=None)
+def get_search_cache() -> Optional[Cache]:
+    """The cache of serialized search pages selected by SEARCH_CACHE; None when caching is off"""
+    if config.SEARCH_CACHE == "redis":
+        return RedisCache(config.SEARCH_CACHE_TTL, url=config.REDIS_URL, prefix="search:")
+    if config.SEARCH_CACHE == "memory":
+        return MemoryCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL)
+    return None
+
+def cache_diagnostics() -> Dict[str, Any]:
+    """Purchase and search cache counters of this worker process"""
+    diagnostics: Dict[str, Any] = {"purchase": {"backend": None}, "search": {"backend": None}}
+    purchase_cache, search_cache = get_purchase_cache(), get_search_cache()
+    if purchase_cache is not None:
+        diagnostics["purchase"] = purchase_cache.snapshot()
+    if search_cache is not None:
+        diagnostics["search"] = search_cache.snapshot()
+    return diagnostics
@@ -0,0 +1,61 @@
+"""
+Configuration settings for the backend application
+"""
+import os
+
+class Config:
+    """Application configuration"""
+
+    # Search Configuration
+    SEARCH_DEFAULT_LIMIT = int(os.getenv("SEARCH_DEFAULT_LIMIT", "50"))
+    SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "500"))
+
+    # Upload Configuration
+    UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "./uploads")
+    MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(10 * 1024 * 1024)))  # 10MB
+    UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))  # 1MB
+    # "unique": one file per upload; "content": deduplicated, reference-counted files named by SHA-256
+    RECEIPT_STORAGE = os.getenv("RECEIPT_STORAGE", "unique").lower()
+
+    # Receipt storage backend: "local" (UPLOAD_FOLDER) or "s3" (any S3-compatible service)
+    RECEIPT_BACKEND = os.getenv("RECEIPT_BACKEND", "local").lower()
+    # Levels of hashed subdirectories receipts are fanned out into, e.g. uploads/ab/cd/<name>
+    RECEIPT_SHARD_DEPTH = int(os.getenv("RECEIPT_SHARD_DEPTH", "2"))
+    S3_BUCKET = os.getenv("S3_BUCKET", "receipts")
+    S3_PREFIX = os.getenv("S3_PREFIX", "")
+    S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.getenv("S3_REGION") or None
+    # Lifetime in seconds of the presigned URLs receipt downloads redirect to
+    S3_URL_EXPIRY = int(os.getenv("S3_URL_EXPIRY", "300"))
+
+    # Read-through cache of single-purchase lookups: "memory" (per worker), "redis" (shared) or "off"
+    PURCHASE_CACHE = os.getenv("PURCHASE_CACHE", "memory").lower()
+    PURCHASE_CACHE_SIZE = int(os.getenv("PURCHASE_CACHE_SIZE", "10000"))
+    PURCHASE_CACHE_TTL = float(os.getenv("PURCHASE_CACHE_TTL", "60"))  # seconds
+    # Cache of serialized /search pages, invalidated wholesale by every write: "memory", "redis" or "off"
+    SEARCH_CACHE = os.getenv("SEARCH_CACHE", "memory").lower()
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "30"))  # seconds
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+    # Change feed: most changes per /changes page, and how often /changes/stream polls for new ones
+    CHANGES_MAX_LIMIT = int(os.getenv("CHANGES_MAX_LIMIT", "1000"))
+    CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))  # seconds
+    # Seconds between keep-alive comments on an idle stream, so proxies keep it open
+    CHANGES_KEEPALIVE = float(os.getenv("CHANGES_KEEPALIVE", "15"))
+    # Days deletes stay in the change feed before prune-tombstones may drop them
+    TOMBSTONE_RETENTION_DAYS = float(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+    # Database Configuration
+    # Serve requests through SQLAlchemy asyncio (asyncpg) instead of the sync engine
+    ASYNC_DB = os.getenv("ASYNC_DB", "false").lower() in ("1", "true", "yes")
+
+    # Connection pool (SQLAlchemy QueuePool) settings, applied to the sync and async engines
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+
+# Global config instance
+config = Config()
@@ -1,20 +1,142 @@
-from fastapi import Depends, UploadFile, File, Form, HTTPException
+from fastapi import BackgroundTasks, Depends, UploadFile, File, Form, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
-from database import get_db
-from repository import PurchaseRepository
-from service import PurchaseService
-from model import PurchaseCreate, PurchaseResponse
-from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, SessionLocal, get_async_db, get_db, pool_diagnostics
+from cache import cache_diagnostics
+from repository import AsyncPurchaseRepository, PurchaseRepository
+from service import AsyncPurchaseService, PurchaseService, ReceiptError, ReceiptTooLargeError
+from config import config
+from model import (
+    PurchaseCreate, PurchaseSearchParams, PurchaseStats, CfSearchMode, ExportFormat, RollupDimension
+)
+from serialization import dumps_json, negotiate_response, ORJSONResponse
+from typing import Any, AsyncIterator, Callable, Dict, List, Mapping, Optional
+from decimal import Decimal
+from email.utils import parsedate_to_datetime
+import asyncio
+import datetime
+import inspect
+import time
+import zipfile
+
+async def _run(method: Callable, *args, **kwargs) -> Any:
+    """Await async service methods; run sync ones in the threadpool, off the event loop"""
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+    return await run_in_threadpool(method, *args, **kwargs)
+
+def _not_modified(request: Request, headers: Mapping[str, str]) -> bool:
+    """Whether the client's cached copy is current, by If-None-Match or else If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as required for If-None-Match
+        etag = headers.get("etag", "").removeprefix("W/")
+        return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(","))
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "last-modified" in headers:
+        try:
+            return parsedate_to_datetime(headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _not_modified_response(headers: Mapping[str, str]) -> Response:
+    """Empty 304 response repeating the validators and caching headers"""
+    return Response(status_code=304, headers={
+        name: headers[name] for name in ("etag", "last-modified", "cache-control") if name in headers
+    })
+
+async def _poll_changes(since: Optional[int]) -> Dict[str, Any]:
+    """One change feed page, read on a session held only for the poll so idle streams keep no pooled connection"""
+    if config.ASYNC_DB:
+        async with AsyncSessionLocal() as db:
+            return await AsyncPurchaseService(AsyncPurchaseRepository(db)).get_changes(since)
+    
+    def poll() -> Dict[str, Any]:
+        with SessionLocal() as db:
+            return PurchaseService(PurchaseRepository(db)).get_changes(since)
+    
+    return await run_in_threadpool(poll)
+
+def _event(seq: int, event: str, data: Any) -> bytes:
+    """One server-sent event; its id is the change number a reconnecting client resumes after"""
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (seq, event.encode(), dumps_json(data))
+
+async def _change_events(request: Request, since: Optional[int]) -> AsyncIterator[bytes]:
+    """Server-sent events for every change after `since`, polling the feed until the client disconnects"""
+    last_sent = time.monotonic()
+    while not await request.is_disconnected():
+        feed = await _poll_changes(since)
+        if feed["reset"]:
+            yield _event(feed["next"], "reset", {"next": feed["next"]})
+        for change in feed["changes"]:
+            yield _event(change["seq"], change["op"], change)
+        if feed["reset"] or feed["changes"]:
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= config.CHANGES_KEEPALIVE:
+            # A comment line, ignored by clients, so proxies do not close an idle stream
+            yield b": keepalive\n\n"
+            last_sent = time.monotonic()
+        since = feed["next"]
+        if not feed["more"]:
+            await asyncio.sleep(config.CHANGES_POLL_INTERVAL)
 
 class PurchaseController:
     """Controller class for handling purchase HTTP requests"""
     
     @staticmethod
-    def get_service(db: Session = Depends(get_db)) -> PurchaseService:
+    def get_sync_service(db: Session = Depends(get_db)) -> PurchaseService:
         """Dependency to get purchase service"""
         repository = PurchaseRepository(db)
         return PurchaseService(repository)
     
+    @staticmethod
+    def get_async_service(db: AsyncSession = Depends(get_async_db)) -> AsyncPurchaseService:
+        """Dependency to get the async purchase service"""
+        repository = AsyncPurchaseRepository(db)
+        return AsyncPurchaseService(repository)
+    
+    get_service = get_async_service if config.ASYNC_DB else get_sync_service
+    
+    @staticmethod
+    def get_search_params(
+        name: Optional[str] = None,
+        surname: Optional[str] = None,
+        cf: Optional[str] = None,
+        cf_mode: CfSearchMode = CfSearchMode.AUTO,
+        cc: Optional[str] = None,
+        product: Optional[str] = None,
+        date: Optional[datetime.date] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None,
+        price_min: Optional[Decimal] = None,
+        price_max: Optional[Decimal] = None
+    ) -> PurchaseSearchParams:
+        """Dependency to collect search filters from query parameters"""
+        try:
+            return PurchaseSearchParams(
+                name=name,
+                surname=surname,
+                cf=cf,
+                cf_mode=cf_mode,
+                cc=cc,
+                product=product,
+                date=date,
+                date_from=date_from,
+                date_to=date_to,
+                price_min=price_min,
+                price_max=price_max
+            )
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=400,
+                detail="; ".join(error["msg"].removeprefix("Value error, ") for error in e.errors())
+            )
+    
     @staticmethod
     async def upload_purchase(
         customer_name: str = Form(...),
@@ -22,8 +144,8 @@ class PurchaseController:
         customer_cf: str = Form(...),
         credit_card: str = Form(...),
         product_name: str = Form(...),
-        price: float = Form(...),
-        date: str = Form(...),
+        price: Decimal = Form(..., description="Rounded half up to cents"),
+        date: datetime.date = Form(...),
         receipt: UploadFile = File(...),
         service: PurchaseService = Depends(get_service)
     ) -> dict:
@@ -39,45 +161,213 @@ class PurchaseController:
                 date=date
             )
             
-            return service.upload_purchase(purchase_data, receipt)
+            return await _run(service.upload_purchase, purchase_data, receipt)
+        except ValidationError as e:
+            # Form fields are checked by PurchaseCreate, so report its errors like FastAPI's own
+            raise RequestValidationError(
+                [dict(error, loc=("body", *error["loc"])) for error in e.errors(include_url=False)]
+            )
+        except ReceiptTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except ReceiptError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to upload purchase: {str(e)}")
     
     @staticmethod
-    def search_purchases(
-        cf: Optional[str] = None,
+    async def bulk_upload_purchases(
+        manifest: UploadFile = File(..., description="NDJSON or CSV rows, each naming its receipt"),
+        receipts: Optional[UploadFile] = File(None, description="ZIP archive of receipt PDFs"),
         service: PurchaseService = Depends(get_service)
-    ) -> List[PurchaseResponse]:
+    ) -> dict:
+        """Handle bulk purchase upload endpoint"""
+        try:
+            return await _run(service.bulk_upload_purchases, manifest, receipts)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="Receipts must be a ZIP archive")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="Manifest must be UTF-8 encoded")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to bulk upload purchases: {str(e)}")
+    
+    @staticmethod
+    async def search_purchases(
+        request: Request,
+        params: PurchaseSearchParams = Depends(get_search_params),
+        cursor: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1),
+        stream: bool = False,
+        fields: Optional[str] = Query(None, description="Comma-separated columns to return"),
+        service: PurchaseService = Depends(get_service)
+    ) -> Response:
         """Handle purchase search endpoint"""
         try:
-            return service.search_purchases(cf)
+            # NDJSON mode streams every match instead of a single page
+            if stream or "application/x-ndjson" in request.headers.get("accept", ""):
+                return StreamingResponse(
+                    await _run(service.stream_purchases, params, fields=fields),
+                    media_type="application/x-ndjson"
+                )
+            response_class = negotiate_response(request)
+            etag = await _run(
+                service.search_etag, params,
+                cursor=cursor, limit=limit, fields=fields, response_class=response_class
+            )
+            headers = {"etag": etag, "cache-control": "private, no-cache"}
+            # Only the table version has been read so far
+            if _not_modified(request, headers):
+                return _not_modified_response(headers)
+            body = await _run(
+                service.render_search_page, params,
+                cursor=cursor, limit=limit, fields=fields, response_class=response_class, etag=etag
+            )
+            return Response(body, media_type=response_class.media_type, headers=headers)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to search purchases: {str(e)}")
     
     @staticmethod
-    def get_purchase(
+    async def get_stats(
+        params: PurchaseSearchParams = Depends(get_search_params),
+        service: PurchaseService = Depends(get_service)
+    ) -> PurchaseStats:
+        """Handle purchase statistics endpoint"""
+        try:
+            return await _run(service.get_stats, params)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to compute statistics: {str(e)}")
+    
+    @staticmethod
+    async def get_daily_stats(
+        dimension: RollupDimension = RollupDimension.PRODUCT,
+        group: bool = Query(False, description="Return one series per product/customer"),
+        key: Optional[str] = Query(None, description="Restrict to one product name or customer CF"),
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None,
+        service: PurchaseService = Depends(get_service)
+    ) -> Response:
+        """Handle daily time-series endpoint backed by the rollup tables"""
+        try:
+            return ORJSONResponse(await _run(
+                service.get_daily_series,
+                dimension, group=group, key=key, date_from=date_from, date_to=date_to
+            ))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to get daily statistics: {str(e)}")
+    
+    @staticmethod
+    async def export_purchases(
+        params: PurchaseSearchParams = Depends(get_search_params),
+        format: ExportFormat = ExportFormat.CSV,
+        fields: Optional[str] = Query(None, description="Comma-separated columns to export"),
+        service: PurchaseService = Depends(get_service)
+    ) -> StreamingResponse:
+        """Handle purchase export endpoint"""
+        try:
+            media_types = {
+                ExportFormat.CSV: "text/csv",
+                ExportFormat.PARQUET: "application/vnd.apache.parquet",
+            }
+            return StreamingResponse(
+                await _run(service.export_purchases, params, format, fields=fields),
+                media_type=media_types[format],
+                headers={
+                    "Content-Disposition": f'attachment; filename="purchases_export.{format.value}"'
+                }
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to export purchases: {str(e)}")
+    
+    @staticmethod
+    async def export_receipts(
+        params: PurchaseSearchParams = Depends(get_search_params),
+        service: PurchaseService = Depends(get_service)
+    ) -> StreamingResponse:
+        """Handle receipt ZIP export endpoint"""
+        try:
+            return StreamingResponse(
+                await _run(service.export_receipts, params),
+                media_type="application/zip",
+                headers={"Content-Disposition": 'attachment; filename="receipts.zip"'}
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to export receipts: {str(e)}")
+    
+    @staticmethod
+    async def get_purchase(
         purchase_id: int,
+        request: Request,
+        fields: Optional[str] = Query(None, description="Comma-separated columns to return"),
         service: PurchaseService = Depends(get_service)
-    ) -> PurchaseResponse:
+    ) -> Response:
         """Handle get single purchase endpoint"""
         try:
-            purchase = service.get_purchase_by_id(purchase_id)
-            if not purchase:
+            found = await _run(service.get_versioned_purchase, purchase_id, fields=fields)
+            if not found:
                 raise HTTPException(status_code=404, detail="Purchase not found")
-            return purchase
+            purchase, version = found
+            response_class = negotiate_response(request)
+            headers = {
+                "etag": service.purchase_etag(purchase_id, version, purchase.keys(), response_class),
+                "cache-control": "private, no-cache",
+            }
+            # Answered before serializing; a purchase cache hit skips the query too
+            if _not_modified(request, headers):
+                return _not_modified_response(headers)
+            return response_class(purchase, headers=headers)
         except HTTPException:
             raise
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to get purchase: {str(e)}")
     
     @staticmethod
-    def delete_purchase(
+    async def get_receipt(
+        purchase_id: int,
+        request: Request,
+        service: PurchaseService = Depends(get_service)
+    ) -> Response:
+        """Handle receipt download endpoint"""
+        try:
+            receipt = await _run(service.get_receipt, purchase_id)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to get receipt: {str(e)}")
+        if not receipt:
+            raise HTTPException(status_code=404, detail="Receipt not found")
+        if receipt.url:
+            # Remote backends serve the file, ranges and validators themselves
+            return RedirectResponse(receipt.url, status_code=307)
+        
+        # Content-addressed receipts have a strong ETag for free; otherwise
+        # FileResponse derives one from the file's mtime and size
+        headers = {"cache-control": "private, no-cache"}
+        if receipt.sha256:
+            headers["etag"] = f'"{receipt.sha256}"'
+        # FileResponse answers Range requests and uses zero-copy pathsend where the server offers it
+        response = FileResponse(
+            receipt.location,
+            stat_result=receipt.stat,
+            media_type="application/pdf",
+            filename=f"receipt-{purchase_id}.pdf",
+            content_disposition_type="inline",
+            headers=headers
+        )
+        if _not_modified(request, response.headers):
+            return _not_modified_response(response.headers)
+        return response
+    
+    @staticmethod
+    async def delete_purchase(
         purchase_id: int,
         service: PurchaseService = Depends(get_service)
     ) -> dict:
         """Handle delete purchase endpoint"""
         try:
-            success = service.delete_purchase(purchase_id)
+            success = await _run(service.delete_purchase, purchase_id)
             if not success:
                 raise HTTPException(status_code=404, detail="Purchase not found")
             return {"message": "Purchase deleted successfully"}
@@ -85,3 +375,64 @@ class PurchaseController:
             raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to delete purchase: {str(e)}")
+    
+    @staticmethod
+    async def delete_purchases(
+        background_tasks: BackgroundTasks,
+        params: PurchaseSearchParams = Depends(get_search_params),
+        ids: Optional[List[int]] = Query(None, description="Purchase ids to delete (combined with any filters)"),
+        service: PurchaseService = Depends(get_service)
+    ) -> dict:
+        """Handle bulk delete endpoint"""
+        try:
+            deleted, files, blobs = await _run(service.delete_purchases, ids=ids, params=params)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to delete purchases: {str(e)}")
+        # Rows are committed; unlink their files after the response is sent
+        background_tasks.add_task(service.remove_receipts, files, blobs)
+        return {"message": f"Deleted {deleted} purchases.", "deleted": deleted}
+
+    @staticmethod
+    async def get_changes(
+        request: Request,
+        since: Optional[int] = Query(None, ge=0, description="Change number to read changes after"),
+        limit: Optional[int] = Query(None, ge=1),
+        service: PurchaseService = Depends(get_service)
+    ) -> Response:
+        """Handle change feed endpoint"""
+        try:
+            feed = await _run(service.get_changes, since, limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to read changes: {str(e)}")
+        return negotiate_response(request)(feed)
+    
+    @staticmethod
+    async def stream_changes(
+        request: Request,
+        since: Optional[int] = Query(None, ge=0, description="Change number to stream changes after")
+    ) -> StreamingResponse:
+        """Handle change stream endpoint"""
+        # Browsers reconnect with the id of the last event they received
+        last_event_id = request.headers.get("last-event-id", "")
+        if last_event_id.isdigit():
+            since = int(last_event_id)
+        return StreamingResponse(
+            _change_events(request, since),
+            media_type="text/event-stream",
+            headers={"cache-control": "no-cache", "x-accel-buffering": "no"}
+        )
+
+class DiagnosticsController:
+    """Controller class for operational diagnostics"""
+    
+    @staticmethod
+    def get_pool_stats() -> dict:
+        """Handle connection pool diagnostics endpoint"""
+        return pool_diagnostics()
+    
+    @staticmethod
+    def get_cache_stats() -> dict:
+        """Handle purchase cache diagnostics endpoint"""
+        return cache_diagnostics()
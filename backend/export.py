@@ -0,0 +1,205 @@
+"""
+Streaming CSV, Parquet and receipt ZIP writers for purchase exports
+"""
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from contextlib import closing
+from itertools import islice
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Callable, Iterable, Iterator, List, Sequence
+import csv
+import datetime
+import io
+import tempfile
+import time
+import zipfile
+
+# Human-readable column headers, matching the frontend's former CSV export
+EXPORT_HEADERS = {
+    "id": "ID",
+    "customer_name": "Customer Name",
+    "customer_surname": "Customer Surname",
+    "customer_cf": "Codice Fiscale",
+    "credit_card": "Credit Card",
+    "product_name": "Product",
+    "price": "Price",
+    "date": "Date",
+    "receipt_path": "Receipt Path",
+    "receipt_sha256": "Receipt SHA-256",
+}
+
+# ZIP timestamps can only hold years 1980 to 2107
+ZIP_DATE_RANGE = (datetime.date(1980, 1, 1), datetime.date(2107, 12, 31))
+
+def _batches(rows: Iterable, size: int) -> Iterator[List]:
+    """Group an iterable into lists of at most `size` items"""
+    iterator = iter(rows)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+class CsvEncoder:
+    """Incremental CSV encoder returning one chunk per batch of rows"""
+
+    def __init__(self, fields: Sequence[str], batch_size: int = 1000):
+        self.batch_size = batch_size
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow([EXPORT_HEADERS[field] for field in fields])
+
+    def encode(self, batch: List) -> bytes:
+        self._writer.writerows(batch)
+        return self._drain()
+
+    def finish(self) -> bytes:
+        return self._drain()
+
+    def _drain(self) -> bytes:
+        data = self._buffer.getvalue().encode()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to the caller"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class ParquetEncoder:
+    """Incremental Parquet encoder writing one row group per batch of rows"""
+
+    def __init__(self, fields: Sequence[str], row_group_size: int = 50000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {"id": pa.int64(), "price": pa.decimal128(10, 2), "date": pa.date32()}
+        self.batch_size = row_group_size
+        self._pa = pa
+        self._schema = pa.schema([(field, types.get(field, pa.string())) for field in fields])
+        self._sink = _ChunkSink()
+        self._writer = pq.ParquetWriter(self._sink, self._schema)
+
+    def encode(self, batch: List) -> bytes:
+        columns = list(zip(*batch))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(column, type=self._schema.field(i).type) for i, column in enumerate(columns)],
+            schema=self._schema
+        ))
+        return self._sink.drain()
+
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+def iter_encoded(encoder, rows: Iterable) -> Iterator[bytes]:
+    """Encode rows batch by batch, yielding each non-empty chunk"""
+    for batch in _batches(rows, encoder.batch_size):
+        if chunk := encoder.encode(batch):
+            yield chunk
+    if chunk := encoder.finish():
+        yield chunk
+
+async def aiter_encoded(encoder, batches: AsyncIterable[List]) -> AsyncIterator[bytes]:
+    """Encode batches from an async source, keeping the encoding off the event loop"""
+    async for batch in batches:
+        if chunk := await run_in_threadpool(encoder.encode, batch):
+            yield chunk
+    if chunk := await run_in_threadpool(encoder.finish):
+        yield chunk
+
+class ReceiptZipWriter:
+    """Incremental ZIP writer storing each purchase's receipt as receipts/<id>.pdf, then manifest.csv"""
+
+    def __init__(
+        self,
+        fields: Sequence[str],
+        open_receipt: Callable[[str], BinaryIO],
+        batch_size: int = 100,
+        chunk_size: int = 1024 * 1024
+    ):
+        self.batch_size = batch_size
+        self._open_receipt = open_receipt
+        self._chunk_size = chunk_size
+        self._sink = _ChunkSink()
+        # On an unseekable sink zipfile writes each entry's sizes after its data,
+        # so nothing has to be buffered or rewritten
+        self._zip = zipfile.ZipFile(self._sink, "w")
+        # Manifest rows wait aside, spilling to disk when large, until the receipts are written
+        self._manifest = tempfile.SpooledTemporaryFile(
+            max_size=chunk_size, mode="w+", encoding="utf-8", newline=""
+        )
+        self._manifest_writer = csv.writer(self._manifest)
+        self._manifest_writer.writerow(
+            [EXPORT_HEADERS[field] for field in fields] + ["Receipt File", "Receipt Status"]
+        )
+
+    def write(self, rows: Iterable) -> Iterator[bytes]:
+        """Add each row's receipt, yielding the archive bytes as they are produced"""
+        for row in rows:
+            name, status = "", "none"
+            if row.receipt_path:
+                try:
+                    source = self._open_receipt(row.receipt_path)
+                except FileNotFoundError:
+                    status = "missing"
+                else:
+                    name, status = f"receipts/{row.id}.pdf", "ok"
+                    # PDFs are already compressed, so receipts are stored as they are
+                    with closing(source), self._zip.open(self._entry(name, row.date), "w") as target:
+                        while chunk := source.read(self._chunk_size):
+                            target.write(chunk)
+                            if data := self._sink.drain():
+                                yield data
+            self._manifest_writer.writerow([*row, name, status])
+            if data := self._sink.drain():
+                yield data
+
+    def finish(self) -> Iterator[bytes]:
+        """Add the manifest and the central directory"""
+        self._manifest.seek(0)
+        entry = self._entry("manifest.csv", None, zipfile.ZIP_DEFLATED)
+        with self._manifest, self._zip.open(entry, "w") as target:
+            while text := self._manifest.read(self._chunk_size):
+                target.write(text.encode())
+                if data := self._sink.drain():
+                    yield data
+        self._zip.close()
+        yield self._sink.drain()
+
+    @staticmethod
+    def _entry(name: str, date, compress_type: int = zipfile.ZIP_STORED) -> zipfile.ZipInfo:
+        """Archive entry dated with the purchase date, or now; dates ZIP cannot hold are clamped"""
+        if date:
+            date = min(max(date, ZIP_DATE_RANGE[0]), ZIP_DATE_RANGE[1])
+        date_time = (date.year, date.month, date.day, 0, 0, 0) if date else time.localtime()[:6]
+        entry = zipfile.ZipInfo(name, date_time=date_time)
+        entry.compress_type = compress_type
+        return entry
+
+def iter_archive(writer: ReceiptZipWriter, rows: Iterable) -> Iterator[bytes]:
+    """Stream a receipt ZIP of all rows"""
+    yield from writer.write(rows)
+    yield from writer.finish()
+
+async def aiter_archive(writer: ReceiptZipWriter, batches: AsyncIterable[List]) -> AsyncIterator[bytes]:
+    """Stream a receipt ZIP of batches from an async source, keeping file reads off the event loop"""
+    async for batch in batches:
+        async for chunk in iterate_in_threadpool(writer.write(batch)):
+            yield chunk
+    async for chunk in iterate_in_threadpool(writer.finish()):
+        yield chunk
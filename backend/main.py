@@ -1,7 +1,13 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from config import config
 from database import create_tables
-from controller import PurchaseController
+from controller import DiagnosticsController, PurchaseController
+from model import PurchasePage, PurchaseResponse, PurchaseStats, DailyRollup
+from typing import List
 
 app = FastAPI(title="Purchase Management API", version="1.0.0")
 
@@ -13,14 +19,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Room for the form fields and multipart framing around a single receipt
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+class UploadSizeLimitMiddleware:
+    """Cap the body of single receipt uploads before the multipart parser spools it to disk; a
+    declared Content-Length over the limit is refused unread, and bodies without one (chunked
+    uploads) are cut off once they pass it. Other routes, such as streamed exports and the change
+    stream, pass straight through."""
+    
+    def __init__(self, app: ASGIApp, path: str, limit: int):
+        self.app = app
+        self.path = path
+        self.limit = limit
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        too_large = HTTPException(status_code=413, detail=f"Receipt exceeds the {config.MAX_FILE_SIZE} byte limit")
+        length = Headers(scope=scope).get("content-length", "")
+        if length.isdigit() and int(length) > self.limit:
+            await JSONResponse(status_code=413, content={"detail": too_large.detail})(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    # Raised inside the form parsing, so the route answers it like any HTTPException
+                    raise too_large
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware, path="/upload/", limit=config.MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD)
+
 # Create database tables on startup
 create_tables()
 
 # Purchase routes
 app.post("/upload/")(PurchaseController.upload_purchase)
-app.get("/search", response_model=list)(PurchaseController.search_purchases)
-app.get("/purchase/{purchase_id}")(PurchaseController.get_purchase)
+app.post("/upload/bulk")(PurchaseController.bulk_upload_purchases)
+app.get("/search", response_model=PurchasePage)(PurchaseController.search_purchases)
+app.get("/stats", response_model=PurchaseStats)(PurchaseController.get_stats)
+app.get("/stats/daily", response_model=List[DailyRollup])(PurchaseController.get_daily_stats)
+app.get("/export")(PurchaseController.export_purchases)
+app.get("/export/receipts")(PurchaseController.export_receipts)
+app.get("/purchase/{purchase_id}", response_model=PurchaseResponse)(PurchaseController.get_purchase)
+app.api_route("/purchase/{purchase_id}/receipt", methods=["GET", "HEAD"])(PurchaseController.get_receipt)
 app.delete("/purchase/{purchase_id}")(PurchaseController.delete_purchase)
+app.delete("/purchases")(PurchaseController.delete_purchases)
+app.get("/changes")(PurchaseController.get_changes)
+app.get("/changes/stream")(PurchaseController.stream_changes)
+
+# Diagnostics routes
+app.get("/diagnostics/pool")(DiagnosticsController.get_pool_stats)
+app.get("/diagnostics/cache")(DiagnosticsController.get_cache_stats)
 
 if __name__ == "__main__":
     import uvicorn
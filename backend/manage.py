@@ -0,0 +1,106 @@
+"""
+Maintenance commands for the purchase backend.
+
+Usage:
+
+    python manage.py rebuild-rollups
+    python manage.py migrate-receipts [--workers 8] [--batch-size 500] [--api-stopped]
+    python manage.py reconcile-receipts [--fix] [--limit 100000] [--grace-minutes 60] [--restart]
+    python manage.py prune-tombstones [--days 30]
+"""
+import argparse
+from config import config
+from database import SessionLocal, create_tables
+from repository import PurchaseRepository
+from service import PurchaseService
+
+def rebuild_rollups(args: argparse.Namespace):
+    """Recompute the daily rollup tables from purchases, e.g. after a back-fill"""
+    with SessionLocal() as db:
+        PurchaseRepository(db).rebuild_rollups()
+    print("Rollup tables rebuilt.")
+
+def migrate_receipts(args: argparse.Namespace):
+    """Move receipts stored flat in the upload folder into the configured storage layout"""
+    if config.PURCHASE_CACHE == "memory" and not args.api_stopped:
+        # Clearing the cache only reaches the API workers when they share it through Redis
+        raise SystemExit(
+            "API workers cache purchases in their own memory (PURCHASE_CACHE=memory), which this command "
+            "cannot clear; run it with PURCHASE_CACHE=redis, or stop the API and pass --api-stopped."
+        )
+    with SessionLocal() as db:
+        moved = PurchaseService(PurchaseRepository(db)).migrate_receipts(
+            workers=args.workers, batch_size=args.batch_size
+        )
+    print(f"Moved {moved} receipts.")
+
+def reconcile_receipts(args: argparse.Namespace):
+    """Report (and with --fix, clean up) orphaned receipt files, dangling rows and miscounted blobs"""
+    with SessionLocal() as db:
+        service = PurchaseService(PurchaseRepository(db))
+        if args.restart:
+            service.reset_reconciliation()
+        report = service.reconcile_receipts(
+            fix=args.fix, limit=args.limit, grace=args.grace_minutes * 60, workers=args.workers
+        )
+    
+    files, purchases, blobs = report["files"], report["purchases"], report["blobs"]
+    for location in files["orphaned"]:
+        print(f"{'removed' if args.fix else 'orphaned'} file: {location}")
+    for purchase_id in purchases["dangling"]:
+        print(f"missing receipt: purchase {purchase_id}")
+    for blob in blobs["miscounted"]:
+        print(f"{'recounted' if args.fix else 'miscounted'} blob: {blob['sha256']} "
+              f"ref_count={blob['ref_count']} references={blob['references']}")
+    for name, result in report.items():
+        status = "pass complete" if result["complete"] else "continues next run"
+        print(f"{name}: {result['scanned']} checked, {status}")
+
+def prune_tombstones(args: argparse.Namespace):
+    """Drop old deletes from the change feed; clients that have not synced since must reload"""
+    with SessionLocal() as db:
+        pruned = PurchaseService(PurchaseRepository(db)).prune_tombstones(args.days)
+    print(f"Pruned {pruned} tombstones.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Purchase backend maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser(
+        "rebuild-rollups", help="Recompute daily product/customer rollups"
+    ).set_defaults(handler=rebuild_rollups)
+
+    migrate = commands.add_parser(
+        "migrate-receipts", help="Move flat upload-folder receipts into the sharded or S3 layout"
+    )
+    migrate.add_argument("--workers", type=int, default=8, help="Files moved in parallel")
+    migrate.add_argument("--batch-size", type=int, default=500, help="Receipts repointed per transaction")
+    migrate.add_argument("--api-stopped", action="store_true",
+                         help="The API is not running, so no worker holds an in-memory purchase cache")
+    migrate.set_defaults(handler=migrate_receipts)
+
+    reconcile = commands.add_parser(
+        "reconcile-receipts", help="Find orphaned receipt files, purchases missing receipts and miscounted blobs"
+    )
+    reconcile.add_argument("--fix", action="store_true", help="Remove orphaned files and correct blob ref counts")
+    reconcile.add_argument("--limit", type=int, default=100000,
+                           help="Files, purchases and blobs checked per run; later runs resume")
+    reconcile.add_argument("--grace-minutes", type=float, default=60,
+                           help="Ignore files younger than this, which may be uploads in flight")
+    reconcile.add_argument("--workers", type=int, default=8, help="Parallel file existence checks")
+    reconcile.add_argument("--restart", action="store_true", help="Start a new pass from the beginning")
+    reconcile.set_defaults(handler=reconcile_receipts)
+
+    prune = commands.add_parser(
+        "prune-tombstones", help="Drop deleted-purchase records older than the retention from the change feed"
+    )
+    prune.add_argument("--days", type=float, default=config.TOMBSTONE_RETENTION_DAYS,
+                       help="Keep deletes younger than this many days")
+    prune.set_defaults(handler=prune_tombstones)
+
+    args = parser.parse_args()
+    create_tables()
+    args.handler(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
-from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy import BigInteger, Column, Integer, String, Numeric, Date, DateTime, Index, func
 from sqlalchemy.ext.declarative import declarative_base
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import AfterValidator, BaseModel, BeforeValidator, model_validator
+from typing import Annotated, List, Optional
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from enum import Enum
+import datetime
 
 Base = declarative_base()
 
@@ -15,9 +18,112 @@ class PurchaseDB(Base):
     customer_cf = Column(String, index=True)
     credit_card = Column(String)
     product_name = Column(String)
-    price = Column(Float)
-    date = Column(String)
+    # Exact cents, so SQL sums reconcile to the cent
+    price = Column(Numeric(10, 2))
+    date = Column(Date)
     receipt_path = Column(String)
+    receipt_sha256 = Column(String(64))
+    # Change sequence number of the row's last write (see TableVersionDB); 0 for rows older than versioning
+    version = Column(BigInteger, nullable=False, default=0, server_default="0", index=True)
+
+    __table_args__ = (
+        # Serves date equality/range filters and the (date, id) keyset
+        # ordering used by search pagination
+        Index("ix_purchases_date_id", "date", "id"),
+        # Case-insensitive exact CF lookups; substring/prefix lookups use the
+        # pg_trgm index created in database.create_tables
+        Index("ix_purchases_customer_cf_upper", func.upper(customer_cf)),
+        # Case-insensitive exact and prefix matches on name/surname/product
+        Index(
+            "ix_purchases_surname_name_lower",
+            func.lower(customer_surname).label("surname_lower"),
+            func.lower(customer_name).label("name_lower"),
+            postgresql_ops={"surname_lower": "text_pattern_ops", "name_lower": "text_pattern_ops"},
+        ),
+        Index(
+            "ix_purchases_product_name_lower",
+            func.lower(product_name).label("product_lower"),
+            postgresql_ops={"product_lower": "text_pattern_ops"},
+        ),
+        Index("ix_purchases_credit_card", "credit_card"),
+        # Serves price_min/price_max range filters
+        Index("ix_purchases_price", "price"),
+        # Receipt lookups by location (reconciliation, relocation)
+        Index("ix_purchases_receipt_path", "receipt_path"),
+    )
+
+class DailyProductRollupDB(Base):
+    """Per-day, per-product purchase totals maintained alongside purchases"""
+    __tablename__ = "purchase_daily_product"
+    
+    date = Column(Date, primary_key=True)
+    product_name = Column(String, primary_key=True)
+    purchase_count = Column(Integer, nullable=False, default=0)
+    total_amount = Column(Numeric(14, 2), nullable=False, default=0)
+
+class DailyCustomerRollupDB(Base):
+    """Per-day, per-customer purchase totals maintained alongside purchases"""
+    __tablename__ = "purchase_daily_customer"
+    
+    date = Column(Date, primary_key=True)
+    customer_cf = Column(String, primary_key=True)
+    purchase_count = Column(Integer, nullable=False, default=0)
+    total_amount = Column(Numeric(14, 2), nullable=False, default=0)
+
+class ReceiptBlobDB(Base):
+    """Content-addressed receipt file shared by every purchase with the same receipt"""
+    __tablename__ = "receipt_blobs"
+    
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String, nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+
+class MaintenanceCheckpointDB(Base):
+    """Where an incremental maintenance job (e.g. receipt reconciliation) stopped"""
+    __tablename__ = "maintenance_checkpoints"
+    
+    name = Column(String(64), primary_key=True)
+    position = Column(String)
+    updated_at = Column(DateTime, nullable=False, default=func.now(), onupdate=func.now())
+
+class TableVersionDB(Base):
+    """Change counter of a table, advanced by one per row in the same transaction as every write to it"""
+    __tablename__ = "table_versions"
+    
+    name = Column(String(64), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+class PurchaseTombstoneDB(Base):
+    """A deleted purchase, kept so change feed clients can drop their copy"""
+    __tablename__ = "purchase_tombstones"
+    
+    # Id of the deleted purchase
+    id = Column(Integer, primary_key=True)
+    # Change sequence number of the delete
+    version = Column(BigInteger, nullable=False, index=True)
+    deleted_at = Column(DateTime, nullable=False, default=func.now())
+
+CENTS = Decimal("0.01")
+# Integer digits left in the purchases.price Numeric(10, 2) column
+PRICE_INTEGER_DIGITS = 8
+
+def _round_price(value):
+    """Round a price to cents half up, so float input like 12.340000000000002 is accepted"""
+    try:
+        return Decimal(str(value)).quantize(CENTS, rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError, TypeError):
+        # Left for the Decimal validation to reject with its own message
+        return value
+
+def _check_price_digits(value: Decimal) -> Decimal:
+    """Reject prices too large for the price column"""
+    if value.is_finite() and value.adjusted() >= PRICE_INTEGER_DIGITS:
+        raise ValueError(f"Price must have at most {PRICE_INTEGER_DIGITS} digits before the decimal point")
+    return value
+
+# A price rounded to cents; only values overflowing Numeric(10, 2) are rejected
+Price = Annotated[Decimal, BeforeValidator(_round_price), AfterValidator(_check_price_digits)]
 
 class PurchaseCreate(BaseModel):
     """Pydantic model for creating a purchase"""
@@ -26,8 +132,8 @@ class PurchaseCreate(BaseModel):
     customer_cf: str
     credit_card: str
     product_name: str
-    price: float
-    date: str
+    price: Price
+    date: datetime.date
 
 class PurchaseResponse(BaseModel):
     """Pydantic model for purchase response"""
@@ -38,12 +144,72 @@ class PurchaseResponse(BaseModel):
     credit_card: str
     product_name: str
     price: float
-    date: str
+    date: datetime.date
     receipt_path: str
+    receipt_sha256: Optional[str] = None
 
     class Config:
         from_attributes = True
 
+# Column order of serialized purchases, shared by the Row-based fast path
+PURCHASE_FIELDS = tuple(PurchaseResponse.model_fields)
+
+class CfSearchMode(str, Enum):
+    """How the codice fiscale search term is matched"""
+    AUTO = "auto"
+    EXACT = "exact"
+    PREFIX = "prefix"
+    CONTAINS = "contains"
+
+class ExportFormat(str, Enum):
+    """File formats supported by the export endpoint"""
+    CSV = "csv"
+    PARQUET = "parquet"
+
+class RollupDimension(str, Enum):
+    """Dimensions available in the daily rollup tables"""
+    PRODUCT = "product"
+    CUSTOMER = "customer"
+
+class PurchasePage(BaseModel):
+    """Pydantic model for a page of search results"""
+    items: List[PurchaseResponse]
+    next_cursor: Optional[str] = None
+
+class PurchaseStats(BaseModel):
+    """Pydantic model for aggregate purchase statistics"""
+    total_purchases: int
+    total_amount: float
+    average_amount: float
+    unique_customers: int
+    today_purchases: int
+
+class DailyRollup(BaseModel):
+    """Pydantic model for one point of a daily time series"""
+    date: datetime.date
+    key: Optional[str] = None
+    purchase_count: int
+    total_amount: float
+
 class PurchaseSearchParams(BaseModel):
     """Pydantic model for search parameters"""
-    cf: Optional[str] = None
\ No newline at end of file
+    name: Optional[str] = None
+    surname: Optional[str] = None
+    cf: Optional[str] = None
+    cf_mode: CfSearchMode = CfSearchMode.AUTO
+    cc: Optional[str] = None
+    product: Optional[str] = None
+    date: Optional[datetime.date] = None
+    date_from: Optional[datetime.date] = None
+    date_to: Optional[datetime.date] = None
+    price_min: Optional[Decimal] = None
+    price_max: Optional[Decimal] = None
+    
+    @model_validator(mode="after")
+    def _check_ranges(self) -> "PurchaseSearchParams":
+        """Reject date and price ranges whose start is after their end"""
+        if self.date_from and self.date_to and self.date_from > self.date_to:
+            raise ValueError("date_from must not be after date_to")
+        if self.price_min is not None and self.price_max is not None and self.price_min > self.price_max:
+            raise ValueError("price_min must not be above price_max")
+        return self
@@ -0,0 +1,111 @@
+"""
+Connection pool instrumentation exposed through the diagnostics endpoint
+"""
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from collections import deque
+from typing import Any, Dict
+import threading
+import time
+
+class PoolMetrics:
+    """Connection pool counters fed by SQLAlchemy pool events and checkout timing"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=window)
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def attach(self, engine: Engine) -> None:
+        """Listen to the engine's pool events; listeners survive pool recreation"""
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+
+    def record_wait(self, seconds: float) -> None:
+        """Record how long a checkout waited for a connection"""
+        with self._lock:
+            self._waits.append(seconds)
+            self.waits += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def record_timeout(self) -> None:
+        """Record a checkout that gave up after pool_timeout"""
+        with self._lock:
+            self.timeouts += 1
+
+    def _on_connect(self, dbapi_connection, connection_record) -> None:
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def _on_checkin(self, dbapi_connection, connection_record) -> None:
+        with self._lock:
+            self.in_use -= 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception) -> None:
+        with self._lock:
+            self.invalidations += 1
+
+    def snapshot(self, engine: Engine) -> Dict[str, Any]:
+        """Current pool occupancy plus checkout counters and wait times in milliseconds"""
+        pool = engine.pool
+        with self._lock:
+            waits = sorted(self._waits)
+            snapshot = {
+                "pool": type(pool).__name__,
+                "size": pool.size() if hasattr(pool, "size") else None,
+                "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else self.in_use,
+                "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+                "overflow": max(0, pool.overflow()) if hasattr(pool, "overflow") else None,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_ms": {
+                    "avg": self.total_wait / self.waits * 1000 if self.waits else 0.0,
+                    "p50": _percentile(waits, 0.50) * 1000,
+                    "p95": _percentile(waits, 0.95) * 1000,
+                    "max": self.max_wait * 1000,
+                },
+            }
+        return snapshot
+
+def _percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def instrumented_pool(base: type, metrics: PoolMetrics) -> type:
+    """Subclass a pool class so every checkout reports its wait time to `metrics`"""
+
+    class InstrumentedPool(base):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                return super().connect()
+            except exc.TimeoutError:
+                metrics.record_timeout()
+                raise
+            finally:
+                metrics.record_wait(time.perf_counter() - start)
+
+    InstrumentedPool.__name__ = base.__name__
+    return InstrumentedPool
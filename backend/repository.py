@@ -1,15 +1,59 @@
+from sqlalchemy import and_, bindparam, case, delete, func, insert, or_, select, text, tuple_, union, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
-from model import PurchaseDB, PurchaseCreate
-from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.engine import Row
+from model import (
+    PurchaseDB, PurchaseCreate, CfSearchMode, PurchaseSearchParams, PURCHASE_FIELDS,
+    DailyProductRollupDB, DailyCustomerRollupDB, ReceiptBlobDB, MaintenanceCheckpointDB, TableVersionDB,
+    PurchaseTombstoneDB, RollupDimension
+)
+from collections import Counter, defaultdict
+from decimal import Decimal
+from operator import itemgetter
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+import csv
+import datetime
+import io
+
+# Columns written by bulk inserts, in COPY order (id is pre-allocated)
+BULK_COLUMNS = tuple(field for field in PURCHASE_FIELDS if field != "id") + ("version",)
+
+# Text columns bulk rows always fill; COPY must keep their empty strings, which CSV writes as an
+# unquoted empty field like NULL, as empty strings the way the executemany path stores them
+COPY_NOT_NULL = tuple(
+    name for name, field in PurchaseCreate.model_fields.items() if field.annotation is str
+) + ("receipt_path",)
+
+# Rollup tables, their key column and the purchase expression the key comes from
+ROLLUPS = {
+    RollupDimension.PRODUCT: (
+        DailyProductRollupDB, DailyProductRollupDB.product_name, PurchaseDB.product_name
+    ),
+    RollupDimension.CUSTOMER: (
+        DailyCustomerRollupDB, DailyCustomerRollupDB.customer_cf,
+        func.upper(func.trim(PurchaseDB.customer_cf))
+    ),
+}
 
 class PurchaseRepository:
     """Repository class for handling purchase data operations"""
     
+    # Search and export order; undated rows (empty dates before the DATE migration) come first,
+    # which PostgreSQL reads from ix_purchases_date_id backwards like a plain DESC
+    NEWEST_FIRST = (PurchaseDB.date.desc().nulls_first(), PurchaseDB.id.desc())
+    
     def __init__(self, db: Session):
         self.db = db
     
-    def create_purchase(self, purchase_data: PurchaseCreate, receipt_path: str) -> PurchaseDB:
+    def create_purchase(
+        self,
+        purchase_data: PurchaseCreate,
+        receipt_path: str,
+        receipt_sha256: Optional[str] = None
+    ) -> PurchaseDB:
         """Create a new purchase in the database"""
+        version = self._next_version()
         db_purchase = PurchaseDB(
             customer_name=purchase_data.customer_name,
             customer_surname=purchase_data.customer_surname,
@@ -18,33 +62,702 @@ class PurchaseRepository:
             product_name=purchase_data.product_name,
             price=purchase_data.price,
             date=purchase_data.date,
-            receipt_path=receipt_path
+            receipt_path=receipt_path,
+            receipt_sha256=receipt_sha256,
+            version=version
         )
         self.db.add(db_purchase)
+        self._apply_rollups([self._rollup_entry(db_purchase)])
         self.db.commit()
         self.db.refresh(db_purchase)
         return db_purchase
     
+    def bulk_create_purchases(
+        self,
+        purchases: Sequence[Tuple[PurchaseCreate, str, Optional[str]]],
+        batch_size: int = 5000
+    ) -> List[int]:
+        """Insert (purchase, receipt path, receipt hash) rows in one transaction, returning ids in input order"""
+        if not purchases:
+            return []
+        first_version = self._next_version(len(purchases)) - len(purchases) + 1
+        rows = [
+            dict(
+                purchase_data.model_dump(),
+                receipt_path=receipt_path, receipt_sha256=receipt_sha256, version=first_version + i
+            )
+            for i, (purchase_data, receipt_path, receipt_sha256) in enumerate(purchases)
+        ]
+        ids = []
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            # COPY needs a psycopg2 cursor; other drivers (e.g. asyncpg) use executemany
+            if self.db.get_bind().dialect.driver == "psycopg2":
+                ids.extend(self._copy_purchases(batch))
+            else:
+                result = self.db.execute(
+                    insert(PurchaseDB).returning(PurchaseDB.id, sort_by_parameter_order=True),
+                    batch
+                )
+                ids.extend(result.scalars().all())
+            self._apply_rollups(
+                (row["date"], row["product_name"], row["customer_cf"], row["price"]) for row in batch
+            )
+        self.db.commit()
+        return ids
+    
+    def _copy_purchases(self, rows: List[dict]) -> List[int]:
+        """Load rows with PostgreSQL COPY, pre-allocating their ids from the sequence"""
+        ids = self.db.execute(
+            text("SELECT nextval(pg_get_serial_sequence('purchases', 'id')) "
+                 "FROM generate_series(1, :count)"),
+            {"count": len(rows)}
+        ).scalars().all()
+        
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for purchase_id, row in zip(ids, rows):
+            writer.writerow([purchase_id] + [row[column] for column in BULK_COLUMNS])
+        buffer.seek(0)
+        
+        cursor = self.db.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY purchases (id, {', '.join(BULK_COLUMNS)}) FROM STDIN "
+                f"WITH (FORMAT csv, FORCE_NOT_NULL ({', '.join(COPY_NOT_NULL)}))",
+                buffer
+            )
+        finally:
+            cursor.close()
+        return list(ids)
+    
     def get_purchase_by_id(self, purchase_id: int) -> Optional[PurchaseDB]:
         """Get a purchase by its ID"""
         return self.db.query(PurchaseDB).filter(PurchaseDB.id == purchase_id).first()
     
-    def search_purchases(self, cf: Optional[str] = None) -> List[PurchaseDB]:
-        """Search purchases with optional customer CF filter"""
-        query = self.db.query(PurchaseDB)
-        if cf:
-            query = query.filter(PurchaseDB.customer_cf.ilike(f"%{cf}%"))
-        return query.all()
+    def get_purchase_row(
+        self,
+        purchase_id: int,
+        fields: Sequence[str] = PURCHASE_FIELDS
+    ) -> Optional[Row]:
+        """Get the given columns of a purchase as a plain Row tuple"""
+        statement = select(*self._columns(fields)).where(PurchaseDB.id == purchase_id)
+        return self.db.execute(statement).first()
+    
+    def search_purchases(
+        self,
+        params: PurchaseSearchParams,
+        after: Optional[Tuple[Optional[datetime.date], int]] = None,
+        limit: int = 50,
+        fields: Sequence[str] = PURCHASE_FIELDS
+    ) -> List[Row]:
+        """Search purchases newest first, resuming after the given (date, id) key"""
+        statement = select(*self._columns(fields)).where(*self._filter_conditions(params))
+        if after:
+            statement = statement.where(self._after_key(*after))
+        statement = statement.order_by(*self.NEWEST_FIRST).limit(limit)
+        return self.db.execute(statement).all()
+    
+    @staticmethod
+    def _after_key(date: Optional[datetime.date], purchase_id: int):
+        """Condition for rows past a (date, id) key in NEWEST_FIRST order"""
+        if date is None:
+            # Still among the undated rows listed first: the rest of them, then every dated row
+            return or_(and_(PurchaseDB.date.is_(None), PurchaseDB.id < purchase_id), PurchaseDB.date.isnot(None))
+        # Comparing with NULL is never true, so undated rows already listed are left out
+        return tuple_(PurchaseDB.date, PurchaseDB.id) < tuple_(date, purchase_id)
+    
+    def iter_purchases(
+        self,
+        params: PurchaseSearchParams,
+        batch_size: int = 1000,
+        fields: Sequence[str] = PURCHASE_FIELDS
+    ) -> Iterator[Row]:
+        """Stream matching purchase rows through a server-side cursor, newest first"""
+        yield from self.db.execute(self._stream_statement(params, batch_size, fields))
+    
+    @classmethod
+    def _stream_statement(cls, params: PurchaseSearchParams, batch_size: int, fields: Sequence[str]):
+        """Build the newest-first query read in batches through a server-side cursor"""
+        return (
+            select(*cls._columns(fields))
+            .where(*cls._filter_conditions(params))
+            .order_by(*cls.NEWEST_FIRST)
+            .execution_options(yield_per=batch_size)
+        )
+    
+    def get_stats(self, params: PurchaseSearchParams, today: datetime.date) -> Row:
+        """Compute count, sum, average, distinct customers and today's count in one query"""
+        statement = select(
+            func.count().label("total_purchases"),
+            func.coalesce(func.sum(PurchaseDB.price), 0).label("total_amount"),
+            func.coalesce(func.avg(PurchaseDB.price), 0).label("average_amount"),
+            func.count(func.distinct(PurchaseDB.customer_cf)).label("unique_customers"),
+            func.count().filter(PurchaseDB.date == today).label("today_purchases"),
+        ).where(*self._filter_conditions(params))
+        return self.db.execute(statement).one()
+    
+    @staticmethod
+    def _columns(fields: Sequence[str]) -> list:
+        """Map field names to PurchaseDB columns"""
+        return [getattr(PurchaseDB, field) for field in fields]
+    
+    @classmethod
+    def _filter_conditions(cls, params: PurchaseSearchParams) -> list:
+        """Translate search parameters into SQL predicates combined with AND"""
+        conditions = []
+        if params.name:
+            conditions.append(cls._prefix_filter(PurchaseDB.customer_name, params.name))
+        if params.surname:
+            conditions.append(cls._prefix_filter(PurchaseDB.customer_surname, params.surname))
+        if params.cf:
+            conditions.append(cls._cf_filter(params.cf, params.cf_mode))
+        if params.cc:
+            conditions.append(PurchaseDB.credit_card == params.cc.strip())
+        if params.product:
+            conditions.append(cls._prefix_filter(PurchaseDB.product_name, params.product))
+        if params.date:
+            conditions.append(PurchaseDB.date == params.date)
+        if params.date_from:
+            conditions.append(PurchaseDB.date >= params.date_from)
+        if params.date_to:
+            conditions.append(PurchaseDB.date <= params.date_to)
+        if params.price_min is not None:
+            conditions.append(PurchaseDB.price >= params.price_min)
+        if params.price_max is not None:
+            conditions.append(PurchaseDB.price <= params.price_max)
+        return conditions
+    
+    @staticmethod
+    def _escape_like(term: str) -> str:
+        """Escape LIKE wildcards so user input is matched literally"""
+        return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    
+    @classmethod
+    def _prefix_filter(cls, column, term: str):
+        """Case-insensitive prefix match served by a lower() text_pattern_ops index"""
+        return func.lower(column).like(f"{cls._escape_like(term.strip().lower())}%", escape="\\")
+    
+    @classmethod
+    def _cf_filter(cls, cf: str, mode: CfSearchMode):
+        """Build an index-friendly predicate on the upper-cased customer CF"""
+        term = cf.strip().upper()
+        if mode == CfSearchMode.AUTO:
+            mode = CfSearchMode.EXACT if len(term) == 16 else CfSearchMode.CONTAINS
+        
+        column = func.upper(PurchaseDB.customer_cf)
+        if mode == CfSearchMode.EXACT:
+            return column == term
+        
+        escaped = cls._escape_like(term)
+        if mode == CfSearchMode.PREFIX:
+            return column.like(f"{escaped}%", escape="\\")
+        return column.like(f"%{escaped}%", escape="\\")
     
     def get_all_purchases(self) -> List[PurchaseDB]:
         """Get all purchases"""
         return self.db.query(PurchaseDB).all()
     
-    def delete_purchase(self, purchase_id: int) -> bool:
-        """Delete a purchase by its ID"""
-        purchase = self.get_purchase_by_id(purchase_id)
-        if purchase:
-            self.db.delete(purchase)
+    def delete_purchases(
+        self,
+        ids: Optional[Sequence[int]] = None,
+        params: Optional[PurchaseSearchParams] = None
+    ) -> Tuple[List[int], List[str], List[Tuple[str, str]]]:
+        """Delete purchases by id and/or search filters in one statement, updating rollups and
+        receipt blob references; returns the ids deleted, their unique receipt files and the
+        (sha256, path) of blobs whose last reference went"""
+        conditions = self._filter_conditions(params) if params else []
+        if ids is not None:
+            conditions.append(PurchaseDB.id.in_(ids))
+        if not conditions:
+            raise ValueError("Give purchase ids or search filters; refusing to delete every purchase")
+        
+        rows = self.db.execute(
+            delete(PurchaseDB)
+            .where(*conditions)
+            .returning(
+                PurchaseDB.date, PurchaseDB.product_name, PurchaseDB.customer_cf, PurchaseDB.price,
+                PurchaseDB.receipt_path, PurchaseDB.receipt_sha256, PurchaseDB.id
+            )
+            .execution_options(synchronize_session=False)
+        ).all()
+        blobs = self._release_receipt_blobs(
+            Counter((row.receipt_sha256, row.receipt_path) for row in rows if row.receipt_sha256)
+        )
+        self._lock_versions()
+        self._apply_rollups([row[:4] for row in rows], sign=-1)
+        if rows:
+            self._add_tombstones([row.id for row in rows])
+        self.db.commit()
+        
+        # Unique receipts go with their purchase; shared blobs with their last reference,
+        # removed through claim_released_blob in case their content is uploaded again meanwhile
+        files = {
+            row.receipt_path for row in rows
+            if row.receipt_path and (row.receipt_sha256, row.receipt_path) not in blobs
+        }
+        released = sorted(blob for blob, count in blobs.items() if count <= 0)
+        return [row.id for row in rows], sorted(files), released
+    
+    def get_daily_rollups(
+        self,
+        dimension: RollupDimension,
+        group: bool = False,
+        key: Optional[str] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None
+    ) -> List[Row]:
+        """Read a daily time series from a rollup table, never touching purchases"""
+        model, key_column, _ = ROLLUPS[dimension]
+        columns = [model.date]
+        if group:
+            columns.append(key_column)
+        statement = select(
+            *columns,
+            func.sum(model.purchase_count).label("purchase_count"),
+            func.sum(model.total_amount).label("total_amount"),
+        )
+        if key:
+            statement = statement.where(key_column == self._rollup_key(dimension, key))
+        if date_from:
+            statement = statement.where(model.date >= date_from)
+        if date_to:
+            statement = statement.where(model.date <= date_to)
+        return self.db.execute(statement.group_by(*columns).order_by(*columns)).all()
+    
+    def rebuild_rollups(self) -> None:
+        """Recompute every rollup table from the purchases table"""
+        if self.db.get_bind().dialect.name == "postgresql":
+            # Block concurrent writes so no delta is lost between delete and insert
+            self.db.execute(text("LOCK TABLE purchases IN SHARE MODE"))
+        for model, key_column, source in ROLLUPS.values():
+            self.db.execute(delete(model))
+            self.db.execute(insert(model).from_select(
+                ["date", key_column.key, "purchase_count", "total_amount"],
+                select(PurchaseDB.date, source, func.count(), func.sum(PurchaseDB.price))
+                .where(PurchaseDB.date.isnot(None))
+                .group_by(PurchaseDB.date, source)
+            ))
+        self.db.commit()
+    
+    @staticmethod
+    def _rollup_key(dimension: RollupDimension, value: str) -> str:
+        """Normalize a rollup key the same way ROLLUPS derives it in SQL (TRIM strips spaces only)"""
+        return value.strip(" ").upper() if dimension == RollupDimension.CUSTOMER else value
+    
+    @staticmethod
+    def _rollup_entry(purchase: PurchaseDB) -> Tuple:
+        """Extract the (date, product, cf, price) tuple a purchase contributes"""
+        return purchase.date, purchase.product_name, purchase.customer_cf, purchase.price
+    
+    def _apply_rollups(self, entries: Iterable[Tuple], sign: int = 1) -> None:
+        """Add (or with sign=-1 subtract) purchases to the rollups in the current transaction"""
+        deltas = {dimension: defaultdict(lambda: [0, Decimal(0)]) for dimension in ROLLUPS}
+        for date, product_name, customer_cf, price in entries:
+            if date is None:
+                # Undated purchases (empty dates before the DATE migration) have no day to count under
+                continue
+            for dimension, value in ((RollupDimension.PRODUCT, product_name),
+                                     (RollupDimension.CUSTOMER, customer_cf)):
+                delta = deltas[dimension][(date, self._rollup_key(dimension, value))]
+                delta[0] += sign
+                delta[1] += sign * (price or 0)
+        
+        for dimension, (model, key_column, _) in ROLLUPS.items():
+            if not deltas[dimension]:
+                continue
+            rows = [
+                {"date": date, key_column.key: key, "purchase_count": count, "total_amount": amount}
+                for (date, key), (count, amount) in deltas[dimension].items()
+            ]
+            statement = self._upsert(model)
+            statement = statement.on_conflict_do_update(
+                index_elements=[model.date, key_column],
+                set_={
+                    "purchase_count": model.purchase_count + statement.excluded.purchase_count,
+                    "total_amount": model.total_amount + statement.excluded.total_amount,
+                }
+            )
+            self.db.execute(statement, rows)
+            if sign < 0:
+                self.db.execute(delete(model).where(
+                    tuple_(model.date, key_column).in_(list(deltas[dimension])),
+                    model.purchase_count <= 0
+                ))
+
+    def _upsert(self, model):
+        """Dialect-specific INSERT supporting ON CONFLICT DO UPDATE"""
+        if self.db.get_bind().dialect.name == "postgresql":
+            return postgresql.insert(model)
+        return sqlite.insert(model)
+    
+    def acquire_receipt_blobs(self, blobs: Sequence[Dict[str, Any]]) -> None:
+        """Add references (sha256, path, size, ref_count dicts) to receipt blobs in the current transaction"""
+        if not blobs:
+            return
+        # The upsert keeps the blob rows locked until commit, and claim_released_blob claims
+        # a hash before unlinking its file, so a blob being reused is never unlinked
+        statement = self._upsert(ReceiptBlobDB)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ReceiptBlobDB.sha256],
+            set_={"ref_count": ReceiptBlobDB.ref_count + statement.excluded.ref_count}
+        )
+        self.db.execute(statement, sorted(blobs, key=itemgetter("sha256")))
+    
+    def _release_receipt_blobs(self, references: Dict[Tuple[str, str], int]) -> Dict[Tuple[str, str], int]:
+        """Drop (sha256, path) -> count references from receipt blobs in the current transaction,
+        returning the references each blob has left; receipts that are not blobs are absent"""
+        if not references:
+            return {}
+        # Unique-mode receipts carry a hash too, so only references to a blob's own path count;
+        # the rows are locked in hash order, like acquire_receipt_blobs does, so paths cannot move meanwhile
+        counts = {
+            row.sha256: references[(row.sha256, row.path)]
+            for row in self.db.execute(
+                select(ReceiptBlobDB.sha256, ReceiptBlobDB.path)
+                .where(ReceiptBlobDB.sha256.in_({sha256 for sha256, _ in references}))
+                .order_by(ReceiptBlobDB.sha256)
+                .with_for_update()
+            )
+            if (row.sha256, row.path) in references
+        }
+        if not counts:
+            return {}
+        remaining = {
+            (row.sha256, row.path): row.ref_count
+            for row in self.db.execute(
+                update(ReceiptBlobDB)
+                .where(ReceiptBlobDB.sha256.in_(list(counts)))
+                .values(ref_count=ReceiptBlobDB.ref_count - case(counts, value=ReceiptBlobDB.sha256))
+                .returning(ReceiptBlobDB.sha256, ReceiptBlobDB.path, ReceiptBlobDB.ref_count)
+            )
+        }
+        released = [sha256 for (sha256, _), count in remaining.items() if count <= 0]
+        if released:
+            self.db.execute(delete(ReceiptBlobDB).where(ReceiptBlobDB.sha256.in_(released)))
+        return remaining
+
+    def claim_released_blob(self, sha256: str, path: str) -> bool:
+        """Claim the hash of a blob whose last reference was dropped and committed, unless its content
+        was referenced again since; a claim stays open until finish_blob_removal"""
+        # A placeholder row claims the hash: acquire_receipt_blobs for the same content waits on it
+        # until the file is gone, and the claim fails if the content already has a blob row again
+        statement = self._upsert(ReceiptBlobDB).values(sha256=sha256, path=path, size=0, ref_count=0)
+        try:
+            claimed = self.db.execute(
+                statement.on_conflict_do_nothing(index_elements=[ReceiptBlobDB.sha256])
+                .returning(ReceiptBlobDB.sha256)
+            ).first() is not None
+            if not claimed:
+                self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return claimed
+    
+    def finish_blob_removal(self, sha256: str, removed: bool = True) -> None:
+        """Drop a claimed blob's placeholder once its file is removed, or with removed=False give the claim up"""
+        if not removed:
+            self.db.rollback()
+            return
+        try:
+            self.db.execute(delete(ReceiptBlobDB).where(ReceiptBlobDB.sha256 == sha256))
             self.db.commit()
-            return True
-        return False
\ No newline at end of file
+        except Exception:
+            self.db.rollback()
+            raise
+    
+    def relocate_receipts(self, moves: Dict[str, str]) -> None:
+        """Point purchases and receipt blobs stored at old locations (keys) to new ones (values)"""
+        pairs = [{"old": old, "new": new} for old, new in moves.items()]
+        if not pairs:
+            return
+        # Purchase and blob rows are locked before the change counter, in the order delete_purchases takes them
+        purchases = self.db.execute(
+            select(PurchaseDB.id, PurchaseDB.receipt_path)
+            .where(PurchaseDB.receipt_path.in_(list(moves)))
+            .with_for_update()
+        ).all()
+        blob_table = ReceiptBlobDB.__table__
+        self.db.execute(
+            update(blob_table).where(blob_table.c.path == bindparam("old")).values(path=bindparam("new")),
+            pairs
+        )
+        # Repointed purchases are updated one by one, each with its own change sequence number
+        if purchases:
+            first_version = self._next_version(len(purchases)) - len(purchases) + 1
+            purchase_table = PurchaseDB.__table__
+            self.db.execute(
+                update(purchase_table)
+                .where(purchase_table.c.id == bindparam("purchase_id"))
+                .values(receipt_path=bindparam("new"), version=bindparam("new_version")),
+                [{"purchase_id": purchase.id, "new": moves[purchase.receipt_path], "new_version": first_version + i}
+                 for i, purchase in enumerate(purchases)]
+            )
+        self.db.commit()
+
+    def referenced_receipts(self, locations: Sequence[str]) -> Set[str]:
+        """The subset of receipt locations still referenced by a purchase or receipt blob"""
+        return set(self.db.execute(union(
+            select(PurchaseDB.receipt_path).where(PurchaseDB.receipt_path.in_(locations)),
+            select(ReceiptBlobDB.path).where(ReceiptBlobDB.path.in_(locations))
+        )).scalars())
+    
+    def get_receipt_paths(self, after_id: int, limit: int) -> List[Row]:
+        """(id, receipt_path) of the next purchases by id"""
+        return self.db.execute(
+            select(PurchaseDB.id, PurchaseDB.receipt_path)
+            .where(PurchaseDB.id > after_id)
+            .order_by(PurchaseDB.id)
+            .limit(limit)
+        ).all()
+    
+    @staticmethod
+    def _blob_references():
+        """Correlated count of the purchases actually referencing a receipt blob"""
+        return (
+            select(func.count())
+            .select_from(PurchaseDB)
+            .where(PurchaseDB.receipt_sha256 == ReceiptBlobDB.sha256, PurchaseDB.receipt_path == ReceiptBlobDB.path)
+            .correlate(ReceiptBlobDB)
+            .scalar_subquery()
+            .label("references")
+        )
+    
+    def get_receipt_blob_refs(self, after_sha256: str, limit: int) -> List[Row]:
+        """(sha256, path, ref_count, references) of the next receipt blobs by hash"""
+        return self.db.execute(
+            select(ReceiptBlobDB.sha256, ReceiptBlobDB.path, ReceiptBlobDB.ref_count, self._blob_references())
+            .where(ReceiptBlobDB.sha256 > after_sha256)
+            .order_by(ReceiptBlobDB.sha256)
+            .limit(limit)
+        ).all()
+    
+    def recount_receipt_blobs(self, sha256s: Sequence[str]) -> List[Row]:
+        """Reset blobs' ref_count to their actual references, deleting unreferenced ones; returns the new counts"""
+        # Writers changing a blob's references hold its row until commit, so once locked
+        # the count below sees every purchase referencing it
+        self.db.execute(
+            select(ReceiptBlobDB.sha256)
+            .where(ReceiptBlobDB.sha256.in_(sha256s))
+            .order_by(ReceiptBlobDB.sha256)
+            .with_for_update()
+        )
+        rows = self.db.execute(
+            select(ReceiptBlobDB.sha256, ReceiptBlobDB.path, self._blob_references())
+            .where(ReceiptBlobDB.sha256.in_(sha256s))
+        ).all()
+        for row in rows:
+            if row.references:
+                self.db.execute(
+                    update(ReceiptBlobDB)
+                    .where(ReceiptBlobDB.sha256 == row.sha256)
+                    .values(ref_count=row.references)
+                )
+            else:
+                self.db.execute(delete(ReceiptBlobDB).where(ReceiptBlobDB.sha256 == row.sha256))
+        self.db.commit()
+        return rows
+    
+    def _lock_versions(self, name: str = PurchaseDB.__tablename__) -> None:
+        """Lock a table's change counter in the current transaction without advancing it"""
+        # Writers lock receipt blob rows (and the purchase rows they delete or repoint) before the
+        # counter, and rollup rows after it, so no receipt storage I/O runs while it is held and
+        # concurrent writers never wait on each other in opposite orders
+        self._next_version(0, name)
+    
+    def _next_version(self, count: int = 1, name: str = PurchaseDB.__tablename__) -> int:
+        """Advance a table's change counter by `count` rows in the current transaction, returning the
+        last number reserved; the rows take the `count` numbers ending there"""
+        # The counter row stays locked until commit, so versions become visible in order; this
+        # serializes purchase writers, a bulk insert included (see benchmarks/version_counter.py)
+        statement = self._upsert(TableVersionDB).values(name=name, version=count)
+        statement = statement.on_conflict_do_update(
+            index_elements=[TableVersionDB.name],
+            set_={"version": TableVersionDB.version + count}
+        ).returning(TableVersionDB.version)
+        return self.db.execute(statement).scalar_one()
+    
+    def _add_tombstones(self, purchase_ids: Sequence[int]) -> None:
+        """Record deleted purchases for the change feed in the current transaction"""
+        first_version = self._next_version(len(purchase_ids)) - len(purchase_ids) + 1
+        # UTC, like the cutoff prune_tombstones is given
+        deleted_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        statement = self._upsert(PurchaseTombstoneDB)
+        self.db.execute(
+            statement.on_conflict_do_update(
+                index_elements=[PurchaseTombstoneDB.id],
+                set_={"version": statement.excluded.version, "deleted_at": statement.excluded.deleted_at}
+            ),
+            [{"id": purchase_id, "version": first_version + i, "deleted_at": deleted_at}
+             for i, purchase_id in enumerate(purchase_ids)]
+        )
+    
+    def get_changes(self, since: int, until: int, limit: int) -> Tuple[List[Row], List[Row]]:
+        """Up to `limit` purchases written and `limit` tombstones recorded after change number `since`
+        and up to `until`, each in change order"""
+        # Both scans stop at `until`, a version read beforehand: a write committed between them
+        # gets a later number, so neither can return it and skip over it
+        upserts = self.db.execute(
+            select(*self._columns(PURCHASE_FIELDS + ("version",)))
+            .where(PurchaseDB.version > since, PurchaseDB.version <= until)
+            .order_by(PurchaseDB.version)
+            .limit(limit)
+        ).all()
+        deletes = self.db.execute(
+            select(PurchaseTombstoneDB.id, PurchaseTombstoneDB.version)
+            .where(PurchaseTombstoneDB.version > since, PurchaseTombstoneDB.version <= until)
+            .order_by(PurchaseTombstoneDB.version)
+            .limit(limit)
+        ).all()
+        return upserts, deletes
+    
+    def prune_tombstones(self, before: datetime.datetime, checkpoint: str) -> int:
+        """Delete tombstones recorded before `before` (UTC), raising the change number saved as
+        `checkpoint` to the highest one removed in the same transaction; returns how many were removed"""
+        pruned = self.db.execute(
+            delete(PurchaseTombstoneDB)
+            .where(PurchaseTombstoneDB.deleted_at < before)
+            .returning(PurchaseTombstoneDB.version)
+        ).scalars().all()
+        if pruned:
+            horizon = max(max(pruned), int(self.get_checkpoint(checkpoint) or 0))
+            self._set_checkpoint(checkpoint, str(horizon))
+        self.db.commit()
+        return len(pruned)
+    
+    def get_table_version(self, name: str = PurchaseDB.__tablename__) -> int:
+        """A table's current change counter; 0 before its first versioned write"""
+        return self.db.execute(
+            select(TableVersionDB.version).where(TableVersionDB.name == name)
+        ).scalar() or 0
+    
+    def get_checkpoint(self, name: str) -> Optional[str]:
+        """Position a maintenance job saved, if any"""
+        return self.db.execute(
+            select(MaintenanceCheckpointDB.position).where(MaintenanceCheckpointDB.name == name)
+        ).scalar()
+    
+    def save_checkpoint(self, name: str, position: Optional[str]) -> None:
+        """Save (or with None, reset) a maintenance job's position"""
+        self._set_checkpoint(name, position)
+        self.db.commit()
+    
+    def _set_checkpoint(self, name: str, position: Optional[str]) -> None:
+        """Upsert a maintenance job's position in the current transaction"""
+        statement = self._upsert(MaintenanceCheckpointDB).values(name=name, position=position)
+        self.db.execute(statement.on_conflict_do_update(
+            index_elements=[MaintenanceCheckpointDB.name],
+            set_={"position": position, "updated_at": func.now()}
+        ))
+
+class AsyncPurchaseRepository:
+    """Async repository running the PurchaseRepository queries on an AsyncSession"""
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def _run(self, method: str, *args, **kwargs) -> Any:
+        """Run a PurchaseRepository method on the session's sync facade without blocking the loop"""
+        return await self.db.run_sync(
+            lambda session: getattr(PurchaseRepository(session), method)(*args, **kwargs)
+        )
+    
+    async def create_purchase(
+        self,
+        purchase_data: PurchaseCreate,
+        receipt_path: str,
+        receipt_sha256: Optional[str] = None
+    ) -> PurchaseDB:
+        """Create a new purchase in the database"""
+        return await self._run("create_purchase", purchase_data, receipt_path, receipt_sha256)
+    
+    async def bulk_create_purchases(
+        self,
+        purchases: Sequence[Tuple[PurchaseCreate, str, Optional[str]]],
+        batch_size: int = 5000
+    ) -> List[int]:
+        """Insert many purchases in a single transaction, returning ids in input order"""
+        return await self._run("bulk_create_purchases", purchases, batch_size=batch_size)
+    
+    async def get_purchase_by_id(self, purchase_id: int) -> Optional[PurchaseDB]:
+        """Get a purchase by its ID"""
+        return await self._run("get_purchase_by_id", purchase_id)
+    
+    async def get_purchase_row(
+        self,
+        purchase_id: int,
+        fields: Sequence[str] = PURCHASE_FIELDS
+    ) -> Optional[Row]:
+        """Get the given columns of a purchase as a plain Row tuple"""
+        return await self._run("get_purchase_row", purchase_id, fields=fields)
+    
+    async def get_table_version(self, name: str = PurchaseDB.__tablename__) -> int:
+        """A table's current change counter"""
+        return await self._run("get_table_version", name)
+    
+    async def get_changes(self, since: int, until: int, limit: int) -> Tuple[List[Row], List[Row]]:
+        """Purchases written and tombstones recorded after change number `since` and up to `until`"""
+        return await self._run("get_changes", since, until, limit)
+    
+    async def get_checkpoint(self, name: str) -> Optional[str]:
+        """Position a maintenance job saved, if any"""
+        return await self._run("get_checkpoint", name)
+    
+    async def search_purchases(
+        self,
+        params: PurchaseSearchParams,
+        after: Optional[Tuple[Optional[datetime.date], int]] = None,
+        limit: int = 50,
+        fields: Sequence[str] = PURCHASE_FIELDS
+    ) -> List[Row]:
+        """Search purchases newest first, resuming after the given (date, id) key"""
+        return await self._run("search_purchases", params, after=after, limit=limit, fields=fields)
+    
+    async def iter_purchase_batches(
+        self,
+        params: PurchaseSearchParams,
+        batch_size: int = 1000,
+        fields: Sequence[str] = PURCHASE_FIELDS
+    ) -> AsyncIterator[List[Row]]:
+        """Stream matching purchase rows in batches through a server-side cursor, newest first"""
+        result = await self.db.stream(PurchaseRepository._stream_statement(params, batch_size, fields))
+        async for batch in result.partitions():
+            yield batch
+    
+    async def get_stats(self, params: PurchaseSearchParams, today: datetime.date) -> Row:
+        """Compute count, sum, average, distinct customers and today's count in one query"""
+        return await self._run("get_stats", params, today=today)
+    
+    async def get_daily_rollups(
+        self,
+        dimension: RollupDimension,
+        group: bool = False,
+        key: Optional[str] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None
+    ) -> List[Row]:
+        """Read a daily time series from a rollup table"""
+        return await self._run(
+            "get_daily_rollups", dimension, group=group, key=key, date_from=date_from, date_to=date_to
+        )
+    
+    async def delete_purchases(
+        self,
+        ids: Optional[Sequence[int]] = None,
+        params: Optional[PurchaseSearchParams] = None
+    ) -> Tuple[List[int], List[str], List[Tuple[str, str]]]:
+        """Delete purchases by id and/or search filters in one statement"""
+        return await self._run("delete_purchases", ids=ids, params=params)
+    
+    async def claim_released_blob(self, sha256: str, path: str) -> bool:
+        """Claim the hash of a released blob unless its content was referenced again since"""
+        return await self._run("claim_released_blob", sha256, path)
+    
+    async def finish_blob_removal(self, sha256: str, removed: bool = True) -> None:
+        """Drop a claimed blob's placeholder once its file is removed, or give the claim up"""
+        return await self._run("finish_blob_removal", sha256, removed=removed)
+    
+    async def acquire_receipt_blobs(self, blobs: Sequence[Dict[str, Any]]) -> None:
+        """Add references to content-addressed receipt blobs in the current transaction"""
+        return await self._run("acquire_receipt_blobs", blobs)
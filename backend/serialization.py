@@ -0,0 +1,60 @@
+"""
+Fast response serialization for purchase payloads
+"""
+from fastapi import Request
+from fastapi.responses import Response
+from typing import Any, Dict, Sequence
+from decimal import Decimal
+import datetime
+import msgpack
+import orjson
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+def rows_to_dicts(fields: Sequence[str], rows) -> list:
+    """Build plain dicts straight from SQLAlchemy Row tuples"""
+    return [dict(zip(fields, row)) for row in rows]
+
+def row_to_dict(fields: Sequence[str], row) -> Dict[str, Any]:
+    """Build a plain dict from a single SQLAlchemy Row tuple"""
+    return dict(zip(fields, row))
+
+def dumps_json(content: Any) -> bytes:
+    """Serialize content to JSON bytes with orjson"""
+    return orjson.dumps(content, default=_json_default)
+
+def _json_default(value: Any) -> Any:
+    """Encode types orjson has no native representation for"""
+    # Prices stay JSON numbers for existing clients
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+class ORJSONResponse(Response):
+    """JSON response rendered with orjson, skipping response_model validation"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+class MsgPackResponse(Response):
+    """MessagePack response for clients that ask for it"""
+    media_type = "application/msgpack"
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, use_bin_type=True, default=_msgpack_default)
+
+def _msgpack_default(value: Any) -> Any:
+    """Encode types msgpack has no native representation for"""
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def negotiate_response(request: Request) -> type:
+    """Pick the response class matching the request's Accept header"""
+    accept = request.headers.get("accept", "")
+    if any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES):
+        return MsgPackResponse
+    return ORJSONResponse
@@ -1,87 +1,1026 @@
 from fastapi import UploadFile
-from repository import PurchaseRepository
-from model import PurchaseCreate, PurchaseResponse
-from typing import List, Optional
+from pydantic import ValidationError
+from fastapi.concurrency import run_in_threadpool
+from repository import AsyncPurchaseRepository, PurchaseRepository
+from model import (
+    PurchaseCreate, PurchaseSearchParams, PurchaseStats, ExportFormat, RollupDimension, PURCHASE_FIELDS
+)
+from export import (
+    CsvEncoder, ParquetEncoder, ReceiptZipWriter, aiter_archive, aiter_encoded, iter_archive, iter_encoded
+)
+from serialization import ORJSONResponse, dumps_json, row_to_dict, rows_to_dicts
+from storage import ReceiptStorage, get_storage
+from cache import Cache, get_purchase_cache, get_search_cache
+from config import config
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from operator import itemgetter
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+import datetime
+import base64
+import csv
+import hashlib
+import heapq
+import io
+import json
 import uuid
-import shutil
 import os
+import time
+import zipfile
+
+# Every PDF starts with this signature
+PDF_MAGIC = b"%PDF-"
+
+# Items checked per query by receipt reconciliation
+RECONCILE_BATCH_SIZE = 1000
+
+# Columns kept per purchase by the purchase cache: every field plus the row version its ETag comes from
+VERSIONED_FIELDS = PURCHASE_FIELDS + ("version",)
+
+# Checkpoint holding the highest change number whose tombstone was pruned from the change feed
+TOMBSTONE_HORIZON = "prune_tombstones"
+
+class ReceiptError(ValueError):
+    """Raised when an uploaded receipt is rejected"""
+
+class InvalidReceiptError(ReceiptError):
+    """Raised when an uploaded receipt is not a PDF"""
+
+class ReceiptTooLargeError(ReceiptError):
+    """Raised when an uploaded receipt exceeds MAX_FILE_SIZE"""
+
+class StoredReceipt(NamedTuple):
+    """A receipt written to receipt storage"""
+    path: str
+    sha256: str
+    size: int
+    # Content-addressed blobs may be referenced by other purchases
+    shared: bool = False
+
+class ReceiptDownload(NamedTuple):
+    """Where a purchase's receipt is served from"""
+    location: str
+    sha256: Optional[str]
+    # File metadata when served from local disk, or a presigned URL for remote backends
+    stat: Optional[os.stat_result] = None
+    url: Optional[str] = None
+
+class _ReceiptStream:
+    """Iterate an uploaded receipt in chunks, enforcing the size limit, hashing and sniffing it on the way"""
+    
+    def __init__(self, source: BinaryIO):
+        self.source = source
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._header = b""
+    
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self.source.read(config.UPLOAD_CHUNK_SIZE):
+            # Check the magic bytes before anything is written
+            if len(self._header) < len(PDF_MAGIC):
+                self._header += chunk[:len(PDF_MAGIC) - len(self._header)]
+                if not PDF_MAGIC.startswith(self._header):
+                    raise InvalidReceiptError("Receipt is not a PDF file")
+            self.size += len(chunk)
+            if self.size > config.MAX_FILE_SIZE:
+                raise ReceiptTooLargeError(f"Receipt exceeds the {config.MAX_FILE_SIZE} byte limit")
+            self.digest.update(chunk)
+            yield chunk
+        if self._header != PDF_MAGIC:
+            raise InvalidReceiptError("Receipt is not a PDF file")
 
 class PurchaseService:
     """Service class for purchase business logic"""
     
-    def __init__(self, repository: PurchaseRepository):
+    def __init__(
+        self,
+        repository: PurchaseRepository,
+        storage: Optional[ReceiptStorage] = None,
+        cache: Optional[Cache] = None,
+        search_cache: Optional[Cache] = None
+    ):
         self.repository = repository
-        self.upload_folder = "./uploads"
-        os.makedirs(self.upload_folder, exist_ok=True)
+        self.storage = storage or get_storage()
+        self.cache = cache or get_purchase_cache()
+        self.search_cache = search_cache or get_search_cache()
     
     def upload_purchase(self, purchase_data: PurchaseCreate, receipt_file: UploadFile) -> dict:
         """Handle purchase upload with file storage"""
-        file_path = None
+        receipt = None
         try:
-            # Generate unique filename and save receipt
-            file_id = str(uuid.uuid4())
-            file_path = os.path.join(self.upload_folder, file_id + ".pdf")
-            
-            with open(file_path, "wb") as f:
-                shutil.copyfileobj(receipt_file.file, f)
+            receipt = self._save_receipt(receipt_file.file)
+            if config.RECEIPT_STORAGE == "content":
+                receipt, = self._share_receipts([receipt])
             
             # Create purchase in database
-            purchase = self.repository.create_purchase(purchase_data, file_path)
+            purchase = self.repository.create_purchase(purchase_data, receipt.path, receipt.sha256)
             
-            return {
-                "message": "Purchase uploaded successfully.",
-                "purchase_id": purchase.id,
-                "receipt_path": file_path
-            }
+            return self._upload_result(purchase.id, receipt)
         except Exception as e:
             # Clean up file if database operation fails
-            if file_path and os.path.exists(file_path):
-                os.remove(file_path)
+            if receipt and not receipt.shared:
+                self._remove_file(receipt.path)
             raise e
     
-    def search_purchases(self, cf: Optional[str] = None) -> List[PurchaseResponse]:
-        """Search purchases and return formatted results"""
-        purchases = self.repository.search_purchases(cf)
-        return [
-            PurchaseResponse(
-                id=p.id,
-                customer_name=p.customer_name,
-                customer_surname=p.customer_surname,
-                customer_cf=p.customer_cf,
-                credit_card=p.credit_card,
-                product_name=p.product_name,
-                price=p.price,
-                date=p.date,
-                receipt_path=p.receipt_path
+    def bulk_upload_purchases(
+        self,
+        manifest: UploadFile,
+        receipts: Optional[UploadFile] = None
+    ) -> dict:
+        """Validate a manifest, store its receipts and insert all valid rows at once"""
+        archive = zipfile.ZipFile(receipts.file) if receipts else None
+        try:
+            results, valid = self._validate_manifest(manifest, archive)
+            stored = self._extract_receipts(archive, valid, results)
+            try:
+                if config.RECEIPT_STORAGE == "content":
+                    stored = self._with_receipts(stored, self._share_receipts(self._receipts(stored)))
+                ids = self.repository.bulk_create_purchases(self._bulk_rows(stored))
+            except Exception:
+                # Clean up files if the database operation fails
+                self._remove_files(stored)
+                raise
+        finally:
+            if archive:
+                archive.close()
+        
+        return self._bulk_result(results, ids, stored)
+    
+    def _save_receipt(self, source: BinaryIO) -> StoredReceipt:
+        """Stream a receipt to storage in chunks, enforcing the size limit, hashing and sniffing it in one pass"""
+        location = self.storage.location(str(uuid.uuid4()) + ".pdf")
+        stream = _ReceiptStream(source)
+        try:
+            self.storage.write(location, stream)
+        except Exception:
+            self._remove_file(location)
+            raise
+        return StoredReceipt(location, stream.digest.hexdigest(), stream.size)
+    
+    def _share_receipts(self, receipts: List[StoredReceipt]) -> List[StoredReceipt]:
+        """Reference content-addressed blobs for freshly saved receipts, keeping one file per content"""
+        if not receipts:
+            return []
+        self.repository.acquire_receipt_blobs(self._blob_refs(receipts))
+        return self._move_to_blobs(receipts)
+    
+    def _blob_path(self, sha256: str) -> str:
+        """Location of the content-addressed blob for a receipt hash"""
+        return self.storage.location(sha256 + ".pdf")
+    
+    def _blob_refs(self, receipts: List[StoredReceipt]) -> List[Dict[str, Any]]:
+        """Count the references each distinct receipt content gains"""
+        refs: Dict[str, Dict[str, Any]] = {}
+        for receipt in receipts:
+            ref = refs.setdefault(receipt.sha256, {
+                "sha256": receipt.sha256,
+                "path": self._blob_path(receipt.sha256),
+                "size": receipt.size,
+                "ref_count": 0
+            })
+            ref["ref_count"] += 1
+        return list(refs.values())
+    
+    def _move_to_blobs(self, receipts: List[StoredReceipt]) -> List[StoredReceipt]:
+        """Rename new contents into place and drop the copies of contents already stored"""
+        shared = []
+        for receipt in receipts:
+            blob_path = self._blob_path(receipt.sha256)
+            if self.storage.exists(blob_path):
+                self._remove_file(receipt.path)
+            else:
+                self.storage.move(receipt.path, blob_path)
+            shared.append(StoredReceipt(blob_path, receipt.sha256, receipt.size, shared=True))
+        return shared
+    
+    @staticmethod
+    def _receipts(stored: List[Tuple[int, PurchaseCreate, StoredReceipt]]) -> List[StoredReceipt]:
+        """The receipts of stored bulk rows"""
+        return [receipt for _, _, receipt in stored]
+    
+    @staticmethod
+    def _with_receipts(
+        stored: List[Tuple[int, PurchaseCreate, StoredReceipt]],
+        receipts: List[StoredReceipt]
+    ) -> List[Tuple[int, PurchaseCreate, StoredReceipt]]:
+        """Replace the receipts of stored bulk rows"""
+        return [(row_number, purchase_data, receipt)
+                for (row_number, purchase_data, _), receipt in zip(stored, receipts)]
+    
+    def _remove_file(self, location: str) -> None:
+        """Remove a stored receipt if it exists"""
+        self.storage.delete(location)
+    
+    def _remove_files(self, stored: List[Tuple[int, PurchaseCreate, StoredReceipt]]) -> None:
+        """Remove the receipts stored for a failed bulk upload"""
+        for _, _, receipt in stored:
+            if not receipt.shared:
+                self._remove_file(receipt.path)
+    
+    @staticmethod
+    def _upload_result(purchase_id: int, receipt: StoredReceipt) -> dict:
+        """Build the upload endpoint's response body"""
+        return {
+            "message": "Purchase uploaded successfully.",
+            "purchase_id": purchase_id,
+            "receipt_path": receipt.path,
+            "receipt_sha256": receipt.sha256
+        }
+    
+    def _validate_manifest(
+        self,
+        manifest: UploadFile,
+        archive: Optional[zipfile.ZipFile]
+    ) -> Tuple[List[Dict[str, Any]], List[Tuple[int, PurchaseCreate, str]]]:
+        """Validate every manifest row, returning row errors and the valid rows"""
+        results: List[Dict[str, Any]] = []
+        valid: List[Tuple[int, PurchaseCreate, str]] = []
+        for row_number, row in enumerate(self._read_manifest(manifest), start=1):
+            try:
+                if isinstance(row, str):
+                    row = json.loads(row)
+                if not isinstance(row, dict):
+                    raise ValueError("manifest row must be an object")
+                receipt_name = row.pop("receipt", None)
+                purchase_data = PurchaseCreate(**row)
+                if not receipt_name:
+                    raise ValueError("receipt: missing receipt file name")
+                if archive is None or receipt_name not in archive.NameToInfo:
+                    raise ValueError(f"receipt: '{receipt_name}' not found in archive")
+            except (ValidationError, ValueError, TypeError) as e:
+                results.append({"row": row_number, "error": self._format_row_error(e)})
+                continue
+            valid.append((row_number, purchase_data, receipt_name))
+        return results, valid
+    
+    def _extract_receipts(
+        self,
+        archive: Optional[zipfile.ZipFile],
+        valid: List[Tuple[int, PurchaseCreate, str]],
+        results: List[Dict[str, Any]]
+    ) -> List[Tuple[int, PurchaseCreate, StoredReceipt]]:
+        """Extract the receipts of valid rows under fresh names, reporting rejected ones as row errors"""
+        stored: List[Tuple[int, PurchaseCreate, StoredReceipt]] = []
+        try:
+            for row_number, purchase_data, receipt_name in valid:
+                try:
+                    with archive.open(receipt_name) as source:
+                        stored.append((row_number, purchase_data, self._save_receipt(source)))
+                except ReceiptError as e:
+                    results.append({"row": row_number, "error": f"receipt: {e}"})
+        except Exception:
+            self._remove_files(stored)
+            raise
+        return stored
+    
+    @staticmethod
+    def _bulk_rows(
+        stored: List[Tuple[int, PurchaseCreate, StoredReceipt]]
+    ) -> List[Tuple[PurchaseCreate, str, str]]:
+        """Pair each purchase with its stored receipt's path and hash"""
+        return [(purchase_data, receipt.path, receipt.sha256) for _, purchase_data, receipt in stored]
+    
+    @staticmethod
+    def _bulk_result(
+        results: List[Dict[str, Any]],
+        ids: List[int],
+        stored: List[Tuple[int, PurchaseCreate, StoredReceipt]]
+    ) -> dict:
+        """Merge inserted ids and row errors into the bulk endpoint's response body"""
+        for (row_number, _, receipt), purchase_id in zip(stored, ids):
+            results.append({
+                "row": row_number,
+                "purchase_id": purchase_id,
+                "receipt_path": receipt.path,
+                "receipt_sha256": receipt.sha256
+            })
+        results.sort(key=lambda result: result["row"])
+        
+        return {
+            "message": f"Inserted {len(ids)} of {len(results)} purchases.",
+            "inserted": len(ids),
+            "failed": len(results) - len(ids),
+            "results": results
+        }
+    
+    @staticmethod
+    def _read_manifest(manifest: UploadFile) -> Iterator[Union[Dict[str, Any], str]]:
+        """Yield CSV rows as dicts, or raw NDJSON lines to be parsed per row"""
+        text_stream = io.TextIOWrapper(manifest.file, encoding="utf-8", newline="")
+        filename = (manifest.filename or "").lower()
+        if filename.endswith(".csv") or manifest.content_type == "text/csv":
+            yield from csv.DictReader(text_stream)
+            return
+        for line in text_stream:
+            if line.strip():
+                yield line
+    
+    @staticmethod
+    def _format_row_error(error: Exception) -> str:
+        """Flatten a validation error into a single message"""
+        if isinstance(error, ValidationError):
+            return "; ".join(
+                f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}"
+                for detail in error.errors()
             )
-            for p in purchases
+        return str(error)
+    
+    def search_purchases(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        fields: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Search purchases and return one page of serializable rows"""
+        limit = self._page_limit(limit)
+        after = self._decode_cursor(cursor) if cursor else None
+        fields = self._parse_fields(fields)
+        
+        # Fetch one extra row to know whether another page exists
+        rows = self.repository.search_purchases(
+            params, after=after, limit=limit + 1, fields=self._with_keyset(fields)
+        )
+        return self._page(rows, fields, limit)
+    
+    def search_etag(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        fields: Optional[str] = None,
+        response_class: type = ORJSONResponse
+    ) -> str:
+        """Strong ETag of a search page: the purchases table version plus a digest of the normalized query"""
+        version = self.repository.get_table_version()
+        return self._search_etag(version, params, cursor, limit, fields, response_class)
+    
+    def render_search_page(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        fields: Optional[str] = None,
+        response_class: type = ORJSONResponse,
+        etag: Optional[str] = None
+    ) -> bytes:
+        """One search page serialized by `response_class`, served from the search cache when enabled"""
+        if self.search_cache is None:
+            return response_class(self.search_purchases(params, cursor, limit, fields)).body
+        # The ETag changes with every write, so pages of older versions are never looked up again
+        key = etag or self.search_etag(params, cursor, limit, fields, response_class)
+        body = self.search_cache.get(key)
+        if body is None:
+            body = response_class(self.search_purchases(params, cursor, limit, fields)).body
+            self.search_cache.add(key, body)
+        return body
+    
+    def _search_etag(
+        self,
+        version: int,
+        params: PurchaseSearchParams,
+        cursor: Optional[str],
+        limit: Optional[int],
+        fields: Optional[str],
+        response_class: type
+    ) -> str:
+        """Quoted ETag from the table version read before the rows, so a racing write only makes it older"""
+        return f'"{version}-{self._search_key(params, cursor, limit, fields, response_class)}"'
+    
+    def _search_key(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str],
+        limit: Optional[int],
+        fields: Optional[str],
+        response_class: type
+    ) -> str:
+        """Digest of a normalized search, so requests differing only in case, spacing or defaults share an entry"""
+        def lower(term: Optional[str]) -> Optional[str]:
+            return term.strip().lower() if term else None
+        
+        normalized = [
+            response_class.media_type,
+            lower(params.name),
+            lower(params.surname),
+            params.cf.strip().upper() if params.cf else None,
+            params.cf_mode.value if params.cf else None,
+            params.cc.strip() if params.cc else None,
+            lower(params.product),
+            params.date,
+            params.date_from,
+            params.date_to,
+            # 10.5 and 10.50 serialize alike
+            params.price_min,
+            params.price_max,
+            cursor,
+            self._page_limit(limit),
+            self._parse_fields(fields),
         ]
+        return hashlib.sha256(dumps_json(normalized)).hexdigest()
     
-    def get_purchase_by_id(self, purchase_id: int) -> Optional[PurchaseResponse]:
-        """Get a single purchase by ID"""
-        purchase = self.repository.get_purchase_by_id(purchase_id)
-        if purchase:
-            return PurchaseResponse(
-                id=purchase.id,
-                customer_name=purchase.customer_name,
-                customer_surname=purchase.customer_surname,
-                customer_cf=purchase.customer_cf,
-                credit_card=purchase.credit_card,
-                product_name=purchase.product_name,
-                price=purchase.price,
-                date=purchase.date,
-                receipt_path=purchase.receipt_path
+    @staticmethod
+    def _page_limit(limit: Optional[int]) -> int:
+        """Apply the configured default and maximum page size"""
+        return min(limit or config.SEARCH_DEFAULT_LIMIT, config.SEARCH_MAX_LIMIT)
+    
+    @staticmethod
+    def _with_keyset(fields: Tuple[str, ...]) -> Tuple[str, ...]:
+        """Add the keyset columns, which zip() drops from the output when not requested"""
+        return fields + tuple(key for key in ("date", "id") if key not in fields)
+    
+    def _page(self, rows: List, fields: Tuple[str, ...], limit: int) -> Dict[str, Any]:
+        """Trim the extra row fetched past the page and derive the next cursor"""
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_cursor(rows[-1].date, rows[-1].id)
+        
+        return {
+            "items": rows_to_dicts(fields, rows),
+            "next_cursor": next_cursor
+        }
+    
+    def stream_purchases(
+        self,
+        params: PurchaseSearchParams,
+        fields: Optional[str] = None
+    ) -> Iterator[bytes]:
+        """Return an iterator yielding every matching purchase as one NDJSON line"""
+        # Parse eagerly so invalid fields fail before the response starts
+        fields = self._parse_fields(fields)
+        rows = self.repository.iter_purchases(params, fields=fields)
+        return (dumps_json(row_to_dict(fields, row)) + b"\n" for row in rows)
+    
+    def get_stats(self, params: PurchaseSearchParams) -> PurchaseStats:
+        """Get aggregate statistics for purchases matching the filters"""
+        stats = self.repository.get_stats(params, today=datetime.date.today())
+        return PurchaseStats(**stats._asdict())
+    
+    def get_daily_series(
+        self,
+        dimension: RollupDimension = RollupDimension.PRODUCT,
+        group: bool = False,
+        key: Optional[str] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None
+    ) -> List[Dict[str, Any]]:
+        """Get a daily spend time series from the rollup tables"""
+        rows = self.repository.get_daily_rollups(
+            dimension, group=group, key=key, date_from=date_from, date_to=date_to
+        )
+        return rows_to_dicts(self._daily_fields(group), rows)
+    
+    @staticmethod
+    def _daily_fields(group: bool) -> Tuple[str, ...]:
+        """Field names of a daily rollup row, with the key only when grouped"""
+        if group:
+            return ("date", "key", "purchase_count", "total_amount")
+        return ("date", "purchase_count", "total_amount")
+    
+    def export_purchases(
+        self,
+        params: PurchaseSearchParams,
+        export_format: ExportFormat = ExportFormat.CSV,
+        fields: Optional[str] = None
+    ) -> Iterator[bytes]:
+        """Return an iterator encoding every matching purchase as CSV or Parquet"""
+        fields = self._parse_fields(fields)
+        encoder = self._export_encoder(export_format, fields)
+        rows = self.repository.iter_purchases(params, batch_size=encoder.batch_size, fields=fields)
+        return iter_encoded(encoder, rows)
+    
+    def export_receipts(self, params: PurchaseSearchParams) -> Iterator[bytes]:
+        """Return an iterator streaming a ZIP of every matching purchase's receipt plus a manifest"""
+        writer = self._receipt_writer()
+        rows = self.repository.iter_purchases(params, batch_size=writer.batch_size)
+        return iter_archive(writer, rows)
+    
+    def _receipt_writer(self) -> ReceiptZipWriter:
+        """Create the ZIP writer reading receipts from storage"""
+        return ReceiptZipWriter(PURCHASE_FIELDS, self.storage.open, chunk_size=config.UPLOAD_CHUNK_SIZE)
+    
+    @staticmethod
+    def _export_encoder(export_format: ExportFormat, fields: Tuple[str, ...]):
+        """Create the incremental encoder for an export format"""
+        if export_format == ExportFormat.PARQUET:
+            return ParquetEncoder(fields)
+        return CsvEncoder(fields)
+    
+    @staticmethod
+    def _parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+        """Parse a comma-separated column projection, defaulting to every field"""
+        if not fields:
+            return PURCHASE_FIELDS
+        requested = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        unknown = [f for f in requested if f not in PURCHASE_FIELDS]
+        if unknown or not requested:
+            raise ValueError(
+                f"Unknown fields: {', '.join(unknown) or fields}. "
+                f"Allowed: {', '.join(PURCHASE_FIELDS)}"
             )
+        return requested
+    
+    @staticmethod
+    def _encode_cursor(date: Optional[datetime.date], purchase_id: int) -> str:
+        """Encode the (date, id) keyset position as an opaque cursor"""
+        raw = json.dumps([date.isoformat() if date else None, purchase_id]).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+    
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[Optional[datetime.date], int]:
+        """Decode a cursor produced by _encode_cursor"""
+        try:
+            date, purchase_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.date.fromisoformat(date) if date is not None else None, int(purchase_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+    
+    def get_purchase_by_id(
+        self,
+        purchase_id: int,
+        fields: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Get a single purchase by ID"""
+        found = self.get_versioned_purchase(purchase_id, fields=fields)
+        return found[0] if found else None
+    
+    def get_versioned_purchase(
+        self,
+        purchase_id: int,
+        fields: Optional[str] = None
+    ) -> Optional[Tuple[Dict[str, Any], int]]:
+        """Get a single purchase by ID with its row version, through the purchase cache when enabled"""
+        fields = self._parse_fields(fields)
+        if self.cache is None:
+            row = self.repository.get_purchase_row(purchase_id, fields=fields + ("version",))
+            return (row_to_dict(fields, row), row.version) if row else None
+        purchase = self.cache.get(purchase_id)
+        if purchase is None:
+            # Deliberately not projected in SQL: a whole row costs little more to read by primary
+            # key, and caching it lets every field projection of the purchase share one entry
+            row = self.repository.get_purchase_row(purchase_id, fields=VERSIONED_FIELDS)
+            if not row:
+                return None
+            purchase = row_to_dict(VERSIONED_FIELDS, row)
+            self.cache.add(purchase_id, purchase)
+        return self._project(purchase, fields), purchase["version"]
+    
+    @staticmethod
+    def _project(purchase: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+        """The requested fields of a cached purchase, as a new dict"""
+        return {field: purchase[field] for field in fields}
+    
+    @staticmethod
+    def purchase_etag(purchase_id: int, version: int, fields: Iterable[str], response_class: type) -> str:
+        """Strong ETag of one representation of a purchase, changing whenever its row is written"""
+        representation = hashlib.sha256(f"{response_class.media_type};{','.join(fields)}".encode()).hexdigest()
+        return f'"{purchase_id}-{version}-{representation[:16]}"'
+    
+    def get_receipt(self, purchase_id: int) -> Optional[ReceiptDownload]:
+        """Locate a purchase's receipt for download"""
+        row = self.repository.get_purchase_row(purchase_id, fields=("receipt_path", "receipt_sha256"))
+        if row and row.receipt_path:
+            return self._receipt_download(row.receipt_path, row.receipt_sha256)
         return None
     
+    def _receipt_download(self, location: str, sha256: Optional[str]) -> Optional[ReceiptDownload]:
+        """Presign a remote receipt, or stat a local one; None when the file is missing"""
+        url = self.storage.presigned_url(location)
+        if url:
+            return ReceiptDownload(location, sha256, url=url)
+        try:
+            return ReceiptDownload(location, sha256, stat=os.stat(location))
+        except FileNotFoundError:
+            return None
+    
     def delete_purchase(self, purchase_id: int) -> bool:
-        """Delete a purchase and its associated file"""
-        purchase = self.repository.get_purchase_by_id(purchase_id)
-        if purchase:
-            # Remove file if it exists
-            if purchase.receipt_path and os.path.exists(purchase.receipt_path):
-                os.remove(purchase.receipt_path)
-            
-            # Delete from database
-            return self.repository.delete_purchase(purchase_id)
-        return False
\ No newline at end of file
+        """Delete a purchase, then its receipt file unless other purchases share it"""
+        deleted, files, blobs = self.delete_purchases(ids=[purchase_id])
+        self.remove_receipts(files, blobs)
+        return deleted > 0
+    
+    def delete_purchases(
+        self,
+        ids: Optional[List[int]] = None,
+        params: Optional[PurchaseSearchParams] = None
+    ) -> Tuple[int, List[str], List[Tuple[str, str]]]:
+        """Delete purchases by id and/or filters, returning the count plus the receipt files and
+        released blobs to remove afterwards"""
+        deleted_ids, files, blobs = self.repository.delete_purchases(ids=ids, params=params)
+        if self.cache is not None:
+            self.cache.invalidate(deleted_ids)
+        return len(deleted_ids), files, blobs
+    
+    def remove_receipts(self, locations: List[str], blobs: Sequence[Tuple[str, str]] = ()) -> None:
+        """Remove receipt files of deleted purchases, once their rows are committed; released blobs
+        are kept if their content was uploaded again meanwhile"""
+        self.storage.delete_many(locations)
+        for sha256, path in blobs:
+            self._remove_released_blob(sha256, path)
+    
+    def _remove_released_blob(self, sha256: str, path: str) -> bool:
+        """Remove a blob whose last reference was dropped and committed, unless its content was
+        referenced again since; returns whether the file was removed"""
+        if not self.repository.claim_released_blob(sha256, path):
+            return False
+        try:
+            self._remove_file(path)
+        except Exception:
+            self.repository.finish_blob_removal(sha256, removed=False)
+            raise
+        self.repository.finish_blob_removal(sha256)
+        return True
+    
+    def get_changes(self, since: Optional[int] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+        """Purchases written and deleted after change number `since`, oldest first;
+        without `since`, just the change number to follow on from"""
+        version = self.repository.get_table_version()
+        if since is None or version <= since:
+            return self._change_page([], version if since is None else since)
+        if since < int(self.repository.get_checkpoint(TOMBSTONE_HORIZON) or 0):
+            # Deletes the client has not seen were pruned: it must reload, then follow on from here
+            return self._change_page([], version, reset=True)
+        limit = self._change_limit(limit)
+        upserts, deletes = self.repository.get_changes(since, version, limit + 1)
+        return self._merge_changes(upserts, deletes, limit, version)
+
+    @staticmethod
+    def _change_limit(limit: Optional[int]) -> int:
+        """Page size asked for, capped at CHANGES_MAX_LIMIT"""
+        return min(limit or config.CHANGES_MAX_LIMIT, config.CHANGES_MAX_LIMIT)
+
+    @staticmethod
+    def _change_page(
+        changes: List[Dict[str, Any]],
+        next_seq: int,
+        more: bool = False,
+        reset: bool = False
+    ) -> Dict[str, Any]:
+        """Change feed response: the changes, the number to follow on from and the more/reset flags"""
+        return {"changes": changes, "next": next_seq, "more": more, "reset": reset}
+    
+    @classmethod
+    def _merge_changes(cls, upserts: List, deletes: List, limit: int, version: int) -> Dict[str, Any]:
+        """Interleave written and deleted purchases in change order, cut to one page"""
+        # Each list holds up to limit + 1 rows, so the first `limit` merged ones are complete
+        changes = heapq.merge(
+            ({"seq": row.version, "op": "upsert", "id": row.id, "purchase": row_to_dict(PURCHASE_FIELDS, row)}
+             for row in upserts),
+            ({"seq": row.version, "op": "delete", "id": row.id} for row in deletes),
+            key=itemgetter("seq")
+        )
+        page = list(islice(changes, limit + 1))
+        more = len(page) > limit
+        page = page[:limit]
+        # The scans stopped at the version read before querying, so a page that is not full
+        # holds every change up to it; a full one may only be followed on from its last entry
+        return cls._change_page(page, page[-1]["seq"] if more else version, more=more)
+    
+    def migrate_receipts(self, workers: int = 8, batch_size: int = 500) -> int:
+        """Move receipts stored flat in the upload folder into the storage backend's layout"""
+        flat = sorted(
+            entry.path for entry in os.scandir(config.UPLOAD_FOLDER)
+            if entry.is_file() and entry.name.endswith(".pdf")
+        )
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(flat), batch_size):
+                moves = {path: self.storage.location(os.path.basename(path))
+                         for path in flat[start:start + batch_size]}
+                # Repoint the rows before moving: an interrupted run leaves the rest
+                # of the batch flat, and running again moves it to the same locations
+                self.repository.relocate_receipts(moves)
+                list(pool.map(self.storage.import_file, moves.keys(), moves.values()))
+        if flat and self.cache is not None:
+            # Cached purchases still point at the old receipt paths; only a shared (Redis) cache
+            # reaches the API workers, so manage.py refuses to run against per-worker caches
+            self.cache.clear()
+        return len(flat)
+
+    def reconcile_receipts(
+        self,
+        fix: bool = False,
+        limit: int = 100000,
+        grace: float = 3600,
+        workers: int = 8
+    ) -> Dict[str, Any]:
+        """Check up to `limit` stored files, purchases and receipt blobs each, from where the last run stopped"""
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return {
+                "files": self._reconcile_files(fix, limit, time.time() - grace),
+                "purchases": self._reconcile_purchases(limit, pool),
+                "blobs": self._reconcile_blobs(fix, limit),
+            }
+    
+    def _reconcile_files(self, fix: bool, limit: int, cutoff: float) -> Dict[str, Any]:
+        """Find (and with `fix`, remove) stored files no row references, ignoring ones newer than `cutoff`"""
+        after = self.repository.get_checkpoint("reconcile_files")
+        files = self.storage.iter_receipts(after)
+        scanned, orphaned = 0, []
+        # Uploads in flight are written before their row is committed, hence the grace period
+        while batch := list(islice(files, min(RECONCILE_BATCH_SIZE, limit - scanned))):
+            referenced = self.repository.referenced_receipts([location for location, _ in batch])
+            for location, modified in batch:
+                if location not in referenced and modified < cutoff:
+                    orphaned.append(location)
+                    if fix:
+                        self._remove_file(location)
+            scanned += len(batch)
+            after = batch[-1][0]
+        complete = scanned < limit
+        self.repository.save_checkpoint("reconcile_files", None if complete else after)
+        return {"scanned": scanned, "orphaned": orphaned, "complete": complete}
+    
+    def _reconcile_purchases(self, limit: int, pool: ThreadPoolExecutor) -> Dict[str, Any]:
+        """Find purchases whose receipt file is missing; they are only reported, never deleted"""
+        after = int(self.repository.get_checkpoint("reconcile_purchases") or 0)
+        scanned, dangling = 0, []
+        while scanned < limit:
+            rows = self.repository.get_receipt_paths(after, min(RECONCILE_BATCH_SIZE, limit - scanned))
+            if not rows:
+                break
+            paths = [row.receipt_path for row in rows if row.receipt_path]
+            # Existence checks are HEAD requests on S3, so run them in parallel
+            missing = {path for path, exists in zip(paths, pool.map(self.storage.exists, paths)) if not exists}
+            dangling.extend(row.id for row in rows if row.receipt_path in missing)
+            scanned += len(rows)
+            after = rows[-1].id
+        complete = scanned < limit
+        self.repository.save_checkpoint("reconcile_purchases", None if complete else str(after))
+        return {"scanned": scanned, "dangling": dangling, "complete": complete}
+    
+    def _reconcile_blobs(self, fix: bool, limit: int) -> Dict[str, Any]:
+        """Find (and with `fix`, correct) receipt blobs whose ref_count disagrees with their purchases"""
+        after = self.repository.get_checkpoint("reconcile_blobs") or ""
+        scanned, miscounted = 0, []
+        while scanned < limit:
+            rows = self.repository.get_receipt_blob_refs(after, min(RECONCILE_BATCH_SIZE, limit - scanned))
+            if not rows:
+                break
+            wrong = [row for row in rows if row.ref_count != row.references]
+            miscounted.extend(
+                {"sha256": row.sha256, "ref_count": row.ref_count, "references": row.references} for row in wrong
+            )
+            if fix and wrong:
+                for blob in self.repository.recount_receipt_blobs([row.sha256 for row in wrong]):
+                    if not blob.references:
+                        self._remove_released_blob(blob.sha256, blob.path)
+            scanned += len(rows)
+            after = rows[-1].sha256
+        complete = scanned < limit
+        self.repository.save_checkpoint("reconcile_blobs", None if complete else after)
+        return {"scanned": scanned, "miscounted": miscounted, "complete": complete}
+    
+    def reset_reconciliation(self) -> None:
+        """Make the next reconciliation run start from the beginning"""
+        for name in ("reconcile_files", "reconcile_purchases", "reconcile_blobs"):
+            self.repository.save_checkpoint(name, None)
+    
+    def prune_tombstones(self, days: float) -> int:
+        """Drop deletes older than `days` from the change feed; clients following from before them must reload"""
+        before = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=days)
+        return self.repository.prune_tombstones(before, TOMBSTONE_HORIZON)
+
+class AsyncPurchaseService(PurchaseService):
+    """Purchase business logic on an async repository, with file I/O kept off the event loop"""
+    
+    repository: AsyncPurchaseRepository
+    
+    async def upload_purchase(self, purchase_data: PurchaseCreate, receipt_file: UploadFile) -> dict:
+        """Handle purchase upload with file storage"""
+        receipt = None
+        try:
+            receipt = await run_in_threadpool(self._save_receipt, receipt_file.file)
+            if config.RECEIPT_STORAGE == "content":
+                receipt, = await self._share_receipts([receipt])
+            purchase = await self.repository.create_purchase(purchase_data, receipt.path, receipt.sha256)
+            return self._upload_result(purchase.id, receipt)
+        except Exception:
+            # Clean up file if database operation fails
+            if receipt and not receipt.shared:
+                await run_in_threadpool(self._remove_file, receipt.path)
+            raise
+    
+    async def bulk_upload_purchases(
+        self,
+        manifest: UploadFile,
+        receipts: Optional[UploadFile] = None
+    ) -> dict:
+        """Validate a manifest, store its receipts and insert all valid rows at once"""
+        archive = await run_in_threadpool(zipfile.ZipFile, receipts.file) if receipts else None
+        try:
+            results, valid = await run_in_threadpool(self._validate_manifest, manifest, archive)
+            stored = await run_in_threadpool(self._extract_receipts, archive, valid, results)
+            try:
+                if config.RECEIPT_STORAGE == "content":
+                    stored = self._with_receipts(stored, await self._share_receipts(self._receipts(stored)))
+                ids = await self.repository.bulk_create_purchases(self._bulk_rows(stored))
+            except Exception:
+                await run_in_threadpool(self._remove_files, stored)
+                raise
+        finally:
+            if archive:
+                archive.close()
+        
+        return self._bulk_result(results, ids, stored)
+    
+    async def _share_receipts(self, receipts: List[StoredReceipt]) -> List[StoredReceipt]:
+        """Reference content-addressed blobs for freshly saved receipts, keeping one file per content"""
+        if not receipts:
+            return []
+        await self.repository.acquire_receipt_blobs(self._blob_refs(receipts))
+        return await run_in_threadpool(self._move_to_blobs, receipts)
+    
+    async def search_purchases(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        fields: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Search purchases and return one page of serializable rows"""
+        limit = self._page_limit(limit)
+        after = self._decode_cursor(cursor) if cursor else None
+        fields = self._parse_fields(fields)
+        rows = await self.repository.search_purchases(
+            params, after=after, limit=limit + 1, fields=self._with_keyset(fields)
+        )
+        return self._page(rows, fields, limit)
+    
+    async def search_etag(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        fields: Optional[str] = None,
+        response_class: type = ORJSONResponse
+    ) -> str:
+        """Strong ETag of a search page: the purchases table version plus a digest of the normalized query"""
+        version = await self.repository.get_table_version()
+        return self._search_etag(version, params, cursor, limit, fields, response_class)
+    
+    async def render_search_page(
+        self,
+        params: PurchaseSearchParams,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        fields: Optional[str] = None,
+        response_class: type = ORJSONResponse,
+        etag: Optional[str] = None
+    ) -> bytes:
+        """One search page serialized by `response_class`, served from the search cache when enabled"""
+        if self.search_cache is None:
+            return response_class(await self.search_purchases(params, cursor, limit, fields)).body
+        key = etag or await self.search_etag(params, cursor, limit, fields, response_class)
+        body = await self._cache_call(self.search_cache, "get", key)
+        if body is None:
+            body = response_class(await self.search_purchases(params, cursor, limit, fields)).body
+            await self._cache_call(self.search_cache, "add", key, body)
+        return body
+    
+    async def stream_purchases(
+        self,
+        params: PurchaseSearchParams,
+        fields: Optional[str] = None
+    ) -> AsyncIterator[bytes]:
+        """Return an async iterator yielding one chunk of NDJSON lines per batch"""
+        fields = self._parse_fields(fields)
+        return self._ndjson_chunks(self.repository.iter_purchase_batches(params, fields=fields), fields)
+    
+    @staticmethod
+    async def _ndjson_chunks(batches: AsyncIterator[List], fields: Tuple[str, ...]) -> AsyncIterator[bytes]:
+        """Encode each batch of rows as one chunk of NDJSON lines"""
+        async for batch in batches:
+            yield b"".join(dumps_json(row_to_dict(fields, row)) + b"\n" for row in batch)
+    
+    async def get_stats(self, params: PurchaseSearchParams) -> PurchaseStats:
+        """Get aggregate statistics for purchases matching the filters"""
+        stats = await self.repository.get_stats(params, today=datetime.date.today())
+        return PurchaseStats(**stats._asdict())
+    
+    async def get_daily_series(
+        self,
+        dimension: RollupDimension = RollupDimension.PRODUCT,
+        group: bool = False,
+        key: Optional[str] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None
+    ) -> List[Dict[str, Any]]:
+        """Get a daily spend time series from the rollup tables"""
+        rows = await self.repository.get_daily_rollups(
+            dimension, group=group, key=key, date_from=date_from, date_to=date_to
+        )
+        return rows_to_dicts(self._daily_fields(group), rows)
+    
+    async def export_purchases(
+        self,
+        params: PurchaseSearchParams,
+        export_format: ExportFormat = ExportFormat.CSV,
+        fields: Optional[str] = None
+    ) -> AsyncIterator[bytes]:
+        """Return an async iterator encoding every matching purchase as CSV or Parquet"""
+        fields = self._parse_fields(fields)
+        encoder = self._export_encoder(export_format, fields)
+        batches = self.repository.iter_purchase_batches(
+            params, batch_size=encoder.batch_size, fields=fields
+        )
+        return aiter_encoded(encoder, batches)
+    
+    async def export_receipts(self, params: PurchaseSearchParams) -> AsyncIterator[bytes]:
+        """Return an async iterator streaming a ZIP of every matching purchase's receipt plus a manifest"""
+        writer = self._receipt_writer()
+        batches = self.repository.iter_purchase_batches(params, batch_size=writer.batch_size)
+        return aiter_archive(writer, batches)
+    
+    async def get_purchase_by_id(
+        self,
+        purchase_id: int,
+        fields: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Get a single purchase by ID"""
+        found = await self.get_versioned_purchase(purchase_id, fields=fields)
+        return found[0] if found else None
+    
+    async def get_versioned_purchase(
+        self,
+        purchase_id: int,
+        fields: Optional[str] = None
+    ) -> Optional[Tuple[Dict[str, Any], int]]:
+        """Get a single purchase by ID with its row version, through the purchase cache when enabled"""
+        fields = self._parse_fields(fields)
+        if self.cache is None:
+            row = await self.repository.get_purchase_row(purchase_id, fields=fields + ("version",))
+            return (row_to_dict(fields, row), row.version) if row else None
+        purchase = await self._cache_call(self.cache, "get", purchase_id)
+        if purchase is None:
+            # Whole rows, shared by every projection, as in the sync service
+            row = await self.repository.get_purchase_row(purchase_id, fields=VERSIONED_FIELDS)
+            if not row:
+                return None
+            purchase = row_to_dict(VERSIONED_FIELDS, row)
+            await self._cache_call(self.cache, "add", purchase_id, purchase)
+        return self._project(purchase, fields), purchase["version"]
+    
+    @staticmethod
+    async def _cache_call(cache: Cache, method: str, *args) -> Any:
+        """Call a cache method, in the threadpool when it does network I/O"""
+        if cache.blocking:
+            return await run_in_threadpool(getattr(cache, method), *args)
+        return getattr(cache, method)(*args)
+    
+    async def get_receipt(self, purchase_id: int) -> Optional[ReceiptDownload]:
+        """Locate a purchase's receipt for download"""
+        row = await self.repository.get_purchase_row(purchase_id, fields=("receipt_path", "receipt_sha256"))
+        if row and row.receipt_path:
+            return await run_in_threadpool(self._receipt_download, row.receipt_path, row.receipt_sha256)
+        return None
+    
+    async def delete_purchase(self, purchase_id: int) -> bool:
+        """Delete a purchase, then its receipt file unless other purchases share it"""
+        deleted, files, blobs = await self.delete_purchases(ids=[purchase_id])
+        await self.remove_receipts(files, blobs)
+        return deleted > 0
+    
+    async def delete_purchases(
+        self,
+        ids: Optional[List[int]] = None,
+        params: Optional[PurchaseSearchParams] = None
+    ) -> Tuple[int, List[str], List[Tuple[str, str]]]:
+        """Delete purchases by id and/or filters, returning the count plus the receipt files and
+        released blobs to remove afterwards"""
+        deleted_ids, files, blobs = await self.repository.delete_purchases(ids=ids, params=params)
+        if self.cache is not None:
+            await self._cache_call(self.cache, "invalidate", deleted_ids)
+        return len(deleted_ids), files, blobs
+    
+    async def remove_receipts(self, locations: List[str], blobs: Sequence[Tuple[str, str]] = ()) -> None:
+        """Remove receipt files of deleted purchases, once their rows are committed; released blobs
+        are kept if their content was uploaded again meanwhile"""
+        await run_in_threadpool(self.storage.delete_many, locations)
+        for sha256, path in blobs:
+            await self._remove_released_blob(sha256, path)
+    
+    async def _remove_released_blob(self, sha256: str, path: str) -> bool:
+        """Remove a released blob unless its content was referenced again since, unlinking in the
+        threadpool while the claim's transaction stays open"""
+        if not await self.repository.claim_released_blob(sha256, path):
+            return False
+        try:
+            await run_in_threadpool(self._remove_file, path)
+        except Exception:
+            await self.repository.finish_blob_removal(sha256, removed=False)
+            raise
+        await self.repository.finish_blob_removal(sha256)
+        return True
+    
+    async def get_changes(self, since: Optional[int] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+        """Purchases written and deleted after change number `since`, oldest first;
+        without `since`, just the change number to follow on from"""
+        version = await self.repository.get_table_version()
+        if since is None or version <= since:
+            return self._change_page([], version if since is None else since)
+        if since < int(await self.repository.get_checkpoint(TOMBSTONE_HORIZON) or 0):
+            return self._change_page([], version, reset=True)
+        limit = self._change_limit(limit)
+        upserts, deletes = await self.repository.get_changes(since, version, limit + 1)
+        return self._merge_changes(upserts, deletes, limit, version)
@@ -0,0 +1,251 @@
+"""
+Receipt storage backends: a sharded local directory tree or an S3-compatible bucket
+"""
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from config import config
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+import hashlib
+import io
+import os
+
+class ReceiptStorage(ABC):
+    """Interface of receipt storage backends; receipts are addressed by the location they were stored at"""
+
+    @abstractmethod
+    def location(self, name: str) -> str:
+        """Location a receipt file with this name is stored at"""
+
+    @abstractmethod
+    def write(self, location: str, chunks: Iterable[bytes]) -> None:
+        """Write a receipt from an iterable of chunks"""
+
+    @abstractmethod
+    def exists(self, location: str) -> bool:
+        """Whether a receipt is stored at `location`"""
+
+    @abstractmethod
+    def move(self, source: str, target: str) -> None:
+        """Move a stored receipt, replacing any receipt at `target`"""
+
+    @abstractmethod
+    def delete(self, location: str) -> None:
+        """Remove a stored receipt if it exists"""
+
+    def delete_many(self, locations: Iterable[str]) -> None:
+        """Remove several stored receipts, skipping missing ones"""
+        for location in locations:
+            self.delete(location)
+
+    @abstractmethod
+    def open(self, location: str) -> BinaryIO:
+        """Open a stored receipt for reading; raises FileNotFoundError when it is missing"""
+
+    @abstractmethod
+    def import_file(self, path: str, location: str) -> None:
+        """Move a file from the local filesystem into storage"""
+
+    @abstractmethod
+    def presigned_url(self, location: str) -> Optional[str]:
+        """Temporary URL clients can download the receipt from directly, if the backend has one"""
+
+    @abstractmethod
+    def iter_receipts(self, after: Optional[str] = None) -> Iterator[Tuple[str, float]]:
+        """(location, modification timestamp) of every stored receipt past `after`, in location order"""
+
+    @staticmethod
+    def shard(name: str, depth: int = 2, width: int = 2) -> Tuple[str, ...]:
+        """Hashed subdirectories spreading names evenly, e.g. ('3f', 'a2')"""
+        digest = hashlib.sha256(name.encode()).hexdigest()
+        return tuple(digest[i * width:(i + 1) * width] for i in range(depth))
+
+class LocalStorage(ReceiptStorage):
+    """Receipts on the local filesystem, fanned out into <root>/ab/cd/<name> subdirectories"""
+
+    def __init__(self, root: str, depth: int = 2):
+        self.root = root
+        self.depth = depth
+        os.makedirs(root, exist_ok=True)
+
+    def location(self, name: str) -> str:
+        return os.path.join(self.root, *self.shard(name, self.depth), name)
+
+    def write(self, location: str, chunks: Iterable[bytes]) -> None:
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def exists(self, location: str) -> bool:
+        return os.path.exists(location)
+
+    def move(self, source: str, target: str) -> None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+
+    def delete(self, location: str) -> None:
+        if os.path.exists(location):
+            os.remove(location)
+
+    def open(self, location: str) -> BinaryIO:
+        return open(location, "rb")
+
+    def import_file(self, path: str, location: str) -> None:
+        self.move(path, location)
+
+    def presigned_url(self, location: str) -> Optional[str]:
+        # Served from disk by the API instead
+        return None
+
+    def iter_receipts(self, after: Optional[str] = None) -> Iterator[Tuple[str, float]]:
+        return self._walk(self.root, after)
+
+    def _walk(self, directory: str, after: Optional[str]) -> Iterator[Tuple[str, float]]:
+        """Depth-first walk in string order of the full paths, skipping subtrees before `after`"""
+        # A directory's files compare like "<name>/...", so sort it with its separator
+        entries = sorted(os.scandir(directory), key=lambda e: e.name + os.sep if e.is_dir() else e.name)
+        for entry in entries:
+            if entry.is_dir():
+                prefix = entry.path + os.sep
+                if after is None or prefix > after or after.startswith(prefix):
+                    yield from self._walk(entry.path, after)
+            elif entry.name.endswith(".pdf") and (after is None or entry.path > after):
+                yield entry.path, entry.stat().st_mtime
+
+class _ChunkReader(io.RawIOBase):
+    """Readable file object over an iterable of chunks, for streaming uploads"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            self._pending = next(self._chunks, b"")
+            if not self._pending:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+class S3Storage(ReceiptStorage):
+    """Receipts in an S3-compatible bucket (AWS S3, MinIO, ...), located as s3://<bucket>/<key>"""
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None
+    ):
+        import boto3
+        from botocore.exceptions import ClientError
+
+        self.bucket = bucket
+        self.prefix = prefix
+        # Credentials come from the usual AWS environment variables or config files
+        self._client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self._client_error = ClientError
+
+    def location(self, name: str) -> str:
+        # Hashed key prefixes spread the load over the bucket's partitions
+        return f"s3://{self.bucket}/{self.prefix}{'/'.join(self.shard(name))}/{name}"
+
+    def _split(self, location: str) -> Tuple[str, str]:
+        """Bucket and key of an s3:// location"""
+        if not location.startswith("s3://"):
+            raise ValueError(f"Not an S3 location: {location}")
+        bucket, _, key = location[len("s3://"):].partition("/")
+        return bucket, key
+
+    def write(self, location: str, chunks: Iterable[bytes]) -> None:
+        bucket, key = self._split(location)
+        # upload_fileobj switches to a multipart upload for large receipts
+        self._client.upload_fileobj(
+            io.BufferedReader(_ChunkReader(chunks)), bucket, key,
+            ExtraArgs={"ContentType": "application/pdf"}
+        )
+
+    def exists(self, location: str) -> bool:
+        bucket, key = self._split(location)
+        try:
+            self._client.head_object(Bucket=bucket, Key=key)
+        except self._client_error as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def move(self, source: str, target: str) -> None:
+        source_bucket, source_key = self._split(source)
+        target_bucket, target_key = self._split(target)
+        self._client.copy(
+            {"Bucket": source_bucket, "Key": source_key}, target_bucket, target_key
+        )
+        self._client.delete_object(Bucket=source_bucket, Key=source_key)
+
+    def delete(self, location: str) -> None:
+        bucket, key = self._split(location)
+        # Deleting a missing key succeeds
+        self._client.delete_object(Bucket=bucket, Key=key)
+
+    def delete_many(self, locations: Iterable[str]) -> None:
+        keys: Dict[str, List[str]] = {}
+        for location in locations:
+            bucket, key = self._split(location)
+            keys.setdefault(bucket, []).append(key)
+        # DeleteObjects takes up to 1000 keys per request
+        for bucket, bucket_keys in keys.items():
+            for start in range(0, len(bucket_keys), 1000):
+                self._client.delete_objects(Bucket=bucket, Delete={
+                    "Objects": [{"Key": key} for key in bucket_keys[start:start + 1000]],
+                    "Quiet": True
+                })
+
+    def open(self, location: str) -> BinaryIO:
+        bucket, key = self._split(location)
+        try:
+            return self._client.get_object(Bucket=bucket, Key=key)["Body"]
+        except self._client_error as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                raise FileNotFoundError(location) from e
+            raise
+
+    def import_file(self, path: str, location: str) -> None:
+        bucket, key = self._split(location)
+        self._client.upload_file(path, bucket, key, ExtraArgs={"ContentType": "application/pdf"})
+        os.remove(path)
+
+    def iter_receipts(self, after: Optional[str] = None) -> Iterator[Tuple[str, float]]:
+        # S3 lists keys in order, resuming after a key
+        start_after = self._split(after)[1] if after else ""
+        pages = self._client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=self.prefix, StartAfter=start_after
+        )
+        for page in pages:
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(".pdf"):
+                    yield f"s3://{self.bucket}/{item['Key']}", item["LastModified"].timestamp()
+
+    def presigned_url(self, location: str) -> Optional[str]:
+        bucket, key = self._split(location)
+        # S3 itself then answers Range and conditional requests
+        return self._client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=config.S3_URL_EXPIRY
+        )
+
+@lru_cache(maxsize=None)
+def get_storage() -> ReceiptStorage:
+    """The receipt storage backend selected by RECEIPT_BACKEND, shared by every request"""
+    if config.RECEIPT_BACKEND == "s3":
+        return S3Storage(
+            config.S3_BUCKET,
+            prefix=config.S3_PREFIX,
+            endpoint_url=config.S3_ENDPOINT_URL,
+            region=config.S3_REGION
+        )
+    return LocalStorage(config.UPLOAD_FOLDER, depth=config.RECEIPT_SHARD_DEPTH)
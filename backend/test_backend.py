@@ -0,0 +1,1432 @@
+"""
+Regression tests for backend data handling, run against a throwaway SQLite database.
+"""
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+from decimal import Decimal
+import argparse
+import asyncio
+import contextlib
+import csv
+import datetime
+import fnmatch
+import hashlib
+import importlib.util
+import io
+import sys
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+# Configure a scratch database and upload folder before the backend modules read the environment
+WORKDIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ["UPLOAD_FOLDER"] = os.path.join(WORKDIR, "uploads")
+os.environ["RECEIPT_STORAGE"] = "content"
+os.environ["PURCHASE_CACHE"] = "off"
+os.environ["SEARCH_CACHE"] = "off"
+
+# Add the backend directory to Python path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache import MemoryCache, RedisCache
+from config import config
+from database import SessionLocal, async_database_url, create_tables
+from export import EXPORT_HEADERS
+from model import (
+    PURCHASE_FIELDS, DailyCustomerRollupDB, DailyProductRollupDB, PurchaseCreate, PurchaseDB, PurchaseSearchParams,
+    ReceiptBlobDB
+)
+import manage
+from pool_metrics import PoolMetrics, instrumented_pool
+from repository import AsyncPurchaseRepository, PurchaseRepository
+from serialization import dumps_json
+from service import AsyncPurchaseService, PurchaseService
+from storage import LocalStorage, S3Storage
+from pydantic import ValidationError
+import orjson
+from sqlalchemy import create_engine, select, update
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import QueuePool
+
+create_tables()
+
+def purchase_data(**overrides) -> PurchaseCreate:
+    """A valid purchase, with any fields overridden"""
+    data = dict(
+        customer_name="John", customer_surname="Doe", customer_cf="RSSMRA80A01H501U",
+        credit_card="1234567890123456", product_name="Laptop", price="10.50", date=datetime.date(2025, 1, 1)
+    )
+    data.update(overrides)
+    return PurchaseCreate(**data)
+
+class TestReceiptBlobs(unittest.TestCase):
+    """Test cases for content-addressed receipt storage"""
+
+    def setUp(self):
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+
+    def tearDown(self):
+        self.db.close()
+
+    def upload(self, content: bytes) -> dict:
+        return self.service.upload_purchase(purchase_data(), Mock(file=io.BytesIO(content)))
+
+    def test_reupload_before_blob_removal_keeps_file(self):
+        """Test a blob released by a delete survives its deferred removal when uploaded again meanwhile"""
+        receipt = b"%PDF-1.4 reupload"
+        first = self.upload(receipt)
+        _, files, blobs = self.service.delete_purchases(ids=[first["purchase_id"]])
+        second = self.upload(receipt)
+
+        self.service.remove_receipts(files, blobs)
+
+        self.assertEqual(blobs, [(second["receipt_sha256"], second["receipt_path"])])
+        self.assertTrue(os.path.exists(second["receipt_path"]))
+
+    def test_released_blob_is_removed(self):
+        """Test the deferred removal unlinks a blob nothing references any more"""
+        first = self.upload(b"%PDF-1.4 released")
+        _, files, blobs = self.service.delete_purchases(ids=[first["purchase_id"]])
+
+        self.service.remove_receipts(files, blobs)
+
+        self.assertFalse(os.path.exists(first["receipt_path"]))
+
+    def test_delete_counts_blob_references_by_path(self):
+        """Test a unique-mode receipt with a blob's hash does not change the blob's decrement"""
+        uploads = [self.upload(b"%PDF-1.4 mixed") for _ in range(3)]
+        sha256 = uploads[0]["receipt_sha256"]
+        unique = self.service.repository.create_purchase(purchase_data(), "unique.pdf", sha256)
+
+        self.service.delete_purchases(ids=[uploads[0]["purchase_id"], uploads[1]["purchase_id"], unique.id])
+
+        ref_count = self.db.execute(select(ReceiptBlobDB.ref_count).where(ReceiptBlobDB.sha256 == sha256)).scalar()
+        self.assertEqual(ref_count, 1)
+
+class TestBulkDelete(unittest.TestCase):
+    """Test cases for the bulk delete endpoint"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_delete_by_filter_removes_rows_then_files(self):
+        """Test matching purchases are deleted and their receipts removed after the response; others stay"""
+        cf = "BLKDEL80A01H501U"
+        doomed = [
+            self.service.upload_purchase(
+                purchase_data(customer_cf=cf, product_name="Doomed"), Mock(file=io.BytesIO(content))
+            )
+            for content in (b"%PDF-1.4 doomed 1", b"%PDF-1.4 doomed 2")
+        ]
+        kept = self.service.upload_purchase(
+            purchase_data(customer_cf=cf, product_name="Kept"), Mock(file=io.BytesIO(b"%PDF-1.4 kept"))
+        )
+
+        response = self.client.delete("/purchases", params={"cf": cf, "product": "doomed"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["deleted"], 2)
+        for uploaded in doomed:
+            self.assertEqual(self.client.get(f"/purchase/{uploaded['purchase_id']}").status_code, 404)
+            self.assertFalse(os.path.exists(uploaded["receipt_path"]))
+        self.assertEqual(self.client.get(f"/purchase/{kept['purchase_id']}").status_code, 200)
+        self.assertTrue(os.path.exists(kept["receipt_path"]))
+
+    def test_delete_without_filters_is_refused(self):
+        """Test a bulk delete naming neither ids nor filters is refused instead of emptying the table"""
+        self.assertEqual(self.client.delete("/purchases").status_code, 400)
+
+@unittest.skipUnless(importlib.util.find_spec("aiosqlite"), "async mode on SQLite needs aiosqlite")
+class TestAsyncReceiptBlobs(unittest.TestCase):
+    """Test cases for receipt cleanup in async mode"""
+
+    def test_blob_unlink_runs_off_the_event_loop(self):
+        """Test a released blob is unlinked in the threadpool while its claim is held, not on the event loop"""
+        with SessionLocal() as db:
+            uploaded = PurchaseService(PurchaseRepository(db)).upload_purchase(
+                purchase_data(), Mock(file=io.BytesIO(b"%PDF-1.4 async cleanup"))
+            )
+
+        async def delete() -> tuple:
+            engine = create_async_engine(async_database_url(os.environ["DATABASE_URL"]))
+            try:
+                async with AsyncSession(engine, expire_on_commit=False) as db:
+                    service = AsyncPurchaseService(AsyncPurchaseRepository(db))
+                    _, files, blobs = await service.delete_purchases(ids=[uploaded["purchase_id"]])
+                    remove_file, threads = service._remove_file, []
+                    service._remove_file = lambda path: (threads.append(threading.get_ident()), remove_file(path))
+                    await service.remove_receipts(files, blobs)
+            finally:
+                await engine.dispose()
+            return threading.get_ident(), threads
+
+        loop_thread, threads = asyncio.run(delete())
+
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+        self.assertFalse(os.path.exists(uploaded["receipt_path"]))
+        with SessionLocal() as db:
+            self.assertIsNone(db.get(ReceiptBlobDB, uploaded["receipt_sha256"]))
+
+class TestReceiptStorage(unittest.TestCase):
+    """Test cases for the sharded receipt storage layout"""
+
+    def setUp(self):
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_local_layout(self):
+        """Test receipts are fanned out into hashed subdirectories and listed in location order, resumably"""
+        storage = LocalStorage(tempfile.mkdtemp(dir=WORKDIR), depth=2)
+        locations = [storage.location(f"{n}.pdf") for n in range(6)]
+        for location in locations:
+            storage.write(location, [b"%PDF-1.4 ", b"sharded"])
+
+        digest = hashlib.sha256(b"0.pdf").hexdigest()
+        self.assertEqual(locations[0], os.path.join(storage.root, digest[:2], digest[2:4], "0.pdf"))
+        listed = [location for location, _ in storage.iter_receipts()]
+        self.assertEqual(listed, sorted(locations))
+        self.assertEqual([location for location, _ in storage.iter_receipts(after=listed[2])], listed[3:])
+
+    def test_migrate_moves_flat_receipts(self):
+        """Test migrate-receipts moves flat upload-folder receipts into the layout and repoints their rows"""
+        flat = os.path.join(config.UPLOAD_FOLDER, "flat-migrate.pdf")
+        with open(flat, "wb") as f:
+            f.write(b"%PDF-1.4 flat")
+        purchase = self.service.repository.create_purchase(purchase_data(), flat)
+
+        self.assertGreaterEqual(self.service.migrate_receipts(workers=2), 1)
+
+        location = self.service.storage.location("flat-migrate.pdf")
+        self.assertNotEqual(location, flat)
+        self.assertFalse(os.path.exists(flat))
+        with open(location, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4 flat")
+        self.db.expire_all()
+        self.assertEqual(self.service.repository.get_purchase_row(purchase.id).receipt_path, location)
+
+@unittest.skipUnless(importlib.util.find_spec("boto3"), "S3 storage needs boto3")
+class TestS3Storage(unittest.TestCase):
+    """Test cases for the S3 receipt storage, against a stubbed client"""
+
+    def setUp(self):
+        from botocore.stub import Stubber
+
+        credentials = {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test"}
+        with patch.dict(os.environ, credentials):
+            self.storage = S3Storage("receipts", prefix="shop/", region="eu-south-1")
+        self.stubber = Stubber(self.storage._client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def test_write_open_delete(self):
+        """Test receipts are uploaded under sharded keys, read back, checked and deleted"""
+        from botocore.response import StreamingBody
+
+        location = self.storage.location("a.pdf")
+        key = f"shop/{'/'.join(self.storage.shard('a.pdf'))}/a.pdf"
+        content = b"%PDF-1.4 in s3"
+        uploads = []
+        self.storage._client.meta.events.register(
+            "before-parameter-build.s3.PutObject", lambda params, **kwargs: uploads.append(dict(params))
+        )
+        stub = self.stubber.add_response
+        stub("put_object", {})
+        stub("get_object", {"Body": StreamingBody(io.BytesIO(content), len(content))},
+             {"Bucket": "receipts", "Key": key})
+        stub("head_object", {}, {"Bucket": "receipts", "Key": key})
+        stub("delete_object", {}, {"Bucket": "receipts", "Key": key})
+        self.stubber.add_client_error("head_object", "404", expected_params={"Bucket": "receipts", "Key": key})
+        self.stubber.add_client_error("get_object", "NoSuchKey", expected_params={"Bucket": "receipts", "Key": key})
+
+        self.assertEqual(location, f"s3://receipts/{key}")
+        self.storage.write(location, [b"%PDF-1.4 ", b"in s3"])
+        (upload,) = uploads
+        self.assertEqual((upload["Bucket"], upload["Key"], upload["ContentType"]), ("receipts", key, "application/pdf"))
+        with self.storage.open(location) as body:
+            self.assertEqual(body.read(), content)
+        self.assertTrue(self.storage.exists(location))
+        self.storage.delete(location)
+        self.assertFalse(self.storage.exists(location))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(location)
+        self.stubber.assert_no_pending_responses()
+
+    def test_delete_many_in_batches(self):
+        """Test bulk deletes are sent at most 1000 keys per request"""
+        keys = [f"shop/{n}.pdf" for n in range(1001)]
+        for batch in (keys[:1000], keys[1000:]):
+            self.stubber.add_response("delete_objects", {}, {
+                "Bucket": "receipts", "Delete": {"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            })
+
+        self.storage.delete_many(f"s3://receipts/{key}" for key in keys)
+
+        self.stubber.assert_no_pending_responses()
+
+    def test_iter_receipts_pages(self):
+        """Test listing follows continuation tokens, skips non-PDF keys and resumes after a location"""
+        modified = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+        listing = {"Bucket": "receipts", "Prefix": "shop/", "StartAfter": "shop/aa/a.pdf"}
+        self.stubber.add_response("list_objects_v2", {
+            "Contents": [{"Key": "shop/ab/b.pdf", "LastModified": modified},
+                         {"Key": "shop/ab/notes.txt", "LastModified": modified}],
+            "IsTruncated": True, "NextContinuationToken": "page-2",
+        }, listing)
+        self.stubber.add_response("list_objects_v2", {
+            "Contents": [{"Key": "shop/cd/c.pdf", "LastModified": modified}], "IsTruncated": False,
+        }, {**listing, "ContinuationToken": "page-2"})
+
+        receipts = list(self.storage.iter_receipts(after="s3://receipts/shop/aa/a.pdf"))
+
+        self.assertEqual(receipts, [("s3://receipts/shop/ab/b.pdf", modified.timestamp()),
+                                    ("s3://receipts/shop/cd/c.pdf", modified.timestamp())])
+        self.stubber.assert_no_pending_responses()
+
+class TestReceiptDownload(unittest.TestCase):
+    """Test cases for the receipt download endpoint"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+        self.receipt = b"%PDF-1.4 " + bytes(range(256))
+        self.uploaded = self.service.upload_purchase(purchase_data(), Mock(file=io.BytesIO(self.receipt)))
+        self.url = f"/purchase/{self.uploaded['purchase_id']}/receipt"
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_range_request(self):
+        """Test a Range request gets 206 with just the requested bytes"""
+        response = self.client.get(self.url, headers={"range": "bytes=5-14"})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.receipt[5:15])
+        self.assertEqual(response.headers["content-range"], f"bytes 5-14/{len(self.receipt)}")
+
+    def test_full_download_and_revalidation(self):
+        """Test a full download carries the content hash as ETag, which If-None-Match answers with 304"""
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.receipt)
+        self.assertEqual(response.headers["content-type"], "application/pdf")
+        self.assertEqual(response.headers["etag"], f'"{self.uploaded["receipt_sha256"]}"')
+
+        revalidated = self.client.get(self.url, headers={"if-none-match": response.headers["etag"]})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.content, b"")
+
+    def test_head_request(self):
+        """Test HEAD reports the receipt's length without a body"""
+        response = self.client.head(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response.headers["content-length"]), len(self.receipt))
+        self.assertEqual(response.content, b"")
+
+    def test_missing_receipt(self):
+        """Test an unknown purchase or a receipt missing from storage gets 404"""
+        os.remove(self.uploaded["receipt_path"])
+
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get("/purchase/0/receipt").status_code, 404)
+
+class TestExport(unittest.TestCase):
+    """Test cases for the CSV and Parquet purchase exports"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def create(self, cf: str) -> list:
+        """Two purchases for `cf` plus one for another customer, returning the matches' ids newest first"""
+        older = self.repository.create_purchase(purchase_data(customer_cf=cf, date=datetime.date(2025, 1, 1)), "a.pdf")
+        newer = self.repository.create_purchase(
+            purchase_data(customer_cf=cf, date=datetime.date(2025, 2, 1), price="7.25"), "b.pdf"
+        )
+        self.repository.create_purchase(purchase_data(customer_cf="OTHERS80A01H501U"), "c.pdf")
+        return [newer.id, older.id]
+
+    def test_csv(self):
+        """Test the CSV export lists the filtered purchases newest first under the column headers"""
+        cf = "CSVXPT80A01H501U"
+        ids = self.create(cf)
+
+        response = self.client.get("/export", params={"cf": cf})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/csv"))
+        self.assertIn('filename="purchases_export.csv"', response.headers["content-disposition"])
+        header, *rows = csv.reader(io.StringIO(response.text))
+        self.assertEqual(header, [EXPORT_HEADERS[field] for field in PURCHASE_FIELDS])
+        self.assertEqual([int(row[0]) for row in rows], ids)
+        self.assertEqual(dict(zip(PURCHASE_FIELDS, rows[0])), {
+            "id": str(ids[0]), "customer_name": "John", "customer_surname": "Doe", "customer_cf": cf,
+            "credit_card": "1234567890123456", "product_name": "Laptop", "price": "7.25", "date": "2025-02-01",
+            "receipt_path": "b.pdf", "receipt_sha256": "",
+        })
+
+    def test_csv_fields_and_empty_result(self):
+        """Test the CSV export keeps the requested column order and sends only headers when nothing matches"""
+        cf = "CSVFLD80A01H501U"
+        ids = self.create(cf)
+
+        rows = list(csv.reader(io.StringIO(self.client.get("/export", params={"cf": cf, "fields": "price,id"}).text)))
+        empty = list(csv.reader(io.StringIO(self.client.get("/export", params={"cf": "NOBODY80A01H501U"}).text)))
+
+        self.assertEqual(rows, [["Price", "ID"], ["7.25", str(ids[0])], ["10.50", str(ids[1])]])
+        self.assertEqual(empty, [[EXPORT_HEADERS[field] for field in PURCHASE_FIELDS]])
+        self.assertEqual(self.client.get("/export", params={"fields": "id,secret"}).status_code, 400)
+
+    def test_parquet(self):
+        """Test the Parquet export types ids, prices and dates and reads back the filtered purchases"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        cf = "PQTXPT80A01H501U"
+        ids = self.create(cf)
+
+        response = self.client.get("/export", params={"cf": cf, "format": "parquet"})
+        empty = self.client.get("/export", params={"cf": "NOBODY80A01H501U", "format": "parquet", "fields": "id,date"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/vnd.apache.parquet")
+        table = pq.read_table(io.BytesIO(response.content))
+        self.assertEqual(table.schema.names, list(PURCHASE_FIELDS))
+        self.assertEqual(table.schema.field("id").type, pa.int64())
+        self.assertEqual(table.schema.field("price").type, pa.decimal128(10, 2))
+        self.assertEqual(table.schema.field("date").type, pa.date32())
+        self.assertEqual(table.schema.field("customer_cf").type, pa.string())
+        self.assertEqual(table.column("id").to_pylist(), ids)
+        self.assertEqual(table.column("price").to_pylist(), [Decimal("7.25"), Decimal("10.50")])
+        self.assertEqual(table.column("date").to_pylist(), [datetime.date(2025, 2, 1), datetime.date(2025, 1, 1)])
+        empty_table = pq.read_table(io.BytesIO(empty.content))
+        self.assertEqual((empty_table.num_rows, empty_table.schema.names), (0, ["id", "date"]))
+
+class TestReceiptExport(unittest.TestCase):
+    """Test cases for the receipt ZIP export"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_zip_of_search_results(self):
+        """Test the archive holds each match's receipt and a manifest marking missing files"""
+        cf = "ZIPXPT80A01H501U"
+        receipts = {}
+        for content in (b"%PDF-1.4 zip 1", b"%PDF-1.4 zip 2"):
+            uploaded = self.service.upload_purchase(purchase_data(customer_cf=cf), Mock(file=io.BytesIO(content)))
+            receipts[uploaded["purchase_id"]] = content
+        missing = self.service.repository.create_purchase(purchase_data(customer_cf=cf), "gone.pdf").id
+
+        response = self.client.get("/export/receipts", params={"cf": cf})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/zip")
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                ["manifest.csv"] + sorted(f"receipts/{purchase_id}.pdf" for purchase_id in receipts)
+            )
+            for purchase_id, content in receipts.items():
+                self.assertEqual(archive.read(f"receipts/{purchase_id}.pdf"), content)
+            manifest = list(csv.DictReader(io.StringIO(archive.read("manifest.csv").decode())))
+        statuses = {int(row["ID"]): (row["Receipt File"], row["Receipt Status"]) for row in manifest}
+        self.assertEqual(statuses, {
+            **{purchase_id: (f"receipts/{purchase_id}.pdf", "ok") for purchase_id in receipts},
+            missing: ("", "missing"),
+        })
+
+    def test_zip_with_dates_outside_zip_range(self):
+        """Test receipts dated before 1980 or after 2107 are archived with the nearest ZIP date"""
+        cf = "ZIPOLD80A01H501U"
+        for date in (datetime.date(1975, 6, 1), datetime.date(2150, 1, 1)):
+            self.service.upload_purchase(
+                purchase_data(customer_cf=cf, date=date), Mock(file=io.BytesIO(b"%PDF-1.4 " + str(date.year).encode()))
+            )
+
+        response = self.client.get("/export/receipts", params={"cf": cf})
+
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            self.assertIsNone(archive.testzip())
+            dates = sorted(entry.date_time for entry in archive.infolist() if entry.filename.startswith("receipts/"))
+        self.assertEqual(dates, [(1980, 1, 1, 0, 0, 0), (2107, 12, 31, 0, 0, 0)])
+
+class TestReconciliation(unittest.TestCase):
+    """Test cases for receipt reconciliation and garbage collection"""
+
+    def setUp(self):
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+
+    def tearDown(self):
+        self.db.close()
+
+    def reconcile(self, **options) -> str:
+        """Run the reconcile-receipts command from the start, returning what it printed"""
+        args = dict(fix=False, limit=100000, grace_minutes=60, workers=2, restart=True)
+        args.update(options)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            manage.reconcile_receipts(argparse.Namespace(**args))
+        return output.getvalue()
+
+    def stored_file(self, name: str, age: float = 0) -> str:
+        location = self.service.storage.location(name)
+        self.service.storage.write(location, [b"%PDF-1.4 " + name.encode()])
+        modified = time.time() - age
+        os.utime(location, (modified, modified))
+        return location
+
+    def test_reconcile_reports_then_fixes(self):
+        """Test the command reports orphaned files, dangling rows and miscounted blobs, and --fix cleans up"""
+        orphan = self.stored_file("orphan.pdf", age=7200)
+        in_flight = self.stored_file("in-flight.pdf")
+        dangling = self.service.repository.create_purchase(purchase_data(), self.service.storage.location("gone.pdf"))
+        blob = self.service.upload_purchase(purchase_data(), Mock(file=io.BytesIO(b"%PDF-1.4 miscounted")))
+        self.db.execute(update(ReceiptBlobDB).where(ReceiptBlobDB.sha256 == blob["receipt_sha256"]).values(ref_count=5))
+        self.db.commit()
+
+        report = self.reconcile()
+
+        self.assertIn(f"orphaned file: {orphan}\n", report)
+        self.assertNotIn(in_flight, report)
+        self.assertIn(f"missing receipt: purchase {dangling.id}\n", report)
+        self.assertIn(f"miscounted blob: {blob['receipt_sha256']} ref_count=5 references=1\n", report)
+        self.assertTrue(os.path.exists(orphan))
+
+        report = self.reconcile(fix=True)
+
+        self.assertIn(f"removed file: {orphan}\n", report)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(in_flight))
+        self.assertTrue(os.path.exists(blob["receipt_path"]))
+        self.db.expire_all()
+        ref_count = self.db.execute(
+            select(ReceiptBlobDB.ref_count).where(ReceiptBlobDB.sha256 == blob["receipt_sha256"])
+        ).scalar()
+        self.assertEqual(ref_count, 1)
+
+    def test_reconcile_resumes_from_checkpoint(self):
+        """Test a run cut short by --limit continues where it stopped, and --restart starts over"""
+        for _ in range(2):
+            self.service.repository.create_purchase(purchase_data(), "r.pdf")
+
+        first = self.service.reconcile_receipts(limit=1)["purchases"]
+        position = self.service.repository.get_checkpoint("reconcile_purchases")
+        second = self.service.reconcile_receipts(limit=1)["purchases"]
+
+        self.assertEqual((first["scanned"], first["complete"]), (1, False))
+        self.assertEqual(second["scanned"], 1)
+        self.assertGreater(int(self.service.repository.get_checkpoint("reconcile_purchases")), int(position))
+        self.service.reset_reconciliation()
+        self.assertIsNone(self.service.repository.get_checkpoint("reconcile_purchases"))
+
+class SharedRedis:
+    """The few Redis commands RedisCache uses, on one dict standing for a server shared by processes"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def scan_iter(self, match, count=None):
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, match)]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+class TestPurchaseCache(unittest.TestCase):
+    """Test cases for the read-through purchase cache"""
+
+    def setUp(self):
+        self.api_db, self.cli_db = SessionLocal(), SessionLocal()
+
+    def tearDown(self):
+        self.api_db.close()
+        self.cli_db.close()
+
+    @staticmethod
+    def redis_cache(server: SharedRedis) -> RedisCache:
+        """A purchase cache like get_purchase_cache builds for PURCHASE_CACHE=redis"""
+        return RedisCache(60, client=server, prefix="purchase:", encode=dumps_json, decode=orjson.loads)
+
+    def test_projections_of_cached_purchases(self):
+        """Test cached purchases are projected like uncached ones"""
+        repository = PurchaseRepository(self.api_db)
+        purchase_id = repository.create_purchase(purchase_data(), "r.pdf").id
+        uncached = PurchaseService(repository)
+        cached = PurchaseService(repository, cache=MemoryCache(maxsize=10, ttl=60))
+
+        for fields in (None, "date,id", "receipt_path"):
+            self.assertEqual(cached.get_versioned_purchase(purchase_id, fields),
+                             uncached.get_versioned_purchase(purchase_id, fields))
+        self.assertEqual(list(cached.get_versioned_purchase(purchase_id, "date,id")[0]), ["date", "id"])
+
+    def test_migration_invalidates_purchases_cached_by_api_workers(self):
+        """Test a purchase an API worker cached is reloaded with a new version after migrate-receipts runs"""
+        server = SharedRedis()
+        api = PurchaseService(PurchaseRepository(self.api_db), cache=self.redis_cache(server))
+        cli = PurchaseService(PurchaseRepository(self.cli_db), cache=self.redis_cache(server))
+        flat = os.path.join(config.UPLOAD_FOLDER, "flat-cached.pdf")
+        with open(flat, "wb") as f:
+            f.write(b"%PDF-1.4 cached")
+        purchase_id = api.repository.create_purchase(purchase_data(), flat).id
+        api.get_versioned_purchase(purchase_id)
+        cached, version = api.get_versioned_purchase(purchase_id)
+        self.assertEqual((cached["receipt_path"], api.cache.hits), (flat, 1))
+
+        cli.migrate_receipts(workers=2)
+
+        reloaded, new_version = api.get_versioned_purchase(purchase_id)
+        self.assertEqual(reloaded["receipt_path"], cli.storage.location("flat-cached.pdf"))
+        self.assertGreater(new_version, version)
+
+    def test_delete_invalidates_cached_purchase(self):
+        """Test a deleted purchase leaves the cache, and a lookup racing the delete cannot put it back"""
+        cache = MemoryCache(maxsize=100, ttl=60)
+        service = PurchaseService(PurchaseRepository(self.api_db), cache=cache)
+        purchase_id = service.repository.create_purchase(purchase_data(), "r.pdf").id
+        stale = service.get_purchase_by_id(purchase_id)
+        self.assertEqual(service.get_purchase_by_id(purchase_id, fields="id,price"), {"id": purchase_id, "price": 10.5})
+
+        service.delete_purchases(ids=[purchase_id])
+        cache.add(purchase_id, stale)
+
+        self.assertIsNone(service.get_purchase_by_id(purchase_id))
+        snapshot = cache.snapshot()
+        self.assertEqual((snapshot["hits"], snapshot["misses"], snapshot["invalidations"]), (1, 2, 1))
+
+    def test_migration_refuses_per_worker_caches(self):
+        """Test migrate-receipts will not run against in-memory worker caches it cannot clear while the API runs"""
+        args = argparse.Namespace(workers=2, batch_size=500, api_stopped=False)
+        with patch.object(config, "PURCHASE_CACHE", "memory"):
+            with self.assertRaises(SystemExit):
+                manage.migrate_receipts(args)
+
+class TestSearchCache(unittest.TestCase):
+    """Test cases for the search page cache"""
+
+    def setUp(self):
+        self.db = SessionLocal()
+        self.cache = MemoryCache(maxsize=100, ttl=60)
+        self.service = PurchaseService(PurchaseRepository(self.db), search_cache=self.cache)
+
+    def tearDown(self):
+        self.db.close()
+
+    def page_ids(self, params: PurchaseSearchParams) -> list:
+        return [item["id"] for item in orjson.loads(self.service.render_search_page(params))["items"]]
+
+    def test_equivalent_searches_share_a_page(self):
+        """Test searches differing only in case and spacing are served the same cached page"""
+        purchase_id = self.service.repository.create_purchase(purchase_data(product_name="Cached Shared"), "r.pdf").id
+
+        first = self.page_ids(PurchaseSearchParams(product="cached shared"))
+        second = self.page_ids(PurchaseSearchParams(product="  CACHED Shared "))
+
+        self.assertEqual(first, [purchase_id])
+        self.assertEqual(second, first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_writes_invalidate_cached_pages(self):
+        """Test uploads and deletes make the next search miss the cache and see the change"""
+        params = PurchaseSearchParams(product="Cached Written")
+        first = self.service.repository.create_purchase(purchase_data(product_name="Cached Written"), "r.pdf").id
+        self.assertEqual(self.page_ids(params), [first])
+        self.assertEqual(self.page_ids(params), [first])
+
+        second = self.service.repository.create_purchase(purchase_data(product_name="Cached Written"), "r.pdf").id
+        self.assertEqual(self.page_ids(params), [second, first])
+
+        self.service.delete_purchases(ids=[first])
+        self.assertEqual(self.page_ids(params), [second])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+class TestConditionalRequests(unittest.TestCase):
+    """Test cases for ETags and 304 responses on purchases and searches"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_purchase_etag(self):
+        """Test a purchase's ETag answers If-None-Match with 304, weakly compared, and differs per projection"""
+        url = f"/purchase/{self.repository.create_purchase(purchase_data(), 'r.pdf').id}"
+        response = self.client.get(url)
+        etag = response.headers["etag"]
+
+        self.assertEqual(response.status_code, 200)
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            revalidated = self.client.get(url, headers={"if-none-match": if_none_match})
+            self.assertEqual((revalidated.status_code, revalidated.content), (304, b""))
+            self.assertEqual(revalidated.headers["etag"], etag)
+        self.assertEqual(self.client.get(url, headers={"if-none-match": '"other"'}).status_code, 200)
+        self.assertNotEqual(self.client.get(url, params={"fields": "id"}).headers["etag"], etag)
+
+    def test_search_etag_changes_with_writes(self):
+        """Test a search page is revalidated with 304 until a write changes the table version"""
+        params = {"cf": "ETAGSR80A01H501U"}
+        self.repository.create_purchase(purchase_data(customer_cf=params["cf"]), "r.pdf")
+        response = self.client.get("/search", params=params)
+        etag = response.headers["etag"]
+
+        self.assertEqual(len(response.json()["items"]), 1)
+        self.assertEqual(self.client.get("/search", params=params, headers={"if-none-match": etag}).status_code, 304)
+
+        self.repository.create_purchase(purchase_data(customer_cf=params["cf"]), "r.pdf")
+        response = self.client.get("/search", params=params, headers={"if-none-match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+        self.assertEqual(len(response.json()["items"]), 2)
+
+class TestChangeFeed(unittest.TestCase):
+    """Test cases for the purchase change feed"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_changes_in_order(self):
+        """Test the feed starts from the current number, then pages through writes and deletes in order"""
+        since = self.client.get("/changes").json()
+        self.assertEqual((since["changes"], since["more"]), ([], False))
+        self.assertEqual(since["next"], self.repository.get_table_version())
+
+        ids = [self.repository.create_purchase(purchase_data(product_name=f"Feed {i}"), "r.pdf").id
+               for i in range(3)]
+        self.repository.delete_purchases(ids=[ids[1]])
+        changes = self.client.get("/changes", params={"since": since["next"]}).json()
+
+        self.assertEqual([(change["op"], change["id"]) for change in changes["changes"]],
+                         [("upsert", ids[0]), ("upsert", ids[2]), ("delete", ids[1])])
+        self.assertEqual(changes["changes"][0]["purchase"]["product_name"], "Feed 0")
+        self.assertEqual(changes["next"], changes["changes"][-1]["seq"])
+        self.assertFalse(changes["more"])
+
+        first = self.client.get("/changes", params={"since": since["next"], "limit": 2}).json()
+        rest = self.client.get("/changes", params={"since": first["next"], "limit": 2}).json()
+
+        self.assertTrue(first["more"])
+        self.assertEqual(first["next"], first["changes"][-1]["seq"])
+        self.assertEqual(first["changes"] + rest["changes"], changes["changes"])
+        self.assertFalse(rest["more"])
+
+    def test_reset_after_pruned_tombstones(self):
+        """Test a client following from before pruned deletes is told to reload"""
+        since = self.client.get("/changes").json()["next"]
+        purchase_id = self.repository.create_purchase(purchase_data(), "r.pdf").id
+        self.repository.delete_purchases(ids=[purchase_id])
+
+        self.assertGreaterEqual(PurchaseService(self.repository).prune_tombstones(0), 1)
+        feed = self.client.get("/changes", params={"since": since}).json()
+
+        self.assertEqual((feed["changes"], feed["reset"]), ([], True))
+        self.assertEqual(feed["next"], self.repository.get_table_version())
+        self.assertFalse(self.client.get("/changes", params={"since": feed["next"]}).json()["reset"])
+
+    def test_stream_events(self):
+        """Test the stream sends each change as an event whose id is its change number"""
+        import controller
+
+        since = self.client.get("/changes").json()["next"]
+        purchase_id = self.repository.create_purchase(purchase_data(), "r.pdf").id
+        request = Mock(is_disconnected=AsyncMock(side_effect=[False, True]))
+
+        async def events() -> list:
+            return [event async for event in controller._change_events(request, since)]
+
+        with patch.object(config, "CHANGES_POLL_INTERVAL", 0):
+            (event,) = asyncio.run(events())
+
+        self.assertTrue(event.startswith(b"id: %d\nevent: upsert\ndata: " % (since + 1)))
+        self.assertEqual(orjson.loads(event.split(b"data: ", 1)[1])["id"], purchase_id)
+
+    def follow(self, since: int, limit: int = 10) -> list:
+        """Every (op, id) change after `since`, polling until a page comes back empty"""
+        changes, page = [], None
+        while page != []:
+            feed = self.client.get("/changes", params={"since": since, "limit": limit}).json()
+            page = [(change["op"], change["id"]) for change in feed["changes"]]
+            changes += page
+            since = feed["next"]
+        return changes
+
+    def test_write_between_scans_is_not_skipped(self):
+        """Test a write committed between the upsert and tombstone scans is left for the next page"""
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        since = self.client.get("/changes").json()["next"]
+        ids = [self.repository.create_purchase(purchase_data(), "r.pdf").id for _ in range(3)]
+        late = []
+
+        def interleave(conn, cursor, statement, *args):
+            # Any engine, so the async service's queries are caught too
+            if not late and "FROM purchase_tombstones" in statement:
+                late.append(None)
+                with SessionLocal() as other:
+                    repository = PurchaseRepository(other)
+                    late[0] = repository.create_purchase(purchase_data(), "r.pdf").id
+                    repository.delete_purchases(ids=[ids[0]])
+
+        event.listen(Engine, "before_cursor_execute", interleave)
+        try:
+            changes = self.follow(since)
+        finally:
+            event.remove(Engine, "before_cursor_execute", interleave)
+
+        self.assertEqual(changes, [("upsert", ids[0]), ("upsert", ids[1]), ("upsert", ids[2]),
+                                   ("upsert", late[0]), ("delete", ids[0])])
+
+class TestSearchPagination(unittest.TestCase):
+    """Test cases for keyset-paginated search"""
+
+    def setUp(self):
+        self.db = SessionLocal()
+        self.service = PurchaseService(PurchaseRepository(self.db))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_pages_through_undated_purchases(self):
+        """Test rows whose date the DATE migration left NULL are paged through once each, first"""
+        repository = self.service.repository
+        ids = [repository.create_purchase(purchase_data(customer_cf="NLLDTE80A01H501U"), "r.pdf").id
+               for _ in range(4)]
+        self.db.execute(update(PurchaseDB).where(PurchaseDB.id.in_(ids[:2])).values(date=None))
+        self.db.commit()
+
+        seen, cursor = [], None
+        while True:
+            page = self.service.search_purchases(PurchaseSearchParams(cf="NLLDTE80A01H501U"), cursor=cursor, limit=1)
+            seen.extend(item["id"] for item in page["items"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(seen, [ids[1], ids[0], ids[3], ids[2]])
+
+class TestSearchFilters(unittest.TestCase):
+    """Test cases for the /search filters"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def create(self, **overrides) -> int:
+        return self.repository.create_purchase(purchase_data(**overrides), "r.pdf").id
+
+    def search(self, **params) -> list:
+        """Ids of the first page of a search, newest first"""
+        response = self.client.get("/search", params=params)
+        self.assertEqual(response.status_code, 200, response.text)
+        return [item["id"] for item in response.json()["items"]]
+
+    def create_cfs(self, tag: str) -> tuple:
+        """A purchase with a 16-character CF starting with `tag` and one whose CF contains it after a prefix"""
+        return self.create(customer_cf=f"{tag}CFMD80A01H501U"), self.create(customer_cf=f"XX{tag}CFMD80A01H501U")
+
+    def test_cf_auto_mode(self):
+        """Test auto mode matches a 16-character CF exactly and a shorter one anywhere, ignoring case"""
+        exact, longer = self.create_cfs("QA")
+
+        self.assertEqual(self.search(cf="qacfmd80a01h501u"), [exact])
+        self.assertEqual(self.search(cf=" qacfMD80 "), [longer, exact])
+
+    def test_cf_exact_mode(self):
+        """Test exact mode matches only the whole CF, ignoring case and surrounding spaces"""
+        exact, _ = self.create_cfs("QB")
+
+        self.assertEqual(self.search(cf=" qbcfmd80a01h501u ", cf_mode="exact"), [exact])
+        self.assertEqual(self.search(cf="QBCFMD80", cf_mode="exact"), [])
+
+    def test_cf_prefix_mode(self):
+        """Test prefix mode matches CFs starting with the term, ignoring case"""
+        exact, longer = self.create_cfs("QC")
+
+        self.assertEqual(self.search(cf="qccfmd", cf_mode="prefix"), [exact])
+        self.assertEqual(self.search(cf="xxqccf", cf_mode="prefix"), [longer])
+        self.assertEqual(self.search(cf="CCFMD80", cf_mode="prefix"), [])
+
+    def test_cf_contains_mode(self):
+        """Test contains mode matches the term anywhere, ignoring case, and LIKE wildcards literally"""
+        exact, longer = self.create_cfs("QD")
+        wildcard = self.create(customer_cf="QD%_MD80A01H501U")
+
+        self.assertEqual(self.search(cf="dcfmd80a01h501u", cf_mode="contains"), [longer, exact])
+        self.assertEqual(self.search(cf="qd%_", cf_mode="contains"), [wildcard])
+        self.assertEqual(self.search(cf="QDCFMD80A01H501UX", cf_mode="contains"), [])
+
+    def test_filters_are_combined(self):
+        """Test name, surname, CF, card, product and date filters must all match, across keyset pages"""
+        match = dict(customer_name="Ada", customer_surname="Lovelace", customer_cf="ANDFLT80A01H501U",
+                     credit_card="4000000000000002", product_name="Engine", date=datetime.date(2025, 3, 1))
+        ids = [self.create(**match) for _ in range(3)]
+        for decoy in (dict(customer_name="Bob"), dict(customer_surname="Babbage"), dict(customer_cf="ANDFLX80A01H501U"),
+                      dict(credit_card="4000000000000010"), dict(product_name="Loom"),
+                      dict(date=datetime.date(2025, 3, 2))):
+            self.create(**{**match, **decoy})
+        params = dict(name="ada", surname="LOVE", cf="andflt80a01h501u", cc="4000000000000002", product="eng",
+                      date="2025-03-01", limit=2)
+
+        first = self.client.get("/search", params=params).json()
+        second = self.client.get("/search", params={**params, "cursor": first["next_cursor"]}).json()
+
+        self.assertEqual([item["id"] for item in first["items"]], [ids[2], ids[1]])
+        self.assertEqual([item["id"] for item in second["items"]], [ids[0]])
+        self.assertIsNone(second["next_cursor"])
+
+    def test_date_range_bounds(self):
+        """Test date_from and date_to are inclusive, and an inverted range is refused with 400"""
+        dates = [datetime.date(2024, 9, day) for day in (1, 2, 3)]
+        ids = [self.create(product_name="Date Bounds", date=date) for date in dates]
+
+        self.assertEqual(self.search(product="Date Bounds", date_from="2024-09-02"), [ids[2], ids[1]])
+        self.assertEqual(self.search(product="Date Bounds", date_to="2024-09-02"), [ids[1], ids[0]])
+        self.assertEqual(self.search(product="Date Bounds", date_from="2024-09-02", date_to="2024-09-02"), [ids[1]])
+        for url in ("/search", "/stats", "/export"):
+            response = self.client.get(url, params={"date_from": "2024-09-03", "date_to": "2024-09-01"})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["detail"], "date_from must not be after date_to")
+
+    def test_price_range_bounds(self):
+        """Test price_min and price_max are inclusive to the cent, and an inverted range is refused with 400"""
+        ids = [self.create(product_name="Price Bounds", price=price) for price in ("9.99", "10.00", "10.01")]
+
+        self.assertEqual(self.search(product="Price Bounds", price_min="10"), [ids[2], ids[1]])
+        self.assertEqual(self.search(product="Price Bounds", price_max="10.00"), [ids[1], ids[0]])
+        self.assertEqual(self.search(product="Price Bounds", price_min="10", price_max="10.0"), [ids[1]])
+        self.assertEqual(self.search(product="Price Bounds", price_min="0", price_max="9.98"), [])
+        for url in ("/search", "/stats", "/export"):
+            response = self.client.get(url, params={"price_min": "10.01", "price_max": "10"})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["detail"], "price_min must not be above price_max")
+
+class TestSearchResponses(unittest.TestCase):
+    """Test cases for the /search and /purchase/{id} response formats"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_ndjson_stream(self):
+        """Test streamed searches send every filtered match as one JSON object per line, or nothing"""
+        cf = "NDJSON80A01H501U"
+        ids = [self.repository.create_purchase(purchase_data(customer_cf=cf), "r.pdf").id for _ in range(3)]
+        self.repository.create_purchase(purchase_data(customer_cf="NDJSOX80A01H501U"), "r.pdf")
+        page = self.client.get("/search", params={"cf": cf}).json()["items"]
+
+        for request in (dict(params={"cf": cf, "stream": "true"}),
+                        dict(params={"cf": cf}, headers={"accept": "application/x-ndjson"})):
+            response = self.client.get("/search", **request)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+            self.assertTrue(response.content.endswith(b"\n"))
+            lines = response.content.splitlines()
+            self.assertEqual([orjson.loads(line) for line in lines], page)
+            self.assertEqual([item["id"] for item in page], ids[::-1])
+
+        empty = self.client.get("/search", params={"cf": "NOBODY80A01H501U", "stream": "true"})
+        projected = self.client.get("/search", params={"cf": cf, "stream": "true", "fields": "id,price"})
+
+        self.assertEqual((empty.status_code, empty.content), (200, b""))
+        self.assertEqual([orjson.loads(line) for line in projected.content.splitlines()],
+                         [{"id": item["id"], "price": 10.5} for item in page])
+
+    def test_msgpack_negotiation(self):
+        """Test MessagePack is sent to clients asking for it and JSON otherwise, holding the same data"""
+        import msgpack
+
+        cf = "MSGPCK80A01H501U"
+        purchase_id = self.repository.create_purchase(purchase_data(customer_cf=cf), "r.pdf").id
+
+        for url, params in (("/search", {"cf": cf}), (f"/purchase/{purchase_id}", {})):
+            expected = self.client.get(url, params=params)
+            self.assertEqual(expected.headers["content-type"], "application/json")
+            for accept in ("application/msgpack", "application/x-msgpack, application/json;q=0.5"):
+                packed = self.client.get(url, params=params, headers={"accept": accept})
+
+                self.assertEqual(packed.status_code, 200)
+                self.assertEqual(packed.headers["content-type"], "application/msgpack")
+                self.assertEqual(msgpack.unpackb(packed.content), expected.json())
+                self.assertNotEqual(packed.headers["etag"], expected.headers["etag"])
+            for accept in ("*/*", "text/html", "application/json"):
+                fallback = self.client.get(url, params=params, headers={"accept": accept})
+                self.assertEqual(fallback.headers["content-type"], "application/json")
+                self.assertEqual(fallback.json(), expected.json())
+
+    def test_search_fields(self):
+        """Test fields= selects only the requested columns in SQL, in the order asked, and rejects unknown ones"""
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        cf = "FIELDS80A01H501U"
+        purchase_id = self.repository.create_purchase(purchase_data(customer_cf=cf), "r.pdf").id
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", capture)
+        try:
+            response = self.client.get("/search", params={"cf": cf, "fields": "price, id,price"})
+        finally:
+            event.remove(Engine, "before_cursor_execute", capture)
+
+        self.assertEqual(response.json()["items"], [{"price": 10.5, "id": purchase_id}])
+        self.assertEqual(list(response.json()["items"][0]), ["price", "id"])
+        search = next(statement for statement in statements if "FROM purchases" in statement)
+        self.assertNotIn("receipt_path", search.split("FROM purchases")[0])
+        for url in ("/search", f"/purchase/{purchase_id}"):
+            response = self.client.get(url, params={"fields": "id,secret"})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("secret", response.json()["detail"])
+        self.assertEqual(self.client.get("/search", params={"fields": ","}).status_code, 400)
+
+class TestStats(unittest.TestCase):
+    """Test cases for the statistics endpoints"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def stats(self, **params) -> dict:
+        response = self.client.get("/stats", params=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_stats_follow_uploads_and_bulk_deletes(self):
+        """Test totals, averages, distinct customers and today's count track uploads and bulk deletes"""
+        product = "Stats Counted"
+        today = datetime.date.today()
+        for cf, price, date in (("STATSA80A01H501U", "10.10", today), ("STATSA80A01H501U", "20.20", today),
+                                ("STATSB80A01H501U", "0.01", datetime.date(2024, 5, 1))):
+            self.repository.create_purchase(
+                purchase_data(product_name=product, customer_cf=cf, price=price, date=date), "r.pdf"
+            )
+
+        stats = self.stats(product=product)
+        self.assertAlmostEqual(stats.pop("average_amount"), 30.31 / 3)
+        self.assertEqual(stats, {
+            "total_purchases": 3, "total_amount": 30.31, "unique_customers": 2, "today_purchases": 2,
+        })
+
+        response = self.client.delete("/purchases", params={"product": product, "date": today.isoformat()})
+        self.assertEqual(response.json()["deleted"], 2)
+
+        self.assertEqual(self.stats(product=product), {
+            "total_purchases": 1, "total_amount": 0.01, "average_amount": 0.01,
+            "unique_customers": 1, "today_purchases": 0,
+        })
+
+    def test_stats_without_matches(self):
+        """Test statistics over no purchases are zeros rather than nulls"""
+        self.assertEqual(self.stats(product="Stats Nothing"), {
+            "total_purchases": 0, "total_amount": 0, "average_amount": 0, "unique_customers": 0, "today_purchases": 0,
+        })
+
+    def test_daily_series(self):
+        """Test the daily series is bounded inclusively and leaves out days without purchases, emptied ones too"""
+        product = "Daily Series"
+        days = [datetime.date(2024, 7, day) for day in (1, 2, 4, 6)]
+        ids = {day: self.repository.create_purchase(purchase_data(product_name=product, date=day), "r.pdf").id
+               for day in days}
+        self.repository.create_purchase(purchase_data(product_name=product, date=days[0], price="4.50"), "r.pdf")
+        self.repository.delete_purchases(ids=[ids[days[1]]])
+
+        def series(**params) -> list:
+            response = self.client.get("/stats/daily", params={"key": product, **params})
+            self.assertEqual(response.status_code, 200)
+            return response.json()
+
+        self.assertEqual(series(), [
+            {"date": "2024-07-01", "purchase_count": 2, "total_amount": 15.0},
+            {"date": "2024-07-04", "purchase_count": 1, "total_amount": 10.5},
+            {"date": "2024-07-06", "purchase_count": 1, "total_amount": 10.5},
+        ])
+        self.assertEqual([point["date"] for point in series(date_from="2024-07-01", date_to="2024-07-04")],
+                         ["2024-07-01", "2024-07-04"])
+        self.assertEqual([point["date"] for point in series(date_from="2024-07-02", date_to="2024-07-05")],
+                         ["2024-07-04"])
+        self.assertEqual(series(date_from="2024-07-02", date_to="2024-07-03"), [])
+        self.assertEqual(series(group="true", date_from="2024-07-06"),
+                         [{"date": "2024-07-06", "key": product, "purchase_count": 1, "total_amount": 10.5}])
+
+class TestRollups(unittest.TestCase):
+    """Test cases for the daily rollup tables"""
+
+    def setUp(self):
+        self.db = SessionLocal()
+        self.repository = PurchaseRepository(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def product_rollups(self, product_name: str) -> list:
+        return self.db.execute(
+            select(DailyProductRollupDB.date, DailyProductRollupDB.purchase_count)
+            .where(DailyProductRollupDB.product_name == product_name)
+        ).all()
+
+    def test_undated_purchases_are_left_out(self):
+        """Test deleting an undated purchase and rebuilding skip it instead of failing on the NULL date"""
+        dated = self.repository.create_purchase(purchase_data(product_name="Undated"), "r.pdf")
+        undated = self.repository.create_purchase(purchase_data(product_name="Undated"), "r.pdf")
+        self.db.execute(update(PurchaseDB).where(PurchaseDB.id == undated.id).values(date=None))
+        self.db.commit()
+
+        self.repository.rebuild_rollups()
+        self.assertEqual(self.product_rollups("Undated"), [(datetime.date(2025, 1, 1), 1)])
+
+        self.repository.delete_purchases(ids=[undated.id])
+        self.repository.rebuild_rollups()
+        self.assertEqual(self.product_rollups("Undated"), [(datetime.date(2025, 1, 1), 1)])
+
+        self.repository.delete_purchases(ids=[dated.id])
+        self.assertEqual(self.product_rollups("Undated"), [])
+
+    def snapshot(self, product_name: str, customer_cf: str) -> tuple:
+        customers = self.db.execute(
+            select(DailyCustomerRollupDB.date, DailyCustomerRollupDB.purchase_count, DailyCustomerRollupDB.total_amount)
+            .where(DailyCustomerRollupDB.customer_cf == customer_cf)
+            .order_by(DailyCustomerRollupDB.date)
+        ).all()
+        products = self.db.execute(
+            select(DailyProductRollupDB.date, DailyProductRollupDB.purchase_count, DailyProductRollupDB.total_amount)
+            .where(DailyProductRollupDB.product_name == product_name)
+            .order_by(DailyProductRollupDB.date)
+        ).all()
+        return customers, products
+
+    def test_incremental_matches_rebuild(self):
+        """Test inserts and deletes leave the rollups a rebuild would compute, for untrimmed lowercase CFs too"""
+        day = datetime.date(2025, 2, 1)
+        created = [
+            self.repository.create_purchase(purchase_data(product_name="Rebuilt", customer_cf=cf, date=day), "r.pdf")
+            for cf in ("RBLDCF80A01H501U", " rbldcf80a01h501u", "RbldCf80A01H501U  ")
+        ]
+        self.repository.bulk_create_purchases([
+            (purchase_data(product_name="Rebuilt", customer_cf=" RBLDCF80A01H501U ", date=date), "r.pdf", None)
+            for date in (day, datetime.date(2025, 2, 2))
+        ])
+        self.repository.delete_purchases(ids=[created[0].id])
+
+        incremental = self.snapshot("Rebuilt", "RBLDCF80A01H501U")
+        self.repository.rebuild_rollups()
+
+        self.assertEqual(incremental, self.snapshot("Rebuilt", "RBLDCF80A01H501U"))
+        self.assertEqual([row[:2] for row in incremental[0]], [(day, 3), (datetime.date(2025, 2, 2), 1)])
+
+class TestPrices(unittest.TestCase):
+    """Test cases for price validation"""
+
+    def test_float_price_is_rounded_to_cents(self):
+        """Test float artefacts and extra decimals are rounded half up instead of rejected"""
+        self.assertEqual(purchase_data(price=12.340000000000002).price, Decimal("12.34"))
+        self.assertEqual(purchase_data(price="0.125").price, Decimal("0.13"))
+
+    def test_price_overflowing_the_column_is_rejected(self):
+        """Test only prices with more integer digits than the column holds are rejected"""
+        self.assertEqual(purchase_data(price="99999999.994").price, Decimal("99999999.99"))
+        with self.assertRaises(ValidationError):
+            purchase_data(price="99999999.995")
+        with self.assertRaises(ValidationError):
+            purchase_data(price="abc")
+
+    def test_upload_form_accepts_float_price(self):
+        """Test the upload form rounds a float price like the JSON models do"""
+        from fastapi.testclient import TestClient
+        import main
+
+        data = purchase_data().model_dump(mode="json")
+        data["price"] = "12.340000000000002"
+        response = TestClient(main.app).post(
+            "/upload/", data=data, files={"receipt": ("r.pdf", b"%PDF-1.4 float price", "application/pdf")}
+        )
+
+        self.assertEqual(response.status_code, 200, response.text)
+
+    def test_upload_form_rejects_overflowing_price(self):
+        """Test the upload form answers a price too large for the column with 422 instead of 500"""
+        from fastapi.testclient import TestClient
+        import main
+
+        data = purchase_data().model_dump(mode="json")
+        data["price"] = "123456789"
+        response = TestClient(main.app).post(
+            "/upload/", data=data, files={"receipt": ("r.pdf", b"%PDF-1.4 large price", "application/pdf")}
+        )
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()["detail"][0]["loc"], ["body", "price"])
+
+class TestUploadLimits(unittest.TestCase):
+    """Test cases for capping receipt uploads before their body is spooled"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        # A small cap in front of the app, so bodies over it stay small
+        self.client = TestClient(main.UploadSizeLimitMiddleware(main.app, path="/upload/", limit=4096))
+
+    @staticmethod
+    def upload_request(receipt: bytes, boundary: str = "receipt-boundary"):
+        """Multipart body and content type of an upload, to be sent without a Content-Length"""
+        fields = [
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in purchase_data().model_dump(mode="json").items()
+        ]
+        file = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="receipt"; filename="r.pdf"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'
+        ).encode() + receipt + f"\r\n--{boundary}--\r\n".encode()
+        return b"".join(fields) + file, f"multipart/form-data; boundary={boundary}"
+
+    def post_chunked(self, body: bytes, content_type: str):
+        chunks = (body[start:start + 1024] for start in range(0, len(body), 1024))
+        return self.client.post("/upload/", content=chunks, headers={"content-type": content_type})
+
+    def test_chunked_upload_within_limit_is_accepted(self):
+        """Test an upload without Content-Length is streamed through when it stays under the cap"""
+        response = self.post_chunked(*self.upload_request(b"%PDF-1.4 chunked"))
+
+        self.assertEqual(response.status_code, 200, response.text)
+
+    def test_chunked_upload_over_limit_is_cut_off(self):
+        """Test an upload without Content-Length is refused once its body passes the cap"""
+        response = self.post_chunked(*self.upload_request(b"%PDF-1.4 " + b"x" * 8192))
+
+        self.assertEqual(response.status_code, 413)
+
+    def test_declared_length_over_limit_is_refused(self):
+        """Test an upload declaring a Content-Length over the cap is refused before it is read"""
+        body, content_type = self.upload_request(b"%PDF-1.4 " + b"x" * 8192)
+        response = self.client.post("/upload/", content=body, headers={"content-type": content_type})
+
+        self.assertEqual(response.status_code, 413)
+
+class TestBulkUpload(unittest.TestCase):
+    """Test cases for the bulk upload endpoint"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+
+    def bulk_upload(self, manifest: bytes) -> dict:
+        response = self.client.post("/upload/bulk", files={"manifest": ("manifest.ndjson", manifest)})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_empty_manifest(self):
+        """Test an empty manifest inserts nothing instead of failing on an empty insert"""
+        result = self.bulk_upload(b"")
+
+        self.assertEqual((result["inserted"], result["failed"]), (0, 0))
+
+    def test_manifest_without_valid_rows(self):
+        """Test a manifest whose rows all fail validation reports them instead of failing"""
+        result = self.bulk_upload(b'{"customer_name": "John"}\n[]\n')
+
+        self.assertEqual((result["inserted"], result["failed"]), (0, 2))
+
+    def test_empty_text_fields_stay_empty(self):
+        """Test empty text is stored as an empty string and a missing hash as NULL, by COPY as by executemany"""
+        with SessionLocal() as db:
+            purchase_id, = PurchaseRepository(db).bulk_create_purchases(
+                [(purchase_data(customer_surname="", product_name=""), "r.pdf", None)]
+            )
+            row = db.execute(
+                select(PurchaseDB.customer_surname, PurchaseDB.product_name, PurchaseDB.receipt_sha256)
+                .where(PurchaseDB.id == purchase_id)
+            ).one()
+
+        self.assertEqual(tuple(row), ("", "", None))
+
+class TestDiagnostics(unittest.TestCase):
+    """Test cases for the diagnostics endpoints"""
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app)
+
+    def test_pool_diagnostics(self):
+        """Test the pool endpoint reports the configured settings and counts request checkouts"""
+        before = self.client.get("/diagnostics/pool").json()
+        self.client.get("/purchase/0")
+        after = self.client.get("/diagnostics/pool").json()
+
+        self.assertEqual(after["config"]["pool_size"], config.DB_POOL_SIZE)
+        self.assertEqual(after["sync"]["pool"], "QueuePool")
+        self.assertGreater(after["sync"]["checkouts"], before["sync"]["checkouts"])
+        self.assertEqual(set(after["sync"]["wait_ms"]), {"avg", "p50", "p95", "max"})
+
+    def test_pool_timeout_is_counted(self):
+        """Test a checkout giving up after pool_timeout is counted as a timeout and a wait"""
+        metrics = PoolMetrics()
+        engine = create_engine(
+            f"sqlite:///{os.path.join(WORKDIR, 'pool.db')}",
+            poolclass=instrumented_pool(QueuePool, metrics), pool_size=1, max_overflow=0, pool_timeout=0.01
+        )
+        metrics.attach(engine)
+        with engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+            snapshot = metrics.snapshot(engine)
+        engine.dispose()
+
+        self.assertEqual((snapshot["timeouts"], snapshot["checked_out"], snapshot["peak_in_use"]), (1, 1, 1))
+        self.assertGreaterEqual(snapshot["wait_ms"]["max"], 10)
+
+@unittest.skipUnless(importlib.util.find_spec("aiosqlite"), "async mode on SQLite needs aiosqlite")
+class AsyncMode:
+    """Mixin running a test case's requests through AsyncPurchaseService, as ASYNC_DB=true does"""
+
+    def setUp(self):
+        # The inherited tests reuse their sync runs' CFs and products, so each starts from no purchases
+        self.delete_purchases()
+        self.addCleanup(self.delete_purchases)
+        super().setUp()
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        from sqlalchemy.pool import NullPool
+        import controller
+        import main
+
+        # Unpooled, since TestClient runs each request on a new event loop
+        engine = create_async_engine(async_database_url(os.environ["DATABASE_URL"]), poolclass=NullPool)
+        sessions = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+        self.async_requests = 0
+
+        async def get_service():
+            self.async_requests += 1
+            async with sessions() as db:
+                yield AsyncPurchaseService(AsyncPurchaseRepository(db))
+
+        # Routes depend on the staticmethod object itself
+        dependency = vars(controller.PurchaseController)["get_service"]
+        main.app.dependency_overrides[dependency] = get_service
+        self.addCleanup(main.app.dependency_overrides.pop, dependency)
+        # The change stream polls on its own sessions
+        for patcher in (patch.object(config, "ASYNC_DB", True),
+                        patch.object(controller, "AsyncSessionLocal", sessions)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super().tearDown()
+        self.assertGreater(self.async_requests, 0)
+
+    @staticmethod
+    def delete_purchases():
+        """Delete every purchase, keeping the rollups and change feed consistent"""
+        with SessionLocal() as db:
+            repository = PurchaseRepository(db)
+            repository.delete_purchases(ids=db.execute(select(PurchaseDB.id)).scalars().all())
+
+class TestAsyncBulkDelete(AsyncMode, TestBulkDelete):
+    """Test cases for the bulk delete endpoint in async mode"""
+
+class TestAsyncExport(AsyncMode, TestExport):
+    """Test cases for the CSV and Parquet purchase exports in async mode"""
+
+class TestAsyncConditionalRequests(AsyncMode, TestConditionalRequests):
+    """Test cases for ETags and 304 responses in async mode"""
+
+class TestAsyncChangeFeed(AsyncMode, TestChangeFeed):
+    """Test cases for the purchase change feed in async mode"""
+
+class TestAsyncSearchFilters(AsyncMode, TestSearchFilters):
+    """Test cases for the /search filters in async mode"""
+
+class TestAsyncSearchResponses(AsyncMode, TestSearchResponses):
+    """Test cases for the /search and /purchase/{id} response formats in async mode"""
+
+if __name__ == '__main__':
+    # Run tests
+    unittest.main(verbosity=2)
@@ -3,8 +3,8 @@ Reusable UI components for the application
 """
 import streamlit as st
 from datetime import date
-from typing import Optional, Tuple, List
-from models import PurchaseData, SearchParams, PurchaseResponse
+from typing import Callable, Optional, Tuple, List
+from models import PurchaseData, SearchParams, PurchaseResponse, PurchaseStats
 from utils import validator, formatter, file_utils
 
 class UIComponents:
@@ -110,10 +110,16 @@ class UIComponents:
             with col2:
                 search_cf = st.text_input("Codice Fiscale", help="Search by tax code")
                 search_cc = st.text_input("Credit Card", help="Search by credit card")
+                search_price_min = st.number_input("Min Price (€)", min_value=0.0, value=None,
+                                                   step=0.01, format="%.2f", help="Minimum purchase price")
+                search_price_max = st.number_input("Max Price (€)", min_value=0.0, value=None,
+                                                   step=0.01, format="%.2f", help="Maximum purchase price")
             
             with col3:
                 search_product = st.text_input("Product", help="Search by product name")
                 search_date = st.date_input("Date", value=None, help="Search by purchase date")
+                search_date_from = st.date_input("From", value=None, help="Purchases on or after this date")
+                search_date_to = st.date_input("To", value=None, help="Purchases on or before this date")
             
             col1, col2, col3 = st.columns([1, 1, 2])
             with col1:
@@ -124,7 +130,11 @@ class UIComponents:
                         cf=search_cf or None,
                         cc=search_cc or None,
                         product=search_product or None,
-                        date=str(search_date) if search_date else None
+                        date=str(search_date) if search_date else None,
+                        date_from=str(search_date_from) if search_date_from else None,
+                        date_to=str(search_date_to) if search_date_to else None,
+                        price_min=search_price_min,
+                        price_max=search_price_max
                     )
             
             with col2:
@@ -134,8 +144,12 @@ class UIComponents:
         return None
     
     @staticmethod
-    def render_purchase_results(purchases: List[PurchaseResponse], show_actions: bool = True):
-        """Render purchase search results"""
+    def render_purchase_results(
+        purchases: List[PurchaseResponse],
+        show_actions: bool = True,
+        receipt_url: Optional[Callable[[int], str]] = None
+    ):
+        """Render purchase search results, linking receipts when `receipt_url` is given"""
         if not purchases:
             st.info("📭 No purchases found matching your criteria.")
             return
@@ -146,6 +160,10 @@ class UIComponents:
             with st.container():
                 col1, col2 = st.columns([3, 1])
                 
+                receipt = purchase.receipt_path.split('/')[-1] if purchase.receipt_path else 'N/A'
+                if purchase.receipt_path and receipt_url:
+                    receipt = f"[{receipt}]({receipt_url(purchase.id)})"
+                
                 with col1:
                     st.markdown(f"""
                     **🆔 Purchase #{purchase.id}**
@@ -155,7 +173,7 @@ class UIComponents:
                     - **🛍️ Product:** {formatter.truncate_text(purchase.product_name, 40)}
                     - **💰 Price:** {formatter.format_currency(purchase.price)}
                     - **📅 Date:** {formatter.format_date(purchase.date)}
-                    - **📄 Receipt:** {purchase.receipt_path.split('/')[-1] if purchase.receipt_path else 'N/A'}
+                    - **📄 Receipt:** {receipt}
                     """)
                 
                 if show_actions:
@@ -191,7 +209,7 @@ class UIComponents:
         return st.spinner("⏳ Processing...")
     
     @staticmethod
-    def render_sidebar_info():
+    def render_sidebar_info(stats: Optional[PurchaseStats] = None):
         """Render sidebar with application info"""
         with st.sidebar:
             st.markdown("## 📋 Application Info")
@@ -212,9 +230,8 @@ class UIComponents:
             
             st.markdown("---")
             st.markdown("**Quick Stats**")
-            # These could be populated with real data
-            st.metric("Today's Uploads", "0")
-            st.metric("Total Purchases", "0")
+            st.metric("Today's Uploads", stats.today_purchases if stats else "N/A")
+            st.metric("Total Purchases", stats.total_purchases if stats else "N/A")
 
 # Global components instance
 ui = UIComponents()
@@ -8,6 +8,8 @@ class Config:
     
     # API Configuration
     BACKEND_URL = os.getenv("BACKEND_URL", "http://backend:8000")
+    # URL of the backend as reached from the user's browser (used for downloads)
+    PUBLIC_BACKEND_URL = os.getenv("PUBLIC_BACKEND_URL", BACKEND_URL)
     
     # UI Configuration
     APP_TITLE = "Customer Purchase Manager"
@@ -18,11 +20,24 @@ class Config:
     MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
     ALLOWED_FILE_TYPES = ["pdf"]
     
+    # Search Configuration
+    SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "50"))
+    # Search pages kept with their ETag, so unchanged results are revalidated instead of re-downloaded
+    VALIDATOR_CACHE_SIZE = int(os.getenv("VALIDATOR_CACHE_SIZE", "64"))
+    # Seconds the sidebar's statistics over every purchase are reused across reruns and sessions
+    STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "60"))
+    
     # API Endpoints
     ENDPOINTS = {
         "upload": f"{BACKEND_URL}/upload/",
         "search": f"{BACKEND_URL}/search",
+        "stats": f"{BACKEND_URL}/stats",
         "purchase": f"{BACKEND_URL}/purchase",
+        "purchases": f"{BACKEND_URL}/purchases",
+        "changes": f"{BACKEND_URL}/changes",
+        "export": f"{PUBLIC_BACKEND_URL}/export",
+        "export_receipts": f"{PUBLIC_BACKEND_URL}/export/receipts",
+        "receipt": f"{PUBLIC_BACKEND_URL}/purchase",
         "health": f"{BACKEND_URL}/health"
     }
 
@@ -51,6 +51,10 @@ class SearchParams:
     cc: Optional[str] = None
     product: Optional[str] = None
     date: Optional[str] = None
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    price_min: Optional[float] = None
+    price_max: Optional[float] = None
     
     def to_params(self) -> Dict[str, str]:
         """Convert to query parameters, excluding None values"""
@@ -67,6 +71,14 @@ class SearchParams:
             params["product"] = self.product
         if self.date:
             params["date"] = self.date
+        if self.date_from:
+            params["date_from"] = self.date_from
+        if self.date_to:
+            params["date_to"] = self.date_to
+        if self.price_min is not None:
+            params["price_min"] = str(self.price_min)
+        if self.price_max is not None:
+            params["price_max"] = str(self.price_max)
         return params
 
 @dataclass
@@ -96,3 +108,23 @@ class PurchaseResponse:
             date=data["date"],
             receipt_path=data["receipt_path"]
         )
+
+@dataclass
+class PurchaseStats:
+    """Data model for aggregate purchase statistics"""
+    total_purchases: int
+    total_amount: float
+    average_amount: float
+    unique_customers: int
+    today_purchases: int
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'PurchaseStats':
+        """Create PurchaseStats from API response"""
+        return cls(
+            total_purchases=data["total_purchases"],
+            total_amount=data["total_amount"],
+            average_amount=data["average_amount"],
+            unique_customers=data["unique_customers"],
+            today_purchases=data["today_purchases"]
+        )
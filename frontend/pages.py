@@ -4,7 +4,18 @@ Page logic and state management
 import streamlit as st
 from services import api_service
 from components import ui
-from models import SearchParams
+from models import SearchParams, PurchaseStats
+from config import config
+
+@st.cache_data(ttl=config.STATS_CACHE_TTL, show_spinner=False)
+def load_total_stats() -> PurchaseStats:
+    """Statistics over every purchase for the sidebar, shared by all sessions; they scan the
+    whole table, so every rerun reuses them until the TTL passes or this app writes"""
+    result = api_service.get_stats()
+    if not result["success"]:
+        # Raised rather than returned, so a failure is not cached
+        raise ConnectionError(result["message"])
+    return result["data"]
 
 class PurchaseManagerPage:
     """Main page controller for purchase management"""
@@ -20,6 +31,11 @@ class PurchaseManagerPage:
             st.session_state.search_results = []
         if 'last_search_params' not in st.session_state:
             st.session_state.last_search_params = None
+        if 'next_cursor' not in st.session_state:
+            st.session_state.next_cursor = None
+        # Change number the loaded results are current as of, for patching them after writes
+        if 'change_seq' not in st.session_state:
+            st.session_state.change_seq = None
     
     def render(self):
         """Render the main page"""
@@ -27,7 +43,11 @@ class PurchaseManagerPage:
         self.ui.render_header()
         
         # Sidebar
-        self.ui.render_sidebar_info()
+        try:
+            stats = load_total_stats()
+        except ConnectionError:
+            stats = None
+        self.ui.render_sidebar_info(stats)
         
         # Main content
         self._render_main_content()
@@ -52,6 +72,7 @@ class PurchaseManagerPage:
             
             if result["success"]:
                 self.ui.render_success_message(result["message"])
+                load_total_stats.clear()
                 # Clear form by rerunning
                 st.balloons()
             else:
@@ -64,20 +85,45 @@ class PurchaseManagerPage:
         # Handle search
         if search_params:
             with self.ui.render_loading():
+                # Read before searching, so changes racing the search are replayed rather than missed
+                change_seq = self._current_change_seq()
                 result = self.api_service.search_purchases(search_params)
             
             if result["success"]:
                 st.session_state.search_results = result["data"]
                 st.session_state.last_search_params = search_params
+                st.session_state.next_cursor = result["next_cursor"]
+                st.session_state.change_seq = change_seq
                 if result["count"] > 0:
                     self.ui.render_info_message(f"Found {result['count']} purchase(s)")
             else:
                 self.ui.render_error_message(result["message"])
                 st.session_state.search_results = []
+                st.session_state.next_cursor = None
         
         # Display results
         if st.session_state.search_results:
             self._render_results_section()
+            self._render_load_more()
+    
+    def _render_load_more(self):
+        """Render button that fetches the next page of search results"""
+        if not st.session_state.next_cursor or not st.session_state.last_search_params:
+            return
+        
+        if st.button("⬇️ Load more"):
+            with self.ui.render_loading():
+                result = self.api_service.search_purchases(
+                    st.session_state.last_search_params,
+                    cursor=st.session_state.next_cursor
+                )
+            
+            if result["success"]:
+                st.session_state.search_results = st.session_state.search_results + result["data"]
+                st.session_state.next_cursor = result["next_cursor"]
+                st.rerun()
+            else:
+                self.ui.render_error_message(result["message"])
     
     def _render_results_section(self):
         """Render search results section"""
@@ -103,13 +149,17 @@ class PurchaseManagerPage:
                             
                             if delete_result["success"]:
                                 self.ui.render_success_message("Purchase deleted successfully")
+                                load_total_stats.clear()
                                 # Remove from session state
                                 del st.session_state[delete_key]
-                                # Refresh search results
-                                if st.session_state.last_search_params:
+                                # Patch the loaded results; search again only if that is not possible
+                                if not self._sync_search_results() and st.session_state.last_search_params:
+                                    change_seq = self._current_change_seq()
                                     result = self.api_service.search_purchases(st.session_state.last_search_params)
                                     if result["success"]:
                                         st.session_state.search_results = result["data"]
+                                        st.session_state.next_cursor = result["next_cursor"]
+                                        st.session_state.change_seq = change_seq
                                 st.rerun()
                             else:
                                 self.ui.render_error_message(delete_result["message"])
@@ -125,11 +175,75 @@ class PurchaseManagerPage:
                 purchases_to_keep.append(purchase)
         
         # Render purchases that are not being deleted
-        self.ui.render_purchase_results(purchases_to_keep, show_actions=True)
+        self.ui.render_purchase_results(
+            purchases_to_keep, show_actions=True, receipt_url=self.api_service.get_receipt_url
+        )
         
         # Add export option
         if purchases_to_keep:
             self._render_export_section(purchases_to_keep)
+            self._render_bulk_delete_section()
+    
+    def _current_change_seq(self):
+        """The backend's current change number, or None when it cannot be read"""
+        result = self.api_service.get_changes()
+        return result["next"] if result["success"] else None
+    
+    def _sync_search_results(self) -> bool:
+        """Apply changes made since the results were loaded; False when they must be searched again"""
+        since = st.session_state.change_seq
+        if since is None:
+            return False
+        purchases = st.session_state.search_results
+        while True:
+            result = self.api_service.get_changes(since)
+            # A reset means deletes since then were pruned from the feed
+            if not result["success"] or result["reset"]:
+                return False
+            purchases = self.api_service.apply_changes(purchases, result["changes"])
+            since = result["next"]
+            if not result["more"]:
+                break
+        st.session_state.search_results = purchases
+        st.session_state.change_seq = since
+        return True
+    
+    def _render_bulk_delete_section(self):
+        """Render deletion of every purchase matching the last search"""
+        search_params = st.session_state.last_search_params
+        # Without filters the backend refuses, rather than deleting everything
+        if not search_params or not search_params.to_params():
+            return
+        
+        st.subheader("🗑️ Bulk Delete")
+        if not st.session_state.get("confirm_bulk_delete"):
+            if st.button("🗑️ Delete all matching purchases"):
+                st.session_state.confirm_bulk_delete = True
+                st.rerun()
+            return
+        
+        st.warning("⚠️ This deletes every purchase matching the current filters, not only the ones shown.")
+        col1, col2, col3 = st.columns([1, 1, 2])
+        
+        with col1:
+            if st.button("✅ Yes, Delete All", key="confirm_bulk_yes"):
+                del st.session_state.confirm_bulk_delete
+                with self.ui.render_loading():
+                    delete_result = self.api_service.delete_purchases(search_params)
+                
+                if delete_result["success"]:
+                    self.ui.render_success_message(delete_result["message"])
+                    load_total_stats.clear()
+                    st.session_state.search_results = []
+                    st.session_state.next_cursor = None
+                    st.rerun()
+                else:
+                    self.ui.render_error_message(delete_result["message"])
+        
+        with col2:
+            if st.button("❌ Cancel", key="confirm_bulk_no"):
+                del st.session_state.confirm_bulk_delete
+                st.rerun()
     
     def _render_export_section(self, purchases):
         """Render export options"""
@@ -138,55 +252,42 @@ class PurchaseManagerPage:
         col1, col2 = st.columns(2)
         
         with col1:
-            if st.button("📊 Export as CSV"):
-                csv_data = self._generate_csv(purchases)
-                st.download_button(
-                    label="📥 Download CSV",
-                    data=csv_data,
-                    file_name="purchases_export.csv",
-                    mime="text/csv"
-                )
+            # The backend streams the export, so the browser downloads it directly
+            search_params = st.session_state.last_search_params or SearchParams()
+            st.link_button(
+                "📥 Download CSV",
+                self.api_service.get_export_url(search_params, "csv"),
+                use_container_width=True
+            )
+            st.link_button(
+                "📥 Download Parquet",
+                self.api_service.get_export_url(search_params, "parquet"),
+                use_container_width=True
+            )
+            st.link_button(
+                "🗂️ Download Receipts (ZIP)",
+                self.api_service.get_receipts_zip_url(search_params),
+                use_container_width=True
+            )
         
         with col2:
             if st.button("📋 Copy Summary"):
-                summary = self._generate_summary(purchases)
-                st.code(summary, language="text")
-    
-    def _generate_csv(self, purchases):
-        """Generate CSV data from purchases"""
-        import io
-        import csv
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Header
-        writer.writerow([
-            "ID", "Customer Name", "Customer Surname", "Codice Fiscale",
-            "Credit Card", "Product", "Price", "Date", "Receipt Path"
-        ])
-        
-        # Data
-        for purchase in purchases:
-            writer.writerow([
-                purchase.id, purchase.customer_name, purchase.customer_surname,
-                purchase.customer_cf, purchase.credit_card, purchase.product_name,
-                purchase.price, purchase.date, purchase.receipt_path
-            ])
-        
-        return output.getvalue()
+                # Totals cover every match, computed by the database
+                stats_result = self.api_service.get_stats(st.session_state.last_search_params)
+                if stats_result["success"]:
+                    summary = self._generate_summary(purchases, stats_result["data"])
+                    st.code(summary, language="text")
+                else:
+                    self.ui.render_error_message(stats_result["message"])
     
-    def _generate_summary(self, purchases):
+    def _generate_summary(self, purchases, stats):
         """Generate text summary of purchases"""
-        total_amount = sum(p.price for p in purchases)
-        unique_customers = len(set(p.customer_cf for p in purchases))
-        
         summary = f"""Purchase Summary
 ================
-Total Purchases: {len(purchases)}
-Unique Customers: {unique_customers}
-Total Amount: €{total_amount:.2f}
-Average Purchase: €{total_amount/len(purchases):.2f}
+Total Purchases: {stats.total_purchases}
+Unique Customers: {stats.unique_customers}
+Total Amount: €{stats.total_amount:.2f}
+Average Purchase: €{stats.average_amount:.2f}
 
 Recent Purchases:
 """
@@ -194,8 +295,8 @@ Recent Purchases:
         for purchase in purchases[:5]:  # Show only first 5
             summary += f"- {purchase.customer_name} {purchase.customer_surname}: €{purchase.price:.2f} ({purchase.product_name})\n"
         
-        if len(purchases) > 5:
-            summary += f"... and {len(purchases) - 5} more purchases"
+        if stats.total_purchases > 5:
+            summary += f"... and {stats.total_purchases - 5} more purchases"
         
         return summary
 
@@ -1,10 +1,13 @@
 """
 Service layer for API communication
 """
+import threading
 import requests
+from collections import OrderedDict
+from urllib.parse import urlencode
 import streamlit as st
-from typing import List, Optional, Dict, Any
-from models import PurchaseData, SearchParams, PurchaseResponse
+from typing import List, Optional, Dict, Any, Tuple
+from models import PurchaseData, SearchParams, PurchaseResponse, PurchaseStats
 from config import config
 
 class APIService:
@@ -13,6 +16,32 @@ class APIService:
     def __init__(self):
         self.base_url = config.BACKEND_URL
         self.endpoints = config.ENDPOINTS
+        # Request -> (ETag, payload) of recent responses, shared by every session
+        self._validators: "OrderedDict[str, Tuple[str, Any]]" = OrderedDict()
+        self._validators_lock = threading.Lock()
+    
+    def _conditional_get(self, url: str, params: Dict[str, Any]) -> Tuple[requests.Response, Any]:
+        """GET a JSON payload, sending back the ETag of a previous copy and reusing it on 304"""
+        key = f"{url}?{urlencode(sorted(params.items()), doseq=True)}"
+        with self._validators_lock:
+            cached = self._validators.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        
+        response = requests.get(url, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return response, cached[1]
+        if not response.ok:
+            return response, None
+        
+        payload = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            with self._validators_lock:
+                self._validators[key] = (etag, payload)
+                self._validators.move_to_end(key)
+                while len(self._validators) > config.VALIDATOR_CACHE_SIZE:
+                    self._validators.popitem(last=False)
+        return response, payload
     
     def upload_purchase(self, purchase_data: PurchaseData, receipt_file) -> Dict[str, Any]:
         """Upload a purchase with receipt file"""
@@ -50,23 +79,24 @@ class APIService:
                 "message": f"Unexpected error: {str(e)}"
             }
     
-    def search_purchases(self, search_params: SearchParams) -> Dict[str, Any]:
-        """Search purchases based on parameters"""
+    def search_purchases(self, search_params: SearchParams, cursor: Optional[str] = None,
+                         limit: Optional[int] = None) -> Dict[str, Any]:
+        """Search purchases based on parameters, one page at a time"""
         try:
             params = search_params.to_params()
+            params["limit"] = limit or config.SEARCH_PAGE_SIZE
+            if cursor:
+                params["cursor"] = cursor
             
-            response = requests.get(
-                self.endpoints["search"],
-                params=params
-            )
+            response, page = self._conditional_get(self.endpoints["search"], params)
             
-            if response.ok:
-                purchases_data = response.json()
-                purchases = [PurchaseResponse.from_dict(p) for p in purchases_data]
+            if page is not None:
+                purchases = [PurchaseResponse.from_dict(p) for p in page["items"]]
                 return {
                     "success": True,
                     "data": purchases,
-                    "count": len(purchases)
+                    "count": len(purchases),
+                    "next_cursor": page.get("next_cursor")
                 }
             else:
                 return {
@@ -86,13 +116,50 @@ class APIService:
                 "message": f"Unexpected error: {str(e)}"
             }
     
+    def get_stats(self, search_params: Optional[SearchParams] = None) -> Dict[str, Any]:
+        """Get aggregate statistics computed by the database"""
+        try:
+            params = search_params.to_params() if search_params else {}
+            response = requests.get(self.endpoints["stats"], params=params, timeout=10)
+            
+            if response.ok:
+                return {
+                    "success": True,
+                    "data": PurchaseStats.from_dict(response.json())
+                }
+            else:
+                return {
+                    "success": False,
+                    "message": f"Failed to get statistics: {response.text}",
+                    "status_code": response.status_code
+                }
+                
+        except requests.exceptions.RequestException as e:
+            return {
+                "success": False,
+                "message": f"Connection error: {str(e)}"
+            }
+    
+    def get_export_url(self, search_params: SearchParams, export_format: str = "csv") -> str:
+        """Build the browser-facing URL that streams an export of all matches"""
+        params = search_params.to_params()
+        params["format"] = export_format
+        return f"{self.endpoints['export']}?{urlencode(params)}"
+    
+    def get_receipts_zip_url(self, search_params: SearchParams) -> str:
+        """Build the browser-facing URL that streams a ZIP of every match's receipt"""
+        return f"{self.endpoints['export_receipts']}?{urlencode(search_params.to_params())}"
+    
+    def get_receipt_url(self, purchase_id: int) -> str:
+        """Build the browser-facing URL that serves a purchase's receipt PDF"""
+        return f"{self.endpoints['receipt']}/{purchase_id}/receipt"
+    
     def get_purchase_by_id(self, purchase_id: int) -> Dict[str, Any]:
         """Get a single purchase by ID"""
         try:
-            response = requests.get(f"{self.endpoints['purchase']}/{purchase_id}")
+            response, purchase_data = self._conditional_get(f"{self.endpoints['purchase']}/{purchase_id}", {})
             
-            if response.ok:
-                purchase_data = response.json()
+            if purchase_data is not None:
                 purchase = PurchaseResponse.from_dict(purchase_data)
                 return {
                     "success": True,
@@ -144,6 +211,80 @@ class APIService:
                 "message": f"Unexpected error: {str(e)}"
             }
     
+    def delete_purchases(self, search_params: SearchParams) -> Dict[str, Any]:
+        """Delete every purchase matching the search filters in one request"""
+        try:
+            response = requests.delete(self.endpoints["purchases"], params=search_params.to_params())
+            
+            if response.ok:
+                deleted = response.json()["deleted"]
+                return {
+                    "success": True,
+                    "message": f"Deleted {deleted} purchase(s)",
+                    "deleted": deleted
+                }
+            else:
+                return {
+                    "success": False,
+                    "message": f"Failed to delete purchases: {response.text}",
+                    "status_code": response.status_code
+                }
+                
+        except requests.exceptions.RequestException as e:
+            return {
+                "success": False,
+                "message": f"Connection error: {str(e)}"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "message": f"Unexpected error: {str(e)}"
+            }
+    
+    def get_changes(self, since: Optional[int] = None) -> Dict[str, Any]:
+        """Fetch purchases written and deleted after change number `since`; without it, just the current number"""
+        try:
+            params = {} if since is None else {"since": since}
+            response = requests.get(self.endpoints["changes"], params=params)
+            
+            if response.ok:
+                feed = response.json()
+                return {
+                    "success": True,
+                    "changes": feed["changes"],
+                    "next": feed["next"],
+                    "more": feed["more"],
+                    "reset": feed["reset"]
+                }
+            else:
+                return {
+                    "success": False,
+                    "message": f"Failed to fetch changes: {response.text}",
+                    "status_code": response.status_code
+                }
+                
+        except requests.exceptions.RequestException as e:
+            return {
+                "success": False,
+                "message": f"Connection error: {str(e)}"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "message": f"Unexpected error: {str(e)}"
+            }
+    
+    @staticmethod
+    def apply_changes(purchases: List[PurchaseResponse], changes: List[Dict[str, Any]]) -> List[PurchaseResponse]:
+        """Patch loaded purchases with change feed entries: drop deleted ones, refresh rewritten ones in place"""
+        by_id = {purchase.id: purchase for purchase in purchases}
+        for change in changes:
+            if change["op"] == "delete":
+                by_id.pop(change["id"], None)
+            elif change["id"] in by_id:
+                by_id[change["id"]] = PurchaseResponse.from_dict(change["purchase"])
+        return [by_id[purchase.id] for purchase in purchases if purchase.id in by_id]
+    
     def health_check(self) -> Dict[str, Any]:
         """Check API health status"""
         try:
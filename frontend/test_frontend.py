@@ -10,7 +10,7 @@ import os
 # Add the frontend directory to Python path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from models import PurchaseData, SearchParams, PurchaseResponse
+from models import PurchaseData, SearchParams, PurchaseResponse, PurchaseStats
 from utils import ValidationUtils, FormatUtils, FileUtils
 
 class TestModels(unittest.TestCase):
@@ -42,7 +42,21 @@ class TestModels(unittest.TestCase):
         self.assertIn("name", params)
         self.assertNotIn("cf", params)
         self.assertNotIn("product", params)
-    
+
+    def test_search_params_date_range(self):
+        """Test SearchParams date range query parameters"""
+        search = SearchParams(date_from="2025-01-01", date_to="2025-01-31")
+        params = search.to_params()
+
+        self.assertEqual(params, {"date_from": "2025-01-01", "date_to": "2025-01-31"})
+
+    def test_search_params_price_range(self):
+        """Test SearchParams keeps a zero minimum price"""
+        search = SearchParams(price_min=0.0, price_max=500.0)
+        params = search.to_params()
+
+        self.assertEqual(params, {"price_min": "0.0", "price_max": "500.0"})
+
     def test_purchase_response_from_dict(self):
         """Test PurchaseResponse creation from dictionary"""
         data = {
@@ -63,6 +77,20 @@ class TestModels(unittest.TestCase):
         self.assertEqual(purchase.customer_name, "John")
         self.assertEqual(purchase.price, 99.99)
 
+    def test_purchase_stats_from_dict(self):
+        """Test PurchaseStats creation from dictionary"""
+        stats = PurchaseStats.from_dict({
+            "total_purchases": 3,
+            "total_amount": 35.5,
+            "average_amount": 11.83,
+            "unique_customers": 2,
+            "today_purchases": 1
+        })
+        
+        self.assertEqual(stats.total_purchases, 3)
+        self.assertEqual(stats.unique_customers, 2)
+        self.assertEqual(stats.today_purchases, 1)
+
 class TestValidationUtils(unittest.TestCase):
     """Test cases for validation utilities"""
     
@@ -231,6 +259,156 @@ class TestAPIService(unittest.TestCase):
         
         self.assertTrue(mock_response.ok)
         self.assertEqual(len(mock_response.json()), 1)
+    
+    @patch('services.requests.get')
+    def test_search_purchases_returns_next_cursor(self, mock_get):
+        """Test search sends the cursor and exposes the next one"""
+        from services import APIService
+        
+        mock_response = Mock()
+        mock_response.ok = True
+        mock_response.json.return_value = {"items": [], "next_cursor": "abc"}
+        mock_get.return_value = mock_response
+        
+        result = APIService().search_purchases(SearchParams(cf="RSS"), cursor="prev", limit=10)
+        
+        params = mock_get.call_args.kwargs["params"]
+        self.assertEqual(params["cursor"], "prev")
+        self.assertEqual(params["limit"], 10)
+        self.assertEqual(result["next_cursor"], "abc")
+
+    @patch('services.requests.get')
+    def test_search_purchases_revalidates_with_etag(self, mock_get):
+        """Test a repeated search sends If-None-Match and reuses the page on 304"""
+        from services import APIService
+        
+        first = Mock(ok=True, status_code=200, headers={"ETag": '"7-abc"'})
+        first.json.return_value = {"items": [], "next_cursor": "abc"}
+        not_modified = Mock(ok=True, status_code=304, headers={"ETag": '"7-abc"'})
+        mock_get.side_effect = [first, not_modified]
+        
+        service = APIService()
+        service.search_purchases(SearchParams(cf="RSS"))
+        result = service.search_purchases(SearchParams(cf="RSS"))
+        
+        self.assertEqual(mock_get.call_args_list[0].kwargs["headers"], {})
+        self.assertEqual(mock_get.call_args.kwargs["headers"], {"If-None-Match": '"7-abc"'})
+        self.assertTrue(result["success"])
+        self.assertEqual(result["next_cursor"], "abc")
+        not_modified.json.assert_not_called()
+
+    def test_apply_changes_patches_loaded_purchases(self):
+        """Test change feed entries drop deleted purchases and replace rewritten ones in order"""
+        from services import APIService
+        
+        def purchase(purchase_id, product):
+            return {
+                "id": purchase_id, "customer_name": "John", "customer_surname": "Doe",
+                "customer_cf": "RSSMRA80A01H501U", "credit_card": "1234567890123456",
+                "product_name": product, "price": 10.0, "date": "2025-01-01",
+                "receipt_path": f"/receipts/{purchase_id}.pdf"
+            }
+        
+        loaded = [PurchaseResponse.from_dict(purchase(i, "Old")) for i in (3, 2, 1)]
+        changes = [
+            {"seq": 7, "op": "upsert", "id": 1, "purchase": purchase(1, "New")},
+            {"seq": 8, "op": "delete", "id": 2},
+            {"seq": 9, "op": "upsert", "id": 4, "purchase": purchase(4, "Unloaded")},
+        ]
+        
+        patched = APIService.apply_changes(loaded, changes)
+        
+        self.assertEqual([p.id for p in patched], [3, 1])
+        self.assertEqual(patched[1].product_name, "New")
+    
+    @patch('services.requests.get')
+    def test_sidebar_stats_are_reused_across_reruns(self, mock_get):
+        """Test the sidebar's whole-table statistics are fetched once, then served from the cache"""
+        from pages import load_total_stats
+        
+        mock_response = Mock(ok=True)
+        mock_response.json.return_value = {
+            "total_purchases": 3, "total_amount": 30.0, "average_amount": 10.0,
+            "unique_customers": 2, "today_purchases": 1
+        }
+        mock_get.return_value = mock_response
+        load_total_stats.clear()
+        
+        first = load_total_stats()
+        second = load_total_stats()
+        
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(second.total_purchases, first.total_purchases)
+        load_total_stats.clear()
+    
+    @patch('services.requests.get')
+    def test_get_purchase_by_id_revalidates_with_etag(self, mock_get):
+        """Test a repeated purchase lookup sends If-None-Match and reuses the purchase on 304"""
+        from services import APIService
+        
+        first = Mock(ok=True, status_code=200, headers={"ETag": '"42-3-abc"'})
+        first.json.return_value = {
+            "id": 42, "customer_name": "John", "customer_surname": "Doe",
+            "customer_cf": "RSSMRA80A01H501U", "credit_card": "1234567890123456",
+            "product_name": "Test Product", "price": 99.99, "date": "2025-01-01",
+            "receipt_path": "/path/to/receipt.pdf"
+        }
+        not_modified = Mock(ok=True, status_code=304, headers={"ETag": '"42-3-abc"'})
+        mock_get.side_effect = [first, not_modified]
+        
+        service = APIService()
+        service.get_purchase_by_id(42)
+        result = service.get_purchase_by_id(42)
+        
+        self.assertEqual(mock_get.call_args.kwargs["headers"], {"If-None-Match": '"42-3-abc"'})
+        self.assertTrue(result["success"])
+        self.assertEqual(result["data"].id, 42)
+        not_modified.json.assert_not_called()
+    
+    @patch('services.requests.delete')
+    def test_delete_purchases_sends_filters(self, mock_delete):
+        """Test bulk delete sends the search filters in one request"""
+        from services import APIService
+        
+        mock_response = Mock()
+        mock_response.ok = True
+        mock_response.json.return_value = {"message": "Deleted 3 purchases.", "deleted": 3}
+        mock_delete.return_value = mock_response
+        
+        result = APIService().delete_purchases(SearchParams(cf="RSS", product="Desk"))
+        
+        self.assertTrue(result["success"])
+        self.assertEqual(result["deleted"], 3)
+        self.assertEqual(mock_delete.call_args.kwargs["params"], {"cf": "RSS", "product": "Desk"})
+    
+    def test_get_export_url_includes_filters(self):
+        """Test export URL carries the search filters and format"""
+        from services import APIService
+        
+        url = APIService().get_export_url(SearchParams(cf="RSS", product="Desk"), "parquet")
+        
+        self.assertIn("/export?", url)
+        self.assertIn("cf=RSS", url)
+        self.assertIn("product=Desk", url)
+        self.assertIn("format=parquet", url)
+
+    def test_get_receipts_zip_url_includes_filters(self):
+        """Test receipt ZIP URL carries the search filters"""
+        from services import APIService
+        
+        url = APIService().get_receipts_zip_url(SearchParams(cf="RSS", date_from="2025-01-01"))
+        
+        self.assertIn("/export/receipts?", url)
+        self.assertIn("cf=RSS", url)
+        self.assertIn("date_from=2025-01-01", url)
+    
+    def test_get_receipt_url(self):
+        """Test receipt URL points at the purchase's receipt endpoint"""
+        from services import APIService
+        
+        url = APIService().get_receipt_url(42)
+        
+        self.assertTrue(url.endswith("/purchase/42/receipt"))
 
 if __name__ == '__main__':
     # Run tests